@@ -0,0 +1,287 @@
+"""
+audit_netcdfs.py
+
+Check every netCDF in the archive for problems in one parallel, incremental pass
+
+Each file is opened once in a worker process and only its header is read,
+plus the first and last time values. That is enough to detect:
+    corrupt   - won't open (e.g. "NetCDF: HDF error")
+    truncated - shorter than its HDF5 superblock says, or the last values can't be read
+    empty     - zero-length npts dimension
+    wrong_day - times fall outside the day in the filename (see check_nc_multiday.py)
+    schema    - missing variables or variables on the wrong dimension
+
+Verdicts are cached in SQLite keyed by (path, size, mtime), so files that
+haven't changed since the last audit are not reopened. Bad files are also
+flagged invalid in the product catalog.
+
+    python3 audit_netcdfs.py [-p fit_nc] [-d /project/superdarn/data/netcdf] [--delete]
+"""
+import argparse
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+import netCDF4
+import helper
+import jdutil
+import product_catalog
+
+NUM_WORKERS = os.cpu_count()
+CHUNK_SIZE = 64  # files per worker task
+
+VERDICTS = ['ok', 'corrupt', 'truncated', 'empty', 'wrong_day', 'schema']
+DELETABLE_VERDICTS = ['corrupt', 'truncated', 'empty']
+
+# Required variables and dimensions of each product, and the variable holding time
+SCHEMAS = {
+    'fit_nc': {
+        'dir': '/project/superdarn/data/netcdf',
+        'time_var': 'mjd',
+        'vars': {vn: ('npts',) for vn in [
+            'mjd', 'beam', 'range', 'lat', 'lon', 'p_l', 'v', 'v_e', 'w_l',
+            'w_l_e', 'gflg', 'tfreq', 'noise.sky', 'cp']},
+    },
+    'fit_nc_merged': {
+        'dir': '/project/superdarn/data/netcdf_merged',
+        'time_var': 'mjd',
+        'vars': {
+            **{vn: ('npts',) for vn in [
+                'mjd', 'beam', 'range', 'lat', 'lon', 'p_l', 'v', 'v_e', 'w_l',
+                'w_l_e', 'gflg', 'tfreq', 'noise.sky', 'cp', 'radar_index']},
+            **{vn: ('radar',) for vn in ['radar.code', 'radar.lat', 'radar.lon']},
+            **{vn: ('index',) for vn in ['index_mjd', 'index_offset']},
+        },
+    },
+    'grid_nc': {
+        'dir': '/project/superdarn/data/grid_nc',
+        'time_var': 'mjd_start',
+        'vars': {
+            **{vn: ('time',) for vn in [
+                'mjd_start', 'mjd_end', 'vector_offset', 'vector_count']},
+            **{vn: ('npts',) for vn in [
+                'vector.glat', 'vector.glon', 'vector.g_kvect', 'vector.mlat', 'vector.mlon',
+                'vector.kvect', 'vector.vel.median', 'vector.vel.sd', 'vector.vel.dirn',
+                'vector.pwr.median', 'vector.wdt.median']},
+        },
+    },
+}
+
+HDF5_SIGNATURE = b'\x89HDF\r\n\x1a\n'
+
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS audit (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    verdict TEXT,
+    detail TEXT
+);
+"""
+
+
+def main(product='fit_nc', netcdf_dir=None, cache_fn=helper.NC_AUDIT_DB,
+         log_dir=os.path.join(helper.LOG_DIR, 'netCDF_check'),
+         delete=False, num_workers=NUM_WORKERS):
+    start_time = time.time()
+    if netcdf_dir is None:
+        netcdf_dir = SCHEMAS[product]['dir']
+
+    results = audit_archive(netcdf_dir, product, cache_fn, num_workers)
+    write_logs(results, log_dir, product)
+
+    bad = {path: res for path, res in results.items() if res[0] != 'ok'}
+    flag_in_catalog(bad)
+
+    if delete:
+        for path, (verdict, _) in bad.items():
+            if verdict in DELETABLE_VERDICTS:
+                print('Deleting {0} ({1})'.format(path, verdict))
+                os.remove(path)
+
+    for verdict in VERDICTS:
+        print('{0}: {1}'.format(verdict, sum(1 for res in results.values() if res[0] == verdict)))
+    print('Audit of {0} files took {1}'.format(
+        len(results), helper.getTimeString(time.time() - start_time)))
+
+
+def audit_archive(netcdf_dir, product, cache_fn=helper.NC_AUDIT_DB, num_workers=NUM_WORKERS):
+    """ Return {path: (verdict, detail)} for every .nc file under netcdf_dir """
+    os.makedirs(os.path.dirname(os.path.abspath(cache_fn)), exist_ok=True)
+    conn = sqlite3.connect(cache_fn)
+    conn.executescript(CACHE_SCHEMA)
+
+    cached = {row[0]: row[1:] for row in conn.execute(
+        'SELECT path, size, mtime, verdict, detail FROM audit WHERE path LIKE ?',
+        (os.path.join(netcdf_dir, '') + '%',))}
+
+    results = {}
+    to_check = []
+    for path, size, mtime in list_netcdfs(netcdf_dir):
+        entry = cached.get(path)
+        if entry and entry[0] == size and entry[1] == mtime:
+            results[path] = (entry[2], entry[3])
+        else:
+            to_check.append(path)
+
+    print('{0} files unchanged since the last audit, {1} to check'.format(
+        len(results), len(to_check)))
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        args = [(path, product) for path in to_check]
+        for ct, res in enumerate(executor.map(audit_file_star, args, chunksize=CHUNK_SIZE)):
+            path, size, mtime, verdict, detail = res
+            results[path] = (verdict, detail)
+            conn.execute('INSERT OR REPLACE INTO audit VALUES (?, ?, ?, ?, ?)', res)
+            if (ct + 1) % 10000 == 0:
+                conn.commit()
+                print('Checked {0} of {1}'.format(ct + 1, len(to_check)))
+
+    # Forget files that have since been removed
+    gone = set(cached) - set(results)
+    conn.executemany('DELETE FROM audit WHERE path = ?', [(p,) for p in gone])
+    conn.commit()
+    conn.close()
+
+    return results
+
+
+def list_netcdfs(netcdf_dir):
+    """ Yield (path, size, mtime) of every .nc file under netcdf_dir """
+    for path, _, files in os.walk(netcdf_dir):
+        for fname in files:
+            if os.path.splitext(fname)[-1] != '.nc':
+                continue
+            fn = os.path.join(path, fname)
+            fn_info = os.stat(fn)
+            yield fn, fn_info.st_size, fn_info.st_mtime
+
+
+def audit_file_star(args):
+    return audit_file(*args)
+
+
+def audit_file(path, product='fit_nc'):
+    """ Return (path, size, mtime, verdict, detail) for one file """
+    fn_info = os.stat(path)
+    verdict, detail = check_file(path, product)
+    return path, fn_info.st_size, fn_info.st_mtime, verdict, detail
+
+
+def check_file(path, product='fit_nc'):
+    schema = SCHEMAS[product]
+    # A file shorter than the end-of-file address in its superblock was cut off
+    eof_address = get_hdf5_eof_address(path)
+    file_size = os.stat(path).st_size
+    if eof_address is not None and eof_address > file_size:
+        return 'truncated', '{0} of {1} bytes'.format(file_size, eof_address)
+
+    try:
+        ds = netCDF4.Dataset(path)
+    except Exception as e:
+        return 'corrupt', str(e)
+
+    with ds:
+        if 'npts' not in ds.dimensions:
+            return 'schema', 'no npts dimension'
+        if ds.dimensions['npts'].size == 0:
+            return 'empty', ''
+
+        # Header only - missing variables or variables on the wrong dimension
+        for vn, dims in schema['vars'].items():
+            if vn not in ds.variables:
+                return 'schema', 'missing {0}'.format(vn)
+            if ds.variables[vn].dimensions != dims:
+                return 'schema', '{0} has dimensions {1}'.format(vn, ds.variables[vn].dimensions)
+
+        # Reading the first and last times checks the data runs to the end of the file
+        try:
+            tvar = ds.variables[schema['time_var']]
+            first_mjd = float(tvar[0])
+            last_mjd = float(tvar[-1])
+        except Exception as e:
+            return 'truncated', str(e)
+
+    info = product_catalog.parse_filename(os.path.basename(path))
+    if info is not None:
+        file_day = info['date']
+        for mjd in first_mjd, last_mjd:
+            day = jdutil.jd_to_datetime(jdutil.mjd_to_jd(mjd)).strftime('%Y-%m-%d')
+            if day != file_day:
+                return 'wrong_day', 'contains {0}'.format(day)
+
+    return 'ok', ''
+
+
+def get_hdf5_eof_address(path):
+    """ Read the end-of-file address from an HDF5 (netCDF4) superblock, or None """
+    with open(path, 'rb') as fp:
+        sb = fp.read(64)
+    if sb[:8] != HDF5_SIGNATURE or len(sb) < 16:
+        return None
+
+    version = sb[8]
+    if version in (0, 1):
+        offset_size = sb[13]
+        eof_pos = (24 if version == 0 else 28) + 2 * offset_size
+    elif version in (2, 3):
+        offset_size = sb[9]
+        eof_pos = 12 + 2 * offset_size
+    else:
+        return None
+    if offset_size not in (2, 4, 8) or len(sb) < eof_pos + offset_size:
+        return None
+    return int.from_bytes(sb[eof_pos:eof_pos + offset_size], 'little')
+
+
+def write_logs(results, log_dir, product):
+    """ One sorted list of bad files and one per-month summary, written once at the end """
+    os.makedirs(log_dir, exist_ok=True)
+    bad_log_file = os.path.join(log_dir, '{0}_bad_netCDFs.log'.format(product))
+    summary_log_file = os.path.join(log_dir, '{0}_bad_netCDFs_summary.log'.format(product))
+
+    summary = {}
+    lines = []
+    for path in sorted(results):
+        verdict, detail = results[path]
+        month = '-'.join(os.path.dirname(path).split('/')[-2:])
+        summary.setdefault(month, {v: 0 for v in VERDICTS})
+        summary[month][verdict] += 1
+        if verdict != 'ok':
+            lines.append('{0} ({1}{2})\n'.format(
+                path, verdict, ': ' + detail if detail else ''))
+
+    with open(bad_log_file, 'w') as fp:
+        fp.writelines(lines)
+
+    with open(summary_log_file, 'w') as fp:
+        fp.write('Month    ' + ' '.join('{0:>10}'.format(v) for v in VERDICTS) + '\n')
+        for month in sorted(summary):
+            fp.write('{0:8} '.format(month) +
+                     ' '.join('{0:>10}'.format(summary[month][v]) for v in VERDICTS) + '\n')
+
+    print('Wrote {0} and {1}'.format(bad_log_file, summary_log_file))
+
+
+def flag_in_catalog(bad):
+    if not bad:
+        return
+    catalog = product_catalog.open_catalog()
+    for path in bad:
+        product_catalog.set_valid(catalog, path, False)
+    catalog.commit()
+    catalog.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--product', default='fit_nc', choices=list(SCHEMAS.keys()),
+                        help='Product to audit')
+    parser.add_argument('-d', '--dir', help='Top-level netCDF directory (default depends on product)')
+    parser.add_argument('--delete', action='store_true',
+                        help='Delete corrupt, truncated and empty files')
+    parser.add_argument('-n', '--num-workers', type=int, default=NUM_WORKERS)
+    args = parser.parse_args()
+
+    main(product=args.product, netcdf_dir=args.dir, delete=args.delete,
+         num_workers=args.num_workers)
@@ -0,0 +1,95 @@
+"""
+compare_grid_nc.py
+
+Compare native Python grids (fit_nc_to_grid_nc.py) against make_grid grids (fit_to_grid_nc.py)
+
+For each sample radar-day, grids the fit netCDF natively into a scratch
+directory and matches its vectors to the make_grid product by (window start,
+AACGM cell). Reports how many vectors each method produced, how many match, and
+the differences in signed velocity and azimuth of the matched vectors.
+
+    python3 compare_grid_nc.py 20150315 20150316 -r sas kod
+"""
+import argparse
+import datetime as dt
+import os
+import tempfile
+import numpy as np
+import nc_utils
+import helper
+import fit_to_grid_nc
+import fit_nc_to_grid_nc
+
+
+def main(dates, radars, fit_version='3.0', out_dir=None):
+    if out_dir is None:
+        out_dir = tempfile.mkdtemp(prefix='grid_compare_')
+
+    print('%-8s %-5s %9s %9s %9s %12s %12s %12s' % (
+        'Date', 'Radar', 'make_grid', 'native', 'matched', 'med|dv| m/s', 'rms dv m/s', 'med|dk| deg'))
+    results = {}
+    for date in dates:
+        for radar in radars:
+            fn_head = date.strftime('%Y%m%d.{0}.v{1}'.format(radar, fit_version))
+            fit_nc_fn = os.path.join(date.strftime(helper.FIT_NC_DIR_FMT), fn_head + '.nc')
+            make_grid_fn = os.path.join(date.strftime(helper.GRID_NC_DIR_FMT), fn_head + '.grid.nc')
+            native_fn = os.path.join(out_dir, fn_head + '.grid.nc')
+
+            if not (os.path.isfile(fit_nc_fn) and os.path.isfile(make_grid_fn)):
+                print('%s: missing %s or %s - skipping' % (fn_head, fit_nc_fn, make_grid_fn))
+                continue
+            if fit_nc_to_grid_nc.convert_fit_nc_to_grid_nc(date, fit_nc_fn, native_fn, clobber=True) != 0:
+                continue
+
+            stats = compare_grids(make_grid_fn, native_fn)
+            results[(date, radar)] = stats
+            print('%-8s %-5s %9i %9i %9i %12.1f %12.1f %12.1f' % (
+                date.strftime('%Y%m%d'), radar, stats['n_make_grid'], stats['n_native'],
+                stats['n_matched'], stats['median_abs_dv'], stats['rms_dv'], stats['median_abs_dk']))
+
+    return results
+
+
+def compare_grids(make_grid_fn, native_fn):
+    """ Match vectors by (window start, cell) and summarise the differences """
+    ref = load_vectors(make_grid_fn)
+    new = load_vectors(native_fn)
+
+    _, ref_ind, new_ind = np.intersect1d(ref['key'], new['key'], return_indices=True)
+    dv = new['vel'][new_ind] - ref['vel'][ref_ind]
+    dk = fit_to_grid_nc.angle_between(new['kvect'][new_ind], ref['kvect'][ref_ind])
+
+    return {
+        'n_make_grid': len(ref['key']),
+        'n_native': len(new['key']),
+        'n_matched': len(ref_ind),
+        'median_abs_dv': np.median(np.abs(dv)) if len(dv) else np.nan,
+        'rms_dv': np.sqrt(np.mean(dv ** 2)) if len(dv) else np.nan,
+        'median_abs_dk': np.median(np.abs(dk)) if len(dk) else np.nan,
+    }
+
+
+def load_vectors(grid_nc_fn):
+    """ Signed velocity and azimuth of every vector, keyed on (window start, cell centre) """
+    grid_data = nc_utils.ncread_vars(grid_nc_fn)
+    window = np.repeat(np.round(grid_data['mjd_start'] * 86400).astype(np.int64),
+                       grid_data['vector_count'])
+    mlat = np.round(grid_data['vector.mlat'] * 10).astype(np.int64)
+    mlon = np.round(np.mod(grid_data['vector.mlon'], 360) * 10).astype(np.int64)
+
+    return {
+        'key': (window * 2000 + mlat + 1000) * 4000 + mlon,
+        'vel': grid_data['vector.vel.median'] * grid_data['vector.vel.dirn'],
+        'kvect': grid_data['vector.kvect'],
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('dates', nargs='+', help='Sample days (YYYYMMDD)')
+    parser.add_argument('-r', '--radars', nargs='+', required=True, help='Radar codes, e.g. sas kod')
+    parser.add_argument('-o', '--out-dir', help='Where to write the native grids (default: a temp dir)')
+    args = parser.parse_args()
+
+    dates = [dt.datetime.strptime(d, '%Y%m%d') for d in args.dates]
+    main(dates, args.radars, out_dir=args.out_dir)
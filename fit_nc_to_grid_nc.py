@@ -0,0 +1,315 @@
+"""
+fit_nc_to_grid_nc.py
+
+Grid fit netCDFs directly in Python, as an alternative to make_grid
+
+Terms:
+    fit .nc  - daily per-radar netCDF made by fit_to_nc.py (one row per return)
+    grid .nc - gridded, median-filtered LOS velocities (same layout as fit_to_grid_nc.py)
+
+This reproduces the steps of
+    make_grid -xtd -chisham -ion -minsrng 500 -maxsrng 3000
+using vectorised numpy operations on the fit netCDF columns, so there is no
+make_grid subprocess, .grid DMAP file or pydarn re-read:
+    1. Ionospheric scatter only, slant range between minsrng and maxsrng
+    2. 3x3x3 (scan x beam x gate) weighted median filter, as RST FilterRadarScan
+    3. make_grid's velocity/power/width/error limits
+    4. Averaging into 2-minute windows on the equal-area AACGM grid
+
+Differences from make_grid: locations come from the fit netCDF (fit_to_nc.py's
+300 km 'IS' virtual height model) rather than the Chisham model, and files
+written before scan_start_index was added to the fit netCDFs have their scans
+identified from beam sweeps rather than the scan flag. Use compare_grid_nc.py to
+check the output against the make_grid product. Until that has been done, the
+native grids go to their own directory (helper.GRID_NC_NATIVE_DIR_FMT) rather
+than alongside the make_grid product.
+
+    python3 fit_nc_to_grid_nc.py 20150315 20150318
+"""
+import argparse
+import datetime as dt
+import glob
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import netCDF4
+import aacgmv2
+import helper
+import jdutil
+import scan
+import sd_utils
+import fit_to_grid_nc
+
+GRID_INTERVAL = 120  # seconds, make_grid -i default
+MIN_SRANGE = 500  # km
+MAX_SRANGE = 3000  # km
+
+# make_grid's default limits on the fitted parameters
+LIMITS = {
+    'v': (35., 2000.),  # m/s, absolute value
+    'p_l': (3., 50.),  # dB
+    'w_l': (10., 1000.),  # m/s
+    'v_e': (0., 200.),  # m/s
+}
+
+# RST median filter weights: the central scan counts double, as does the central cell of each scan
+FILTER_WEIGHTS = np.array([
+    [[1, 1, 1], [1, 2, 1], [1, 1, 1]],
+    [[2, 2, 2], [2, 4, 2], [2, 2, 2]],
+    [[1, 1, 1], [1, 2, 1], [1, 1, 1]],
+])
+FILTER_THRESHOLD = 12  # minimum total weight of populated neighbours
+FILTER_CHUNK = 64  # scans filtered at a time, to bound memory
+FILTER_VARS = ['v', 'p_l', 'w_l', 'v_e']
+
+SCAN_GAP = 90. / 86400  # days - a pause longer than this always starts a new scan
+LAT_STEP = 1.  # deg., equal-area grid cell height
+
+
+def main(
+        stime=dt.datetime(2015, 3, 15),
+        etime=dt.datetime(2015, 3, 18),
+        fit_nc_fmt=os.path.join(helper.FIT_NC_DIR_FMT, '%Y%m%d.*.nc'),
+        out_dirn=helper.GRID_NC_NATIVE_DIR_FMT,
+        clobber=False,
+        num_workers=fit_to_grid_nc.NUM_WORKERS,
+        ):
+    tasks = []
+    time = stime
+    while time <= etime:
+        out_dirn_t = time.strftime(out_dirn)
+        os.makedirs(out_dirn_t, exist_ok=True)
+        for fit_nc_fn in sorted(glob.glob(time.strftime(fit_nc_fmt))):
+            fn_head = '.'.join(os.path.basename(fit_nc_fn).split('.')[:-1])
+            tasks.append((time, fit_nc_fn, os.path.join(out_dirn_t, fn_head + '.grid.nc')))
+        time += dt.timedelta(days=1)
+
+    print('Gridding %i radar-days with %i workers' % (len(tasks), num_workers))
+    failed = []
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = {executor.submit(convert_fit_nc_to_grid_nc, time, fit_nc_fn, out_fn, clobber=clobber): fit_nc_fn
+                   for time, fit_nc_fn, out_fn in tasks}
+        for future in as_completed(futures):
+            try:
+                status = future.result()
+            except Exception as e:
+                print('Error gridding %s: %s' % (futures[future], e))
+                status = 1
+            if status != 0:
+                failed.append((futures[future], status))
+
+    print('Finished gridding: %i of %i radar-days failed' % (len(failed), len(tasks)))
+    return failed
+
+
+def convert_fit_nc_to_grid_nc(time, fit_nc_fname, out_fname, ref_ht=300.,
+                              minsrng=MIN_SRANGE, maxsrng=MAX_SRANGE, limits=LIMITS,
+                              clobber=False):
+    """ Median-filter and grid one day of fit netCDF, writing a grid netCDF """
+    if os.path.isfile(out_fname) and not clobber:
+        print('Output file exists: %s - skipping' % out_fname)
+        return 0
+
+    with netCDF4.Dataset(fit_nc_fname) as nc:
+        fit = {vn: np.asarray(nc.variables[vn][:]) for vn in
+               ['mjd', 'beam', 'range', 'lat', 'lon', 'gflg'] + FILTER_VARS}
+        if 'scan_start_index' in nc.variables:
+            fit['scan'] = scan.expand_scan_index(nc.variables['scan_start_index'][:], len(fit['mjd']))
+        radar_info_t = {'glat': nc.lat, 'glon': nc.lon, 'alt': nc.alt, 'boresight': nc.boresight}
+        rsep = float(nc.rsep_km)
+        fitVersion = nc.fitacf_version
+
+    out_vars = grid_fit_data(fit, rsep, radar_info_t, time, ref_ht, minsrng, maxsrng, limits)
+    if out_vars is None:
+        print('No valid data in %s - not writing %s' % (fit_nc_fname, out_fname))
+        return 1
+
+    last_window = jdutil.jd_to_datetime(jdutil.mjd_to_jd(out_vars['mjd_start'][-1]))
+    fit_to_grid_nc.add_derived_vars(out_vars, radar_info_t, time, last_window, ref_ht)
+
+    var_defs = fit_to_grid_nc.def_vars()
+    dim_defs = {
+        'time': out_vars['mjd_start'].shape[0],
+        'npts': out_vars['vector.mlat'].shape[0],
+    }
+    hdr_vals = fit_to_grid_nc.get_hdr_vals(radar_info_t, fitVersion)
+    grid_call = 'fit_nc_to_grid_nc.py -i %i -ion -minsrng %i -maxsrng %i (native)' % (
+        GRID_INTERVAL, minsrng, maxsrng)
+    header_info = fit_to_grid_nc.def_header_info(fit_nc_fname, grid_call, hdr_vals)
+    fit_to_grid_nc.write_nc(out_fname, header_info, dim_defs, var_defs, out_vars)
+
+    print('Wrote to %s' % out_fname)
+    return 0
+
+
+def grid_fit_data(fit, rsep, radar_info_t, time, ref_ht=300.,
+                  minsrng=MIN_SRANGE, maxsrng=MAX_SRANGE, limits=LIMITS):
+    """
+    Turn fit netCDF columns into grid variables (AACGM vectors plus window times and
+    the vector_offset/vector_count index). Returns None if nothing survives
+    """
+    # 1. Ionospheric scatter in the range limits
+    keep = (fit['gflg'] == 0) & (fit['range'] >= minsrng) & (fit['range'] <= maxsrng)
+    fit = {k: v[keep] for k, v in fit.items()}
+    if len(fit['mjd']) == 0:
+        return None
+
+    # 2. Median filter
+    order = np.lexsort((fit['beam'], fit['mjd']))
+    fit = {k: v[order] for k, v in fit.items()}
+    if 'scan' in fit:
+        scan_ind = fit['scan'] - fit['scan'].min()
+    else:
+        scan_ind = get_scan_index(fit['mjd'], fit['beam'])
+    gate = np.round((fit['range'] - fit['range'].min()) / rsep).astype(int)
+    filtered = median_filter(scan_ind, fit['beam'].astype(int), gate,
+                             {vn: fit[vn] for vn in FILTER_VARS})
+
+    # 3. Parameter limits
+    keep = np.isfinite(filtered['v'])
+    for vn, (vmin, vmax) in limits.items():
+        val = np.abs(filtered[vn]) if vn == 'v' else filtered[vn]
+        with np.errstate(invalid='ignore'):
+            keep &= (val >= vmin) & (val <= vmax)
+    if not keep.any():
+        return None
+    mjd = fit['mjd'][keep]
+    vals = {vn: filtered[vn][keep] for vn in FILTER_VARS}
+
+    # 4. Bin into windows and AACGM cells
+    mlat, mlon = sd_utils.convert_latlon_cached(
+        fit['lat'][keep], fit['lon'][keep], ref_ht, time, method_code='G2A')
+    good = np.isfinite(mlat)
+    mjd, mlat, mlon = mjd[good], mlat[good], mlon[good]
+    vals = {vn: v[good] for vn, v in vals.items()}
+
+    # LOS direction away from the radar, in AACGM
+    [r_mlat, r_mlon, _] = aacgmv2.convert_latlon_arr(
+        radar_info_t['glat'], radar_info_t['glon'], radar_info_t['alt'], time, method_code='G2A')
+    away_azm = np.deg2rad(sd_utils.calc_bearings(mlat, mlon, r_mlat[0], r_mlon[0], ref_ht) + 180.)
+
+    day0 = np.floor(mjd.min())
+    window = np.floor((mjd - day0) * 86400 / GRID_INTERVAL).astype(np.int64)
+    cell_lat, cell_lon, cell_id = locate_cells(mlat, mlon)
+    keys, inverse = np.unique(window * 1000000 + cell_id, return_inverse=True)
+    inverse = inverse.ravel()
+
+    count = np.bincount(inverse)
+    mean = {vn: np.bincount(inverse, weights=v) / count for vn, v in vals.items()}
+    vel_sd = np.sqrt(np.maximum(
+        np.bincount(inverse, weights=vals['v'] ** 2) / count - mean['v'] ** 2, 0))
+    kvect = np.rad2deg(np.arctan2(np.bincount(inverse, weights=np.sin(away_azm)),
+                                  np.bincount(inverse, weights=np.cos(away_azm))))
+
+    # make_grid reports speed, with negative velocities (towards the radar) flipping the azimuth
+    towards = mean['v'] < 0
+    kvect[towards] += 180.
+    kvect[kvect > 180] -= 360.
+
+    first = np.unique(inverse, return_index=True)[1]
+    windows, vector_count = np.unique(keys // 1000000, return_counts=True)
+    out_vars = {
+        'mjd_start': day0 + windows * GRID_INTERVAL / 86400,
+        'mjd_end': day0 + (windows + 1) * GRID_INTERVAL / 86400,
+        'vector_count': vector_count,
+        'vector_offset': np.cumsum(vector_count) - vector_count,
+        'vector.mlat': cell_lat[first],
+        'vector.mlon': cell_lon[first],
+        'vector.kvect': kvect,
+        'vector.vel.median': np.abs(mean['v']),
+        'vector.vel.sd': vel_sd,
+        'vector.pwr.median': mean['p_l'],
+        'vector.wdt.median': mean['w_l'],
+    }
+    return out_vars
+
+
+def get_scan_index(mjd, beam):
+    """
+    Number the scans in time-sorted returns. A scan ends when the beam sweep reverses
+    (e.g. 15 -> 0 for a clockwise radar) or there is a long pause
+    """
+    rec_start = np.concatenate([[True], (np.diff(mjd) != 0) | (np.diff(beam) != 0)])
+    rec_mjd = mjd[rec_start]
+    rec_beam = beam[rec_start].astype(int)
+
+    steps = np.diff(rec_beam)
+    sweep = np.sign(np.median(steps[steps != 0])) if np.any(steps != 0) else 1
+    new_scan = (np.sign(steps) == -sweep) | (np.diff(rec_mjd) > SCAN_GAP)
+    rec_scan = np.concatenate([[0], np.cumsum(new_scan)])
+
+    return rec_scan[np.cumsum(rec_start) - 1]
+
+
+def median_filter(scan, beam, gate, values, weights=FILTER_WEIGHTS,
+                  threshold=FILTER_THRESHOLD, chunk=FILTER_CHUNK):
+    """
+    Weighted 3x3x3 median filter over (scan, beam, gate), computed on a dense padded cube.
+    Returns the filtered values at each input point, NaN where the populated
+    neighbours weigh less than threshold
+    """
+    nscan, nbeam, ngate = scan.max() + 1, beam.max() + 1, gate.max() + 1
+    cube_inds = (scan + 1, beam + 1, gate + 1)
+    populated = np.zeros((nscan + 2, nbeam + 2, ngate + 2), dtype=np.int16)
+    populated[cube_inds] = 1
+    cubes = {}
+    for vn, v in values.items():
+        cubes[vn] = np.full(populated.shape, np.nan, dtype=np.float32)
+        cubes[vn][cube_inds] = v
+
+    offsets = [(ds, db, dg) for ds in range(3) for db in range(3) for dg in range(3)]
+    filtered = {vn: np.full(len(scan), np.nan) for vn in values}
+    for s0 in range(0, nscan, chunk):
+        s1 = min(s0 + chunk, nscan)
+        in_chunk = (scan >= s0) & (scan < s1)
+        pts = (scan[in_chunk] - s0, beam[in_chunk], gate[in_chunk])
+
+        def neighbour(cube, ds, db, dg):
+            return cube[s0 + ds:s1 + ds, db:nbeam + db, dg:ngate + dg]
+
+        total_weight = sum(weights[o] * neighbour(populated, *o) for o in offsets)
+        accepted = total_weight[pts] >= threshold
+
+        for vn, cube in cubes.items():
+            # Each neighbour appears once per unit of weight, giving a weighted median
+            layers = [neighbour(cube, *o)[pts] for o in offsets for _ in range(weights[o])]
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                med = np.nanmedian(np.stack(layers), axis=0)
+            med[~accepted] = np.nan
+            filtered[vn][in_chunk] = med
+
+    return filtered
+
+
+def locate_cells(mlat, mlon):
+    """
+    Equal-area AACGM grid as used by RST: 1-degree latitude bands, each split into
+    round(360 cos(lat)) longitude cells. Returns cell centres and an integer cell ID
+    """
+    lat_band = np.floor(np.abs(mlat) / LAT_STEP)
+    cell_lat = np.sign(mlat) * (lat_band + 0.5) * LAT_STEP
+    nlon = np.maximum(np.round(360. * np.cos(np.deg2rad(np.abs(cell_lat)))), 1)
+    dlon = 360. / nlon
+    lon_ind = np.floor(np.mod(mlon, 360.) / dlon)
+    cell_lon = (lon_ind + 0.5) * dlon
+
+    cell_id = ((np.sign(mlat) + 1) * 100 + lat_band).astype(np.int64) * 1000 + lon_ind.astype(np.int64)
+    return cell_lat, cell_lon, cell_id
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('start_date', help='Specify the start date (YYYYMMDD)')
+    parser.add_argument('end_date', help='Specify the end date (YYYYMMDD)')
+    parser.add_argument('-o', '--out-dir', default=helper.GRID_NC_NATIVE_DIR_FMT,
+                        help='Output directory format (default: %(default)s)')
+    parser.add_argument('-n', '--num-workers', type=int, default=fit_to_grid_nc.NUM_WORKERS)
+    parser.add_argument('--clobber', action='store_true', help='Overwrite existing files')
+    args = parser.parse_args()
+
+    stime = dt.datetime.strptime(args.start_date, '%Y%m%d')
+    etime = dt.datetime.strptime(args.end_date, '%Y%m%d')
+
+    main(stime, etime, out_dirn=args.out_dir, clobber=args.clobber, num_workers=args.num_workers)
@@ -0,0 +1,270 @@
+"""
+fit_nc_to_meteorwind.py
+
+Estimate hourly meteor winds directly from fit netCDFs, as an alternative to make_cfit + meteorproc
+
+Terms:
+    fit .nc        - daily per-radar netCDF made by fit_to_nc.py (one row per return)
+    meteorwind .nc - hourly winds in the layout written by meteorproc_to_nc.py (hour, Vx, Vy, sdev_Vx, sdev_Vy, lat, long)
+
+Meteor echoes are taken to be the near-range, narrow-spectrum returns. Each one
+is assumed to come from METEOR_HEIGHT, which fixes its elevation angle and
+so the off-boresight azimuth of its beam (Milan et al. [1997]). For each
+radar-hour, the horizontal wind (Vx along the boresight, Vy 90 deg. to the
+right) is then the least-squares solution of
+    v_los = cos(el) * (Vx cos(az) + Vy sin(az))
+over all the beams.
+
+All radar-hours of a day are solved together: the 2x2 normal equations are
+accumulated with np.bincount and solved as one batch. Days run in a pool of
+worker processes.
+
+Differences from meteorproc: no cfit step, the echo selection uses the LIMITS
+below rather than meteorproc's flags, and there is no iterative outlier
+rejection. sdev_Vx/sdev_Vy come from the residuals of the fit. The winds are
+written to their own directory (helper.METEORWIND_NATIVE_NC_DIR_FMT) and tagged
+estimator = 'fit_nc_to_meteorwind', so they are never mixed up with meteorproc's.
+
+    python3 fit_nc_to_meteorwind.py 20150315 20150318
+"""
+import argparse
+import datetime as dt
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import netCDF4
+import numpy as np
+import helper
+import jdutil
+import meteorproc_to_nc
+import product_catalog
+from sd_utils import get_random_string
+
+NUM_WORKERS = os.cpu_count()
+RE = 6371.  # km
+METEOR_HEIGHT = 95.  # km, assumed height of the meteor echoes
+MIN_ECHOES = 10  # per radar-hour
+MIN_DET = 1E-6  # normal-equation determinant (relative to trace^2) below which Vx/Vy are unresolved
+ESTIMATOR = 'fit_nc_to_meteorwind'  # 'estimator' global attribute, to tell these winds from meteorproc's
+
+# Echo selection - fit netCDF variable: (min, max)
+LIMITS = {
+    'range': (100., 400.),  # km, slant range
+    'w_l': (0., 25.),  # m/s, spectral width
+    'v': (-150., 150.),  # m/s
+    'v_e': (0., 25.),  # m/s
+}
+
+
+def main(start_date, end_date,
+         in_dir_fmt=helper.FIT_NC_DIR_FMT,
+         out_dir_fmt=helper.METEORWIND_NATIVE_NC_DIR_FMT,
+         fit_version='3.0',
+         num_workers=NUM_WORKERS,
+         clobber=False,
+         ):
+    """ Write meteor wind netCDFs for every radar-day between start_date and end_date """
+    days = []
+    time = start_date
+    while time <= end_date:
+        days.append(time)
+        time += dt.timedelta(days=1)
+
+    print('Fitting meteor winds for %i days with %i workers' % (len(days), num_workers))
+    failed = []
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = {executor.submit(convert_day, day, in_dir_fmt, out_dir_fmt, fit_version, clobber): day
+                   for day in days}
+        for future in as_completed(futures):
+            day = futures[future]
+            try:
+                status = future.result()
+            except Exception as e:
+                print('Error fitting winds for %s: %s' % (day.strftime('%Y-%m-%d'), e))
+                status = 1
+            if status != 0:
+                failed.append(day)
+
+    print('Finished meteor winds: %i of %i days failed' % (len(failed), len(days)))
+    return failed
+
+
+def convert_day(time, in_dir_fmt=helper.FIT_NC_DIR_FMT, out_dir_fmt=helper.METEORWIND_NATIVE_NC_DIR_FMT,
+                fit_version='3.0', clobber=False):
+    """ Fit every radar-hour of one day in one batch and write a wind netCDF per radar """
+    out_dir = time.strftime(out_dir_fmt)
+    fit_fns = {}
+    for fit_fn in sorted(glob.glob(os.path.join(time.strftime(in_dir_fmt), time.strftime('%Y%m%d.*.nc')))):
+        info = product_catalog.parse_filename(os.path.basename(fit_fn))
+        if info is None or info['radar'] is None or info['version'] not in (None, str(fit_version)):
+            continue
+        out_fn = os.path.join(out_dir, time.strftime('%Y%b%d.') + '%s.nc' % info['radar'])
+        if os.path.isfile(out_fn) and not clobber:
+            print('File exists: %s - skipping' % out_fn)
+            continue
+        fit_fns[info['radar']] = (fit_fn, out_fn)
+    if len(fit_fns) == 0:
+        return 0
+
+    # Pool the meteor echoes of all radars, grouped by radar-hour
+    radars = sorted(fit_fns)
+    day_mjd = jdutil.jd_to_mjd(jdutil.datetime_to_jd(time))
+    echoes = {'group': [], 'v': [], 'los_x': [], 'los_y': [], 'lat': [], 'lon': []}
+    headers = {}
+    for ind, radar in enumerate(radars):
+        echoes_r, headers[radar] = load_echoes(fit_fns[radar][0])
+        hour = np.floor((echoes_r.pop('mjd') - day_mjd) * 24)
+        # Daily files can run past midnight - drop echoes from outside the target day
+        in_day = (hour >= 0) & (hour < 24)
+        echoes['group'].append(ind * 24 + hour[in_day].astype(int))
+        for k, v in echoes_r.items():
+            echoes[k].append(v[in_day])
+    echoes = {k: np.concatenate(v) for k, v in echoes.items()}
+
+    winds = fit_winds(echoes, len(radars) * 24)
+
+    os.makedirs(out_dir, exist_ok=True)
+    for ind, radar in enumerate(radars):
+        groups = np.arange(ind * 24, (ind + 1) * 24)
+        good = np.isfinite(winds['Vx'][groups])
+        if not good.any():
+            print('No meteor winds for %s on %s' % (radar, time.strftime('%Y-%m-%d')))
+            continue
+        outvars = {k: v[groups][good] for k, v in winds.items()}
+        outvars['hour'] = np.arange(24.)[good]
+        write_winds(fit_fns[radar][1], outvars, headers[radar], fit_fns[radar][0])
+
+    return 0
+
+
+def load_echoes(fit_nc_fn):
+    """
+    Select the meteor echoes from a fit netCDF. Returns their times, LOS velocities,
+    the horizontal projections of their look directions onto the boresight (los_x)
+    and its right-hand normal (los_y), their locations, and the radar header
+    """
+    with netCDF4.Dataset(fit_nc_fn) as nc:
+        rng = np.asarray(nc.variables['range'][:])
+        near = (rng >= LIMITS['range'][0]) & (rng <= LIMITS['range'][1])
+        fit = {vn: np.asarray(nc.variables[vn][:])[near] for vn in
+               ['mjd', 'beam', 'v', 'w_l', 'v_e', 'lat', 'lon']}
+        fit['range'] = rng[near]
+        hdr = {
+            'lat': float(nc.lat), 'lon': float(nc.lon),
+            'rsep': float(nc.rsep_km), 'bmsep': float(nc.bmsep),
+            'boresight': float(nc.boresight), 'nbeams': np.size(nc.beams),
+        }
+
+    keep = np.ones(len(fit['mjd']), dtype=bool)
+    for vn, (vmin, vmax) in LIMITS.items():
+        keep &= (fit[vn] >= vmin) & (fit[vn] <= vmax)
+    fit = {k: v[keep] for k, v in fit.items()}
+
+    # Elevation of an echo at METEOR_HEIGHT, then its beam's azimuth at that elevation
+    srange = fit['range'].astype(float)
+    sin_el = np.clip(((RE + METEOR_HEIGHT) ** 2 - RE ** 2 - srange ** 2) / (2 * RE * srange), 0., 1.)
+    elevation = np.rad2deg(np.arcsin(sin_el))
+    boff_zero = hdr['bmsep'] * (fit['beam'] - (hdr['nbeams'] - 1) / 2.)
+    az = np.deg2rad(az_off_bore(elevation, boff_zero))
+    cos_el = np.sqrt(1. - sin_el ** 2)
+
+    echoes = {
+        'mjd': fit['mjd'],
+        'v': fit['v'].astype(float),
+        'los_x': cos_el * np.cos(az),
+        'los_y': cos_el * np.sin(az),
+        'lat': fit['lat'].astype(float),
+        'lon': fit['lon'].astype(float),
+    }
+    return echoes, hdr
+
+
+def az_off_bore(elevation, boff_zero):
+    """ Vectorised radFov.calcAzOffBore (front field of view), in degrees """
+    bdir = np.cos(np.deg2rad(boff_zero)) ** 2 - np.sin(np.deg2rad(elevation)) ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bore_offset = np.where(bdir > 0., np.arctan(np.sqrt(np.sin(np.deg2rad(boff_zero)) ** 2 / bdir)), np.pi / 2.)
+    return np.rad2deg(np.sign(boff_zero) * bore_offset)
+
+
+def fit_winds(echoes, ngroups, min_echoes=MIN_ECHOES):
+    """
+    Least-squares Vx, Vy (and their standard deviations) for every group of echoes
+    at once. Groups with too few echoes or too little spread in azimuth are NaN
+    """
+    def group_sum(vals):
+        return np.bincount(echoes['group'], weights=vals, minlength=ngroups)
+
+    a1, a2, b = echoes['los_x'], echoes['los_y'], echoes['v']
+    count = np.bincount(echoes['group'], minlength=ngroups)
+    ata = np.stack([group_sum(a1 * a1), group_sum(a1 * a2),
+                    group_sum(a1 * a2), group_sum(a2 * a2)], axis=-1).reshape(ngroups, 2, 2)
+    atb = np.stack([group_sum(a1 * b), group_sum(a2 * b)], axis=-1)
+    btb = group_sum(b * b)
+
+    det = np.linalg.det(ata)
+    trace = ata[:, 0, 0] + ata[:, 1, 1]
+    ok = (count >= min_echoes) & (det > MIN_DET * trace ** 2)
+
+    ata_inv = np.linalg.inv(ata[ok])
+    x = np.einsum('gij,gj->gi', ata_inv, atb[ok])
+    rss = np.maximum(btb[ok] - np.einsum('gi,gi->g', x, atb[ok]), 0.)
+    sigma2 = rss / (count[ok] - 2)
+
+    winds = {vn: np.full(ngroups, np.nan) for vn in ['Vx', 'Vy', 'sdev_Vx', 'sdev_Vy', 'lat', 'long']}
+    winds['Vx'][ok] = x[:, 0]
+    winds['Vy'][ok] = x[:, 1]
+    winds['sdev_Vx'][ok] = np.sqrt(sigma2 * ata_inv[:, 0, 0])
+    winds['sdev_Vy'][ok] = np.sqrt(sigma2 * ata_inv[:, 1, 1])
+
+    # Mean echo location (circular mean in longitude)
+    lon = np.deg2rad(echoes['lon'])
+    winds['lat'][ok] = (group_sum(echoes['lat']) / np.maximum(count, 1))[ok]
+    winds['long'][ok] = np.rad2deg(np.arctan2(group_sum(np.sin(lon)), group_sum(np.cos(lon))))[ok]
+
+    return winds
+
+
+def write_winds(out_fname, outvars, hdr, fit_nc_fn):
+    """ Write one radar-day in the meteorproc_to_nc layout """
+    var_defs = meteorproc_to_nc.def_vars()
+    header_info = {
+        'description': 'SuperDARN winds from %s' % fit_nc_fn,
+        'params': 'fit_nc_to_meteorwind.py, meteor height %1.0f km, limits %s' % (METEOR_HEIGHT, LIMITS),
+        'history': 'created on %s' % dt.datetime.now(),
+        'lat': outvars['lat'][0],
+        'lon': outvars['long'][0],
+        'rsep': hdr['rsep'],
+        'frang': np.nan,  # not stored in the fit netCDFs
+        'boresight': '%1.2f degrees East of North' % hdr['boresight'],
+        'estimator': ESTIMATOR,
+    }
+
+    tmp_fname = '%s.%s.tmp' % (out_fname, get_random_string(8))
+    with netCDF4.Dataset(tmp_fname, 'w') as nc:
+        meteorproc_to_nc.set_header(nc, header_info)
+        nc.createDimension('npts', size=len(outvars['hour']))
+        for k, v in outvars.items():
+            defs = var_defs[k]
+            var = nc.createVariable(k, defs['type'], defs['dims'])
+            var[:] = v
+            var.units = defs['units']
+            var.long_name = defs['long_name']
+    os.replace(tmp_fname, out_fname)
+    print('Wrote to %s' % out_fname)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('start_date', help='Specify the start date (YYYYMMDD)')
+    parser.add_argument('end_date', help='Specify the end date (YYYYMMDD)')
+    parser.add_argument('-v', '--fit-version', default='3.0')
+    parser.add_argument('-n', '--num-workers', type=int, default=NUM_WORKERS)
+    parser.add_argument('--clobber', action='store_true', help='Overwrite existing wind files')
+    args = parser.parse_args()
+
+    start_date = dt.datetime.strptime(args.start_date, '%Y%m%d')
+    end_date = dt.datetime.strptime(args.end_date, '%Y%m%d')
+
+    main(start_date, end_date, fit_version=args.fit_version,
+         num_workers=args.num_workers, clobber=args.clobber)
@@ -7,13 +7,21 @@ import jdutil
 import datetime as dt
 import aacgmv2
 import os
+import argparse
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from sd_utils import get_radar_params, id_hdw_params_t, get_random_string, get_radar_list
+import sd_utils
 import netCDF4
 import nc_utils
-import nvector as nv
-wgs84 = nv.FrameE(name='WGS84')
 
 MIN_FITACF_FILE_SIZE = 1E5  # bytes
+NUM_WORKERS = os.cpu_count()
+MAKE_GRID_CMD = 'make_grid -xtd -chisham -ion -minsrng 500 -maxsrng 3000 %s > %s'
+COMBINE_GRID_CMD = 'combine_grid %s > %s'
+
+# Variables on the time (per-window) dimension - everything else is per-vector
+TIME_VARS = ['mjd_start', 'mjd_end', 'vector_offset', 'vector_count']
 
 
 def main(
@@ -23,8 +31,19 @@ def main(
         grid_dirn='/project/superdarn/data/grid/%Y/%m/',
         out_dirn='/project/superdarn/data/grid_nc/%Y/%m/',
         hdw_dat_dir='/project/superdarn/software/rst/tables/superdarn/hdw/',
-        clobber=False):
+        clobber=False,
+        num_workers=NUM_WORKERS,
+        combine=False,
+        ):
+    """
+    Grid every radar-day between stime and etime in a pool of worker processes. With combine,
+    each day's radar grids are merged into north/south hemisphere files by combine_grid as
+    soon as that day's radars are all done. Returns a list of (filename, status) failures
+    """
+    radar_info = get_radar_params(hdw_dat_dir)
 
+    # One task per radar-day
+    tasks = []
     time = stime
     while time <= etime:
         grid_dirn_t = time.strftime(grid_dirn)
@@ -32,21 +51,131 @@ def main(
         os.makedirs(grid_dirn_t, exist_ok=True)
         os.makedirs(out_dirn_t, exist_ok=True)
 
-        flist = glob.glob(time.strftime(fit_fn_fmt))
-        for fit_fn in flist:
+        for fit_fn in sorted(glob.glob(time.strftime(fit_fn_fmt))):
             fn_head = '.'.join(os.path.basename(fit_fn).split('.')[:-1])
             grid_fn = os.path.join(grid_dirn_t, fn_head + '.grid')
             out_fn = os.path.join(out_dirn_t, fn_head + '.grid.nc')
-            convert_fit_to_grid_nc(time, fit_fn, grid_fn,
-                                   out_fn, hdw_dat_dir, clobber=clobber)
+            tasks.append((time, fit_fn, grid_fn, out_fn))
 
         time += dt.timedelta(days=1)
 
+    print('Gridding %i radar-days with %i workers' % (len(tasks), num_workers))
+    remaining = {}
+    grid_files = {}
+    for time, _, _, _ in tasks:
+        remaining[time] = remaining.get(time, 0) + 1
+        grid_files[time] = []
+
+    failed = []
+    num_failed = 0
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = {}
+        for time, fit_fn, grid_fn, out_fn in tasks:
+            future = executor.submit(grid_radar_day, time, fit_fn, grid_fn, out_fn, hdw_dat_dir, clobber)
+            futures[future] = (time, fit_fn, grid_fn)
+
+        while futures:
+            future = next(as_completed(futures))
+            time, fname, grid_fn = futures.pop(future)
+            try:
+                status = future.result()
+            except Exception as e:
+                print('Error processing %s: %s' % (fname, e))
+                status = 1
+            if status != 0:
+                failed.append((fname, status))
+                print('Failed (%s): %s' % (status, fname))
+
+            if grid_fn is None:  # a combine_grid task
+                continue
+            if status == 0:
+                # A skipped radar-day (no fit file, or nothing to grid) also returns 0
+                if os.path.isfile(grid_fn):
+                    grid_files[time].append(grid_fn)
+            else:
+                num_failed += 1
+            remaining[time] -= 1
+
+            # All radars for this day are finished - merge them into hemispheric grids
+            if combine and remaining[time] == 0:
+                for hemi, hemi_files in split_hemispheres(grid_files[time], time, radar_info).items():
+                    if len(hemi_files) == 0:
+                        continue
+                    combined_fn = os.path.join(
+                        time.strftime(grid_dirn), time.strftime('%Y%m%d.') + hemi + '.grid')
+                    future = executor.submit(combine_radar_grids, hemi_files, combined_fn, clobber)
+                    futures[future] = (time, combined_fn, None)
+
+    print('Finished gridding: %i of %i radar-days failed' % (num_failed, len(tasks)))
+    return failed
+
+
+def grid_radar_day(time, fit_fn, grid_fn, out_fn, hdw_dat_dir, clobber=False):
+    """ Worker: make_grid then netCDF conversion for one radar-day, returning an exit status """
+    try:
+        status = convert_fit_to_grid_nc(time, fit_fn, grid_fn, out_fn, hdw_dat_dir, clobber=clobber)
+    except Exception as e:
+        print('Error gridding %s: %s' % (fit_fn, e))
+        status = 1
+    return status
+
+
+def combine_radar_grids(grid_fns, combined_fname, clobber=False):
+    """ Worker: combine_grids for one hemisphere-day, returning an exit status """
+    try:
+        status = combine_grids(grid_fns, combined_fname, clobber=clobber)
+    except Exception as e:
+        print('Error combining %s: %s' % (combined_fname, e))
+        status = 1
+    return status
+
+
+def split_hemispheres(grid_fns, time, radar_info):
+    """ Sort a day's radar grid files into north/south by radar latitude, skipping radars not in hdw.dat """
+    hemi_files = {'north': [], 'south': []}
+    for grid_fn in grid_fns:
+        radar_code = os.path.basename(grid_fn).split('.')[1]
+        try:
+            radar_info_t = id_hdw_params_t(time, radar_info[radar_code])
+        except Exception as e:
+            print('Cannot place %s in a hemisphere (%s: %s) - not combining it' %
+                  (grid_fn, type(e).__name__, e))
+            continue
+        hemi_files['north' if radar_info_t['glat'] > 0 else 'south'].append(grid_fn)
+    return hemi_files
+
+
+def combine_grids(grid_fns, combined_fname, combine_cmd=COMBINE_GRID_CMD, clobber=False):
+    """ Run combine_grid on a set of radar grid files to make a hemispheric grid """
+    if os.path.isfile(combined_fname) and not clobber:
+        print('File exists: %s - skipping' % combined_fname)
+        return 0
+    return run_to_file(combine_cmd, ' '.join(sorted(grid_fns)), combined_fname)
+
+
+def run_to_file(cmd_fmt, in_arg, out_fname):
+    """
+    Run an RST command that writes to stdout (cmd_fmt % (in_arg, out_fname)), via a temporary
+    file that only replaces out_fname if the command succeeds. Returns the exit status
+    """
+    tmp_fname = '%s.%s.tmp' % (out_fname, get_random_string(8))
+    result = subprocess.run(cmd_fmt % (in_arg, tmp_fname), shell=True)
+    status = result.returncode
+    if status == 0 and (not os.path.isfile(tmp_fname) or os.stat(tmp_fname).st_size == 0):
+        print('%s produced no output' % cmd_fmt.split()[0])
+        status = 1
+
+    if status == 0:
+        os.replace(tmp_fname, out_fname)
+    elif os.path.isfile(tmp_fname):
+        os.remove(tmp_fname)
+    return status
+
 
 def convert_fit_to_grid_nc(time, fit_fname, grid_fname, out_fname, hdw_dat_dir,
                            fitVersion='3.0',
                            ref_ht=300.,  # matches the RST operation
-                           convert_cmd='make_grid -xtd -chisham -ion -minsrng 500 -maxsrng 3000 %s > %s',
+                           convert_cmd=MAKE_GRID_CMD,
                            clobber=False,
                            ):
     """ Convert fitACF files to .grid (median-filtered & geolocated), then to netCDF """
@@ -55,15 +184,15 @@ def convert_fit_to_grid_nc(time, fit_fname, grid_fname, out_fname, hdw_dat_dir,
     if os.path.isfile(out_fname):
         if not clobber:
             print('Output file exists: %s - skipping' % out_fname)
-            return
+            return 0
 
     # print('Trying to produce %s' % grid_fname)
 
     # Run fit to GRID file conversion
     status = fit_to_grid(fit_fname, grid_fname, convert_cmd, clobber=clobber)
 
-    if status == 1:
-        return 1
+    if status != 0:
+        return status
 
     # print('Trying to produce %s' % out_fname)
 
@@ -81,17 +210,21 @@ def convert_fit_to_grid_nc(time, fit_fname, grid_fname, out_fname, hdw_dat_dir,
     radar_code = os.path.basename(fit_fname).split('.')[1]
     radar_info_t = id_hdw_params_t(time, radar_info[radar_code])
 
-    # set up data holders
+    # set up data holders - each record's arrays are collected in a list and
+    # concatenated once at the end, rather than np.append-ing per record.
+    # Record times are stored once per record, with vector_offset/vector_count
+    # pointing at that record's vectors
     copy_vn = ['vector.mlat', 'vector.mlon', 'vector.kvect', 'vector.vel.median',
                'vector.vel.sd', 'vector.pwr.median', 'vector.wdt.median',
                ]
-    new_vn = ['mjd_start', 'mjd_end', 'vector.glat',
-              'vector.glon', 'vector.g_kvect']
-    out_vars = {}
-    for vn in copy_vn + new_vn:
-        out_vars[vn] = []
-
-    # run through and fill out the out_vars
+    record_vars = {}
+    for vn in copy_vn:
+        record_vars[vn] = []
+    mjd_start = []
+    mjd_end = []
+    vector_count = []
+
+    # run through and fill out the record_vars
     for data in grid_data:
 
         # Skip empty entries
@@ -100,9 +233,9 @@ def convert_fit_to_grid_nc(time, fit_fname, grid_fname, out_fname, hdw_dat_dir,
 
         # straight copy the easy stuff
         for vn in copy_vn:
-            out_vars[vn] = np.append(out_vars[vn], data[vn])
+            record_vars[vn].append(np.atleast_1d(data[vn]))
 
-        # Create the MJD start and end time vectors
+        # Create the MJD start and end times
         stime = dt.datetime(
             int(data['start.year']), int(
                 data['start.month']), int(data['start.day']),
@@ -115,22 +248,49 @@ def convert_fit_to_grid_nc(time, fit_fname, grid_fname, out_fname, hdw_dat_dir,
             int(data['end.hour']), int(
                 data['end.minute']), int(data['end.second']),
         )
-        shape = np.ones(data['vector.mlat'].shape)
-        out_vars['mjd_start'] = np.append(out_vars['mjd_start'],
-                                          jdutil.jd_to_mjd(jdutil.datetime_to_jd(stime)) * shape)
-        out_vars['mjd_end'] = np.append(out_vars['mjd_end'],
-                                        jdutil.jd_to_mjd(jdutil.datetime_to_jd(etime)) * shape)
+        mjd_start.append(jdutil.jd_to_mjd(jdutil.datetime_to_jd(stime)))
+        mjd_end.append(jdutil.jd_to_mjd(jdutil.datetime_to_jd(etime)))
+        vector_count.append(np.size(data['vector.mlat']))
 
     # Check there's something to write
-    if out_vars['mjd_start'] == []:
+    if len(mjd_start) == 0:
         print('No valid data in %s - not writing %s' % (grid_fname, out_fname))
-        return
+        return 1
 
+    out_vars = {}
+    out_vars['mjd_start'] = np.array(mjd_start)
+    out_vars['mjd_end'] = np.array(mjd_end)
+    out_vars['vector_count'] = np.array(vector_count)
+    out_vars['vector_offset'] = np.cumsum(vector_count) - vector_count
+    for vn, arrays in record_vars.items():
+        out_vars[vn] = np.concatenate(arrays)
+
+    add_derived_vars(out_vars, radar_info_t, time, stime, ref_ht)
+
+    # Write out to netCDF
+    var_defs = def_vars()
+    dim_defs = {
+        'time': out_vars['mjd_start'].shape[0],
+        'npts': out_vars['vector.mlat'].shape[0],
+    }
+    hdr_vals = get_hdr_vals(radar_info_t, fitVersion)
+    header_info = def_header_info(fit_fname, convert_cmd, hdr_vals)
+    write_nc(out_fname, header_info, dim_defs, var_defs, out_vars)
+
+    print('Wrote to %s' % out_fname)
+    return 0
+
+
+def add_derived_vars(out_vars, radar_info_t, time, rtime, ref_ht=300.):
+    """
+    Add geographic locations/bearings and velocity direction to gridded AACGM vectors.
+    rtime is the time used to put the radar itself in AACGM
+    """
     # AACGM to geo
     mlat = out_vars['vector.mlat']
     mlon = out_vars['vector.mlon']
-    [out_vars['vector.glat'], out_vars['vector.glon'], alt] = \
-        aacgmv2.convert_latlon_arr(mlat, mlon, ref_ht, time, method_code="A2G")
+    out_vars['vector.glat'], out_vars['vector.glon'] = \
+        sd_utils.convert_latlon_cached(mlat, mlon, ref_ht, time, method_code="A2G")
 
     # geographic bearing
     out_vars['vector.g_kvect'] = calc_bearings(
@@ -141,25 +301,15 @@ def convert_fit_to_grid_nc(time, fit_fname, grid_fname, out_fname, hdw_dat_dir,
     # geomagnetic bearing (to determine whether velocity oriented  towards/away array)
     [r_mlat, r_mlon, _] = aacgmv2.convert_latlon_arr(
         radar_info_t['glat'], radar_info_t['glon'], radar_info_t['alt'],
-        stime, method_code="G2A",
+        rtime, method_code="G2A",
     )
     maz = calc_bearings(r_mlat[0], r_mlon[0], mlat, mlon, ref_ht)
     delta_maz = angle_between(maz, out_vars['vector.kvect'])
     dirn = np.ones(maz.shape)
     dirn[np.abs(delta_maz) > 90.] *= -1
     out_vars['vector.vel.dirn'] = dirn
-    out_vars['vector.vel.median']
-
-    # Write out to netCDF
-    var_defs = def_vars()
-    dim_defs = {
-        'npts': out_vars['mjd_start'].shape[0],
-    }
-    hdr_vals = get_hdr_vals(radar_info_t, fitVersion)
-    header_info = def_header_info(fit_fname, convert_cmd, hdr_vals)
-    write_nc(out_fname, header_info, dim_defs, var_defs, out_vars)
 
-    print('Wrote to %s' % out_fname)
+    return out_vars
 
 
 def angle_between(x, y, deg=True):
@@ -175,8 +325,9 @@ def angle_between(x, y, deg=True):
 
 
 def write_nc(out_fname, header_info, dim_defs, var_defs, out_vars):
-    # Write out the netCDF
-    with netCDF4.Dataset(out_fname, 'w') as nc:
+    # Write out the netCDF to a temporary file, moved into place once complete
+    tmp_fname = '%s.%s.tmp' % (out_fname, get_random_string(8))
+    with netCDF4.Dataset(tmp_fname, 'w') as nc:
         set_header(nc, header_info)
         for k, v in dim_defs.items():
             nc.createDimension(k, size=v)
@@ -199,32 +350,26 @@ def write_nc(out_fname, header_info, dim_defs, var_defs, out_vars):
             var.units = defs['units']
             var.long_name = defs['long_name']
 
+    os.replace(tmp_fname, out_fname)
     return 0
 
 
 def calc_bearings(rlat, rlon, lats, lons, ref_ht):
-    depth = -ref_ht * 1E3
-    brng_deg = np.zeros(len(lats)) * np.nan
-    pointB = wgs84.GeoPoint(
-        latitude=rlat, longitude=rlon, z=depth, degrees=True)
-    for ind, lat in enumerate(lats):
-        lon = lons[ind]
-        pointA = wgs84.GeoPoint(
-            latitude=lat, longitude=lon, z=depth, degrees=True)
-        p_AB_N = pointA.delta_to(pointB)  # note we want the bearing at point A
-        brng_deg[ind] = p_AB_N.azimuth_deg
-
-    return brng_deg
+    # bearing at each vector location towards the radar
+    return sd_utils.calc_bearings(lats, lons, rlat, rlon, ref_ht)
 
 
 def def_vars():
     # netCDF writer expects a series of variable definitions - here they are
     stdin_flt = {'type': 'f4', 'dims': 'npts'}
-    stdin_dbl = {'type': 'f8', 'dims': 'npts'}
     stdin_int = {'type': 'i1', 'dims': 'npts'}
+    time_dbl = {'type': 'f8', 'dims': 'time'}
+    time_int = {'type': 'i4', 'dims': 'time'}
     var_defs = {
-        'mjd_start': dict({'units': 'days', 'long_name': 'Modified Julian Date (start of window)'}, **stdin_dbl),
-        'mjd_end': dict({'units': 'days', 'long_name': 'Modified Julian Date (end of window)'}, **stdin_dbl),
+        'mjd_start': dict({'units': 'days', 'long_name': 'Modified Julian Date (start of window)'}, **time_dbl),
+        'mjd_end': dict({'units': 'days', 'long_name': 'Modified Julian Date (end of window)'}, **time_dbl),
+        'vector_offset': dict({'units': 'None', 'long_name': 'Index of the first vector in each window'}, **time_int),
+        'vector_count': dict({'units': 'None', 'long_name': 'Number of vectors in each window'}, **time_int),
         'vector.glat': dict({'units': 'deg.', 'long_name': 'Geographic Latitude'}, **stdin_flt),
         'vector.glon': dict({'units': 'deg.', 'long_name': 'Geographic Longitude'}, **stdin_flt),
         'vector.g_kvect': dict({'units': 'deg.', 'long_name': 'Geographic Azimuth angle'}, **stdin_flt),
@@ -308,14 +453,17 @@ def fit_to_grid(fit_fname, grid_fname, convert_cmd,
     os.makedirs(out_dir, exist_ok=True)
 
     # Run the executable
-    # print(convert_cmd % (fit_fname, grid_fname))
-    os.system(convert_cmd % (fit_fname, grid_fname))
+    status = run_to_file(convert_cmd, fit_fname, grid_fname)
+    if status != 0:
+        print('make_grid failed (%i) on %s' % (status, fit_fname))
 
-    return 0
+    return status
 
 
 def load_grid(grid_nc_fn, time):
     grid_data = nc_utils.ncread_vars(grid_nc_fn)
+    if 'vector_offset' not in grid_data:
+        grid_data = windows_from_vectors(grid_data)
     atts = nc_utils.load_nc(grid_nc_fn)
     radar_loc = [atts.lat, atts.lon, atts.alt / 1E3]
     m_radar_loc = aacgmv2.convert_latlon_arr(
@@ -325,6 +473,62 @@ def load_grid(grid_nc_fn, time):
     return grid_data, radar_loc
 
 
+def load_grid_window(grid_nc_fn, stime, etime):
+    """
+    Read only the windows starting in [stime, etime) from a grid netCDF. The record
+    times are searched with a binary search and only the matching vectors are read
+    """
+    with netCDF4.Dataset(grid_nc_fn) as nc:
+        if 'time' in nc.dimensions:
+            grid_vars = nc.variables
+        else:
+            # Written before the per-window layout - the whole file is read into memory
+            grid_vars = windows_from_vectors({k: v[:] for k, v in nc.variables.items()})
+        mjd_start = grid_vars['mjd_start'][:]
+        t0, t1 = np.searchsorted(mjd_start, [
+            jdutil.jd_to_mjd(jdutil.datetime_to_jd(stime)),
+            jdutil.jd_to_mjd(jdutil.datetime_to_jd(etime)),
+        ])
+        return read_windows(grid_vars, t0, t1)
+
+
+def windows_from_vectors(grid_data):
+    """
+    Per-window TIME_VARS for grid data in the old layout, which stores mjd_start/mjd_end
+    on every vector. A window is a run of consecutive vectors with the same mjd_start
+    """
+    mjd_start = np.asarray(grid_data['mjd_start'])
+    if len(mjd_start) == 0:
+        offsets = np.array([], dtype=int)
+    else:
+        offsets = np.flatnonzero(np.r_[True, np.diff(mjd_start) != 0])
+
+    grid_data = dict(grid_data)
+    grid_data['mjd_start'] = mjd_start[offsets]
+    grid_data['mjd_end'] = np.asarray(grid_data['mjd_end'])[offsets]
+    grid_data['vector_offset'] = offsets
+    grid_data['vector_count'] = np.diff(np.r_[offsets, len(mjd_start)]).astype(int)
+    return grid_data
+
+
+def read_windows(grid_vars, t0, t1):
+    """ Slice windows t0:t1 (and their vectors) out of grid variables, in memory or on disk """
+    offsets = grid_vars['vector_offset'][t0:t1]
+    counts = grid_vars['vector_count'][t0:t1]
+    v0 = int(offsets[0]) if t1 > t0 else 0
+    v1 = int(offsets[-1] + counts[-1]) if t1 > t0 else 0
+
+    grid_data_t = {}
+    for k, v in grid_vars.items():
+        if k in TIME_VARS:
+            grid_data_t[k] = np.asarray(v[t0:t1])
+        else:
+            grid_data_t[k] = np.asarray(v[v0:v1])
+    grid_data_t['vector_offset'] -= v0
+
+    return grid_data_t
+
+
 def plot_grid_nc(grid_nc_fn, time, intvl_min=2):
     grid_data, radar_loc = load_grid(grid_nc_fn, time)
     grid_data_t = subsample_data(grid_data, time, intvl_min)
@@ -354,46 +558,30 @@ def plot_grid(grid_fn, time):
 
 
 def subsample_data(grid_data, time, intvl_min=2):
-    delta_ts = []
-    for t, mjd_s in enumerate(grid_data['mjd_start']):
-        mjd_e = grid_data['mjd_end'][t]
-        mjd = np.mean([mjd_s, mjd_e])
-        datet = jdutil.jd_to_datetime(jdutil.mjd_to_jd(mjd))
-        delta_ts.append((datet - time).total_seconds())
-    delta_ts = np.abs(np.array(delta_ts))
-    tidx = delta_ts < (intvl_min * 60 / 2)  # divide by 2 for plus/minus
-    grid_data_t = {}
-    for k, v in grid_data.items():
-        grid_data_t[k] = v[tidx]
+    """ Windows centred within intvl_min/2 minutes of time (binary search on the record times) """
+    mjd = jdutil.jd_to_mjd(jdutil.datetime_to_jd(time))
+    half_intvl = intvl_min / 60 / 24 / 2  # divide by 2 for plus/minus
+    mjd_mid = (grid_data['mjd_start'] + grid_data['mjd_end']) / 2
+    t0 = np.searchsorted(mjd_mid, mjd - half_intvl, side='right')
+    t1 = np.searchsorted(mjd_mid, mjd + half_intvl, side='left')
 
-    return grid_data_t
+    return read_windows(grid_data, t0, t1)
 
 
 if __name__ == '__main__':
-    stime = dt.datetime(2015, 3, 15)
-    etime = dt.datetime(2015, 3, 18)
-    fit_fn_fmt = '/project/superdarn/data/fitacf/%Y/%m/%Y%m%d.*.v3.0.fit'
-    grid_dirn = '/project/superdarn/data/grid/%Y/%m/'
-    out_dirn = '/project/superdarn/data/grid_nc/%Y/%m/'
-    hdw_dat_dir = '/project/superdarn/software/rst/tables/superdarn/hdw/'
-    clobber = True
-
-    time = stime
-    while time <= etime:
-        grid_dirn_t = time.strftime(grid_dirn)
-        out_dirn_t = time.strftime(out_dirn)
-        os.makedirs(grid_dirn_t, exist_ok=True)
-        os.makedirs(out_dirn_t, exist_ok=True)
-
-        flist = glob.glob(time.strftime(fit_fn_fmt))
-        for fit_fn in flist:
-            fn_head = '.'.join(os.path.basename(fit_fn).split('.')[:-1])
-            grid_fn = os.path.join(grid_dirn_t, fn_head + '.grid')
-            out_fn = os.path.join(out_dirn_t, fn_head + '.grid.nc')
-            convert_fit_to_grid_nc(time, fit_fn, grid_fn,
-                                   out_fn, hdw_dat_dir, clobber=clobber)
-
-        time += dt.timedelta(days=1)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('start_date', help='Specify the start date (YYYYMMDD)')
+    parser.add_argument('end_date', help='Specify the end date (YYYYMMDD)')
+    parser.add_argument('-n', '--num-workers', type=int, default=NUM_WORKERS)
+    parser.add_argument('-c', '--combine', action='store_true',
+                        help='Also combine each day into north/south hemisphere grids')
+    parser.add_argument('--clobber', action='store_true', help='Overwrite existing files')
+    args = parser.parse_args()
+
+    stime = dt.datetime.strptime(args.start_date, '%Y%m%d')
+    etime = dt.datetime.strptime(args.end_date, '%Y%m%d')
+
+    main(stime, etime, clobber=args.clobber, num_workers=args.num_workers, combine=args.combine)
 
     """ #one-off instance w. before/after plotting for sanity check 
     time = dt.datetime(2015, 3, 15, 1, 58)
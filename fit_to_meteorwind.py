@@ -4,14 +4,25 @@ fitacf_to_meteorwind.py
 Loop through all the days and radars, processing the bzipped fitACFs into meteor winds
 Use hardware.dat files to identify the beam configurations
 
+Radar-days run in a pool of worker processes. Each one makes its cfit once, in
+its own temporary directory, and runs the meridional and zonal meteorproc
+passes on it at the same time.
 """
 import datetime as dt
 import os
 import glob
+import shutil
+import subprocess
+import tempfile
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from sd_utils import get_random_string, get_radar_list, id_beam_north, id_hdw_params_t, get_radar_params
 import sys
 import helper
 
+NUM_WORKERS = os.cpu_count()
+MZ_FLAGS = ['m', 'z']  # meridional and zonal
+
 
 def main(
         starttime=dt.datetime(2016, 1, 1),
@@ -23,12 +34,14 @@ def main(
         cfit_exe='/project/superdarn/software/rst/bin/make_cfit',
         hdw_dat_dir='/project/superdarn/software/rst/tables/superdarn/hdw/',
         skip_existing=False,
+        num_workers=NUM_WORKERS,
 ):
+    # One task per radar-day
+    tasks = []
     time = starttime
     radar_list = get_radar_params(hdw_dat_dir)
     while time <= endtime:
         for radar_name, hdw_params in radar_list.items():
-            print(radar_name)
             # get hardware parameters
             hdw_params = id_hdw_params_t(time, hdw_params)
 
@@ -51,57 +64,115 @@ def main(
                       (fit_fname, fn_info.st_size / 1E6))
                 continue
 
-            hdw_dat_fname = glob.glob(os.path.join(
-                hdw_dat_dir, '*%s*' % radar_name))[0]
-
-            # loop over meridional and zonal
-            for mz_flag in ['m', 'z']:
-                print(mz_flag)
-
-                radar_name_with_mode = '.'.join(
-                    os.path.basename(fit_fname).split('.')[1:-3])
-
-                # specify output filename
+            # specify output filenames, meridional and zonal
+            radar_name_with_mode = '.'.join(
+                os.path.basename(fit_fname).split('.')[1:-3])
+            wind_fnames = {}
+            for mz_flag in MZ_FLAGS:
                 wind_fname = time.strftime(
                     wind_fname_fmt) + '.%s.%s.txt' % (radar_name_with_mode, mz_flag)
-
                 if (os.path.isfile(wind_fname) & skip_existing):
-                    print('wind file already exists')
+                    print('wind file already exists: %s' % wind_fname)
                     continue
+                wind_fnames[mz_flag] = wind_fname
+            if len(wind_fnames) == 0:
+                continue
 
-                beam_num = 1  # id_beam_north(hdw_params)
-                # find_middle_beam
-                # beam_num = int(hdw_params['maxbeams'] / 2)
+            beam_num = 1  # id_beam_north(hdw_params)
+            # find_middle_beam
+            # beam_num = int(hdw_params['maxbeams'] / 2)
 
-                # skip radars with no good beam
-                # if np.isnan(beam_num):
-                #    print('No valid beam')
-                #    continue
+            # skip radars with no good beam
+            # if np.isnan(beam_num):
+            #    print('No valid beam')
+            #    continue
 
-                # Convert file to a wind
-                fit_to_wind(
-                    time, fit_fname, beam_num, wind_fname, meteorproc_exe,
-                    cfit_exe, mz_flag,
-                )
+            tasks.append((time, fit_fname, beam_num, wind_fnames))
 
         time += dt.timedelta(days=1)
 
+    # Convert files to winds
+    print('Processing %i radar-days with %i workers' % (len(tasks), num_workers))
+    failed = []
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = {}
+        for time, fit_fname, beam_num, wind_fnames in tasks:
+            future = executor.submit(
+                fit_to_winds, time, fit_fname, beam_num, wind_fnames,
+                meteorproc_exe, cfit_exe, run_dir,
+            )
+            futures[future] = fit_fname
+        for future in as_completed(futures):
+            try:
+                status = future.result()
+            except Exception as e:
+                print('Error processing %s: %s' % (futures[future], e))
+                status = 1
+            if status != 0:
+                failed.append(futures[future])
+
+    print('Finished meteor winds: %i of %i radar-days failed' % (len(failed), len(tasks)))
+    return failed
+
+
+def fit_to_winds(
+        day, fit_fname, beam_num, wind_fnames, meteorproc_exe, cfit_exe,
+        run_dir='./run_mw/',
+):
+    """
+    Make one cfit from fit_fname in a private temporary directory, then run meteorproc
+    on it for every {mz_flag: wind_fname} at once. Returns 0 if all succeeded
+    """
+    os.makedirs(run_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix='cfit_', dir=run_dir)
+    try:
+        cfit_fname = os.path.join(tmp_dir, os.path.basename(fit_fname) + '.cfit')
+        status = make_cfit(fit_fname, cfit_fname, cfit_exe)
+        if status != 0:
+            print('make_cfit failed on %s' % fit_fname)
+            return status
+
+        # meteorproc only reads the cfit, so the m and z passes can share it
+        procs = {}
+        for mz_flag, wind_fname in wind_fnames.items():
+            os.makedirs(os.path.dirname(wind_fname), exist_ok=True)
+            tmp_wind_fname = '%s.%s.tmp' % (wind_fname, get_random_string(8))
+            cmd = '%s -mz %s %s > %s' % \
+                (meteorproc_exe, mz_flag, cfit_fname, tmp_wind_fname)
+            print(cmd)
+            procs[mz_flag] = (subprocess.Popen(cmd, shell=True), tmp_wind_fname)
+
+        for mz_flag, (proc, tmp_wind_fname) in procs.items():
+            if proc.wait() == 0:
+                os.replace(tmp_wind_fname, wind_fnames[mz_flag])
+                print('written to %s' % wind_fnames[mz_flag])
+            else:
+                print('meteorproc -mz %s failed on %s' % (mz_flag, fit_fname))
+                status = proc.returncode
+                if os.path.isfile(tmp_wind_fname):
+                    os.remove(tmp_wind_fname)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return status
+
+
+def make_cfit(fit_fname, cfit_fname, cfit_exe):
+    # Convert fit to cfit
+    return subprocess.run('%s %s > %s' % (cfit_exe, fit_fname, cfit_fname), shell=True).returncode
+
 
 def fit_to_wind(
         day, fit_fname, beam_num, wind_fname, meteorproc_exe, cfit_exe,
-        mz_flag='m', cfit_fname='tmp.cfit',
+        mz_flag='m', cfit_fname=None, run_dir='./run_mw/',
 ):
-
-    # Convert fit to cfit
-    os.system('%s %s > %s' % (cfit_exe, fit_fname, cfit_fname))
-
-    # Convert cfit to  wind
-    os.makedirs(os.path.dirname(wind_fname), exist_ok=True)
-    cmd = '%s -mz %s %s > %s' % \
-        (meteorproc_exe, mz_flag, cfit_fname, wind_fname)
-    print(cmd)
-    os.system(cmd)
-    print('written to %s' % wind_fname)
+    # Single meteorproc pass - use fit_to_winds to do m and z from one cfit
+    if cfit_fname is not None:
+        warnings.warn('fit_to_wind(cfit_fname=...) is deprecated and ignored - the cfit is '
+                      'made in a temporary directory under run_dir', DeprecationWarning, stacklevel=2)
+    return fit_to_winds(
+        day, fit_fname, beam_num, {mz_flag: wind_fname}, meteorproc_exe, cfit_exe, run_dir,
+    )
 
 
 def get_radar_list(in_dir):
@@ -35,6 +35,7 @@ import numpy as np
 from sd_utils import get_radar_params, id_hdw_params_t, get_random_string, get_radar_list
 import pydarn
 import radFov
+import scan
 import pickle
 import helper
 
@@ -46,7 +47,7 @@ FIT_EXT = '*.fitacf3'
 SKIP_EXISTING = True
 
 
-def main(startTime, endTime, fitDir, netDir, fitVersion):
+def main(startTime, endTime, fitDir, netDir, fitVersion, merge=False):
 
     rstpath = os.getenv('RSTPATH')
     assert rstpath, 'RSTPATH environment variable needs to be set'
@@ -120,6 +121,12 @@ def main(startTime, endTime, fitDir, netDir, fitVersion):
                 file=multiBeamFile)
             helper.send_email(subject, body)
 
+        # Optionally merge each day's radars into hemispheric files
+        if merge:
+            import merge_fit_nc  # imported here as merge_fit_nc imports this module for def_vars()
+            monthEnd = min(time + relativedelta(months=1) - dt.timedelta(days=1), endTime)
+            merge_fit_nc.main(time, monthEnd, in_dir_fmt=netDir, fit_version=fitVersion)
+
         time += relativedelta(months=1)
 
 
@@ -133,6 +140,7 @@ def fit_to_nc(date, in_fname, out_fname, radar_info, fitVersion):
     var_defs = def_vars()
     dim_defs = {
         'npts': out_vars['mjd'].shape[0],
+        'nscans': out_vars['scan_time'].shape[0],
     }
     header_info = def_header_info(in_fname, hdr_vals)
 
@@ -217,7 +225,7 @@ def convert_fitacf_data(date, in_fname, radar_info, fitVersion):
 
                 return MULTIPLE_BEAM_DEFS_ERROR_CODE, MULTIPLE_BEAM_DEFS_ERROR_CODE
 
-            bmdata[k] = int(val)
+            bmdata[k] = int(val[0])
 
         # Define FOV
         fov = radFov.fov(
@@ -247,10 +255,16 @@ def convert_fitacf_data(date, in_fname, radar_info, fitVersion):
         for fld in (fov_flds + data_flds + short_flds):
             out[fld] = []
 
+        # Number the scans from the scan flags of all records, including those skipped below
+        rec_scan = scan.scan_index([rec.get('scan', 0) for rec in data])
+        rec_npts = np.zeros(len(data), dtype=int)
+        rec_mjd = np.zeros(len(data))
+
         # Run through each beam record and store
-        for rec in data:
+        for ind, rec in enumerate(data):
             time = dt.datetime(rec['time.yr'], rec['time.mo'], rec['time.dy'],
                                rec['time.hr'], rec['time.mt'], rec['time.sc'])
+            rec_mjd[ind] = jdutil.jd_to_mjd(jdutil.datetime_to_jd(time))
             # slist is the list of range gates with backscatter
             if 'slist' not in rec.keys():
                 os.makedirs(conversionLogDir, exist_ok=True)
@@ -276,7 +290,8 @@ def convert_fitacf_data(date, in_fname, radar_info, fitVersion):
             time = dt.datetime(rec['time.yr'], rec['time.mo'], rec['time.dy'],
                                rec['time.hr'], rec['time.mt'], rec['time.sc'])
             one_obj = np.ones(len(rec['slist']))
-            mjd = jdutil.jd_to_mjd(jdutil.datetime_to_jd(time))
+            mjd = rec_mjd[ind]
+            rec_npts[ind] = len(rec['slist'])
             bmnum = one_obj * rec['bmnum']
             fovi = fov.beams == rec['bmnum']
             out['mjd'] += (one_obj * mjd).tolist()
@@ -294,6 +309,11 @@ def convert_fitacf_data(date, in_fname, radar_info, fitVersion):
         for k, v in out.items():
             out[k] = np.array(v)
 
+        # Scan k is npts scan_start_index[k]:scan_start_index[k + 1]
+        scan_start_index, scan_first_rec = scan.scan_start_indices(rec_scan, rec_npts)
+        out['scan_start_index'] = scan_start_index
+        out['scan_time'] = rec_mjd[scan_first_rec]
+
         # Calculate beam azimuths assuming 15 degrees elevation
         beam_off = radar_info['beamsep'] * \
             (fov.beams - (radar_info['maxbeams'] - 1) / 2.0)
@@ -358,6 +378,10 @@ def def_vars():
         'tfreq': dict({'units': 'kHz', 'long_name': 'Transmit freq'}, **stdin_int2),
         'noise.sky': dict({'units': 'none', 'long_name': 'Sky noise'}, **stdin_flt),
         'cp': dict({'units': 'none', 'long_name': 'Control program ID'}, **stdin_int2),
+        'scan_start_index': {'units': 'none', 'long_name': 'Index (npts) of the first return of each scan',
+                             'type': 'u4', 'dims': 'nscans'},
+        'scan_time': {'units': 'days', 'long_name': 'Modified Julian Date of the start of each scan',
+                      'type': 'f8', 'dims': 'nscans'},
     }
 
     return var_defs
@@ -480,17 +504,18 @@ if __name__ == '__main__':
 
     args = sys.argv
 
-    assert len(args) >= 6, 'Should have 5x args, e.g.:\n' + \
+    assert len(args) >= 6, 'Should have 5x args (plus optional merge), e.g.:\n' + \
         'python3 fit_to_nc.py 2014,4,23 2014,4,24 ' + \
         '/project/superdarn/data/fitacf/%Y/%m/  ' + \
-        '/project/superdarn/data/netcdf/%Y/%m/ 2.5'
+        '/project/superdarn/data/netcdf/%Y/%m/ 2.5 [merge]'
 
     stime = dt.datetime.strptime(args[1], '%Y,%m,%d')
     etime = dt.datetime.strptime(args[2], '%Y,%m,%d')
-    if len(args) == 6:
+    if len(args) >= 6:
         fit_dir = args[3]
         outDir = args[4]
         fitVersion = args[5]
+    merge = len(args) == 7 and args[6] == 'merge'
     runDir = './run/run_%s' % get_random_string(4)
 
-    main(stime, etime, fit_dir, outDir, fitVersion)
+    main(stime, etime, fit_dir, outDir, fitVersion, merge=merge)
@@ -21,6 +21,7 @@ import sys
 import os
 import time
 import helper
+import product_catalog
 import glob
 import json
 
@@ -51,6 +52,16 @@ def main():
     getBasFileList()
     radarList = helper.get_radar_list()
 
+    # Index the APL netCDFs once rather than globbing every day/radar
+    global aplRadarDays
+    catalog = product_catalog.open_catalog()
+    product_catalog.update_catalog(
+        catalog, BAS_START_DATE, BAS_END_DATE, ['fit_nc'])
+    aplRadarDays = {(day, radar.split('.')[0]) for day, radar in
+                    product_catalog.get_radar_days(catalog, 'fit_nc', BAS_START_DATE, BAS_END_DATE)
+                    if radar}
+    catalog.close()
+
     # TODO: Add DAT file check
 
     date = BAS_START_DATE
@@ -114,11 +125,7 @@ def bas_data(date, radar):
 
 
 def apl_data(date, radar):
-    day = date.strftime('%Y%m%d')
-    netDir = date.strftime(helper.NETCDF_DIR_FMT)
-    numAPLFiles = len(
-        glob.glob('{dir}*{d}**{r}*'.format(dir=netDir, d=day, r=radar)))
-    return numAPLFiles > 0
+    return (date.strftime('%Y-%m-%d'), radar) in aplRadarDays
 
 
 def getBasFileList():
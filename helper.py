@@ -19,10 +19,15 @@ GLOBUS_DAT_DIR_FMT = '/chroot/sddata/dat/%Y/%m/'
 RAWACF_DIR_FMT = '/project/superdarn/data/rawacf/%Y/%m'
 FITACF_DIR_FMT = '/project/superdarn/data/fitacf/%Y/%m'
 FIT_NC_DIR_FMT = '/project/superdarn/data/netcdf/%Y/%m'
+FIT_NC_MERGED_DIR_FMT = '/project/superdarn/data/netcdf_merged/%Y/%m'
 METEORWIND_DIR_FMT = '/project/superdarn/data/meteorwind/%Y/%m'
 METEORWIND_NC_DIR_FMT = '/project/superdarn/data/meteorwindnc/%Y/%m'
+METEORWIND_NATIVE_NC_DIR_FMT = '/project/superdarn/data/meteorwindnc_native/%Y/%m'
 GRID_DIR_FMT = '/project/superdarn/data/grid/%Y/%m'
 GRID_NC_DIR_FMT = '/project/superdarn/data/grid_nc/%Y/%m'
+GRID_NC_NATIVE_DIR_FMT = '/project/superdarn/data/grid_nc_native/%Y/%m'
+MAP_DIR_FMT = '/project/superdarn/data/map/%Y/%m'
+MAP_NC_DIR_FMT = '/project/superdarn/data/map_nc/%Y/%m'
 LOG_DIR = '/project/superdarn/logs'
 PROCESSING_ISSUE_DIR = '/project/superdarn/processing_issues/%Y/%m'
 FIT_NET_LOG_DIR = '/project/superdarn/logs/fitACF_to_netCDF_logs/%Y'
@@ -30,7 +35,11 @@ GLOBUS_PATH = '/homes/superdarn/globusconnectpersonal-3.2.2/globusconnectpersona
 BAS_FILE_LIST_DIR = '/project/superdarn/data/data_status/BAS_files'
 GLOBUS_FILE_LIST_DIR = '/project/superdarn/data/data_status/Globus_files'
 ZENODO_FILE_LIST_DIR = '/project/superdarn/data/data_status/Zenodo_files'
+ZENODO_MANIFEST_DIR = '/project/superdarn/data/data_status/Zenodo_manifests'
 DATA_STATUS_DIR = '/project/superdarn/data/data_status'
+CATALOG_DB = '/project/superdarn/data/data_status/product_catalog.db'
+NC_AUDIT_DB = '/project/superdarn/data/data_status/nc_audit.db'
+MIGRATION_CHECKPOINT_DIR = '/project/superdarn/data/data_status/migrations'
 HDW_DAT_DIR = '/project/superdarn/software/rst/tables/superdarn/hdw'
 
 MIN_FITACF_FILE_SIZE = 1E5
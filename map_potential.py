@@ -0,0 +1,165 @@
+"""
+map_potential.py
+
+Evaluate SuperDARN convection map potentials and ExB drifts from the fit
+coefficients stored by map_to_nc.py, for many map records at once
+
+The RST fit is
+    Phi(theta, phi) = sum_lm P_l^m(cos(alpha theta)) (a_lm cos(m phi) + b_lm sin(m phi))
+where theta is magnetic colatitude, phi = MLT * 15 deg. (zero at midnight) and
+alpha = pi / theta_max rescales the colatitude of the fit's lower latitude
+boundary (latMin) to pi. Coefficients are stored in the RST order given by
+index_legendre(); map_to_nc.py also stores the (l, m) of each column as fitL/fitM.
+
+Every record with the same (fitOrder, latMin) shares a basis matrix of
+Legendre/Fourier terms on the lat/MLT grid, so the potentials of all records
+in a day are one matrix product per group. Basis tables are cached between calls.
+
+    times, lats, mlts, pot, v_theta, v_phi = potential_grid('20140524.north.map.nc')
+"""
+from functools import lru_cache
+import datetime as dt
+import numpy as np
+import nc_utils
+
+RE = 6371.  # km
+ALTITUDE = 300.  # km, altitude of the convection pattern
+B_POLAR = -0.62E-4  # T, RST dipole field at the pole
+D_THETA = 1E-5  # rad., step for the colatitude derivative
+DEFAULT_LAT_MIN = 60.  # deg., grid boundary when no record in the file has a fit
+
+
+def potential_grid(map_nc_fn, lat_step=1., mlt_step=0.1, lat_min=None):
+    """
+    Potential (V) and ExB drift (m/s) for every record of a map netCDF on a regular lat/MLT grid.
+    Returns times, lats, mlts and arrays shaped (time, lat, mlt), all NaN if no record has a fit
+    """
+    data = nc_utils.ncread_vars(map_nc_fn)
+    hemisphere = -1 if np.all(data['hemisphere'] < 0) else 1
+    if lat_min is None:
+        fit_lat_mins = np.abs(data['latMin'][data['fitOrder'] > 0])
+        lat_min = np.min(fit_lat_mins) if len(fit_lat_mins) > 0 else DEFAULT_LAT_MIN
+
+    lats = np.arange(90., np.abs(lat_min), -lat_step) * hemisphere
+    mlts = np.arange(0., 24., mlt_step)
+    lat_grid, mlt_grid = np.meshgrid(lats, mlts, indexing='ij')
+
+    pot, v_theta, v_phi = eval_records(data, lat_grid.ravel(), mlt_grid.ravel())
+    shape = (len(data['times']), len(lats), len(mlts))
+    times = np.array([dt.datetime.fromtimestamp(t) for t in data['times']])
+
+    return times, lats, mlts, pot.reshape(shape), v_theta.reshape(shape), v_phi.reshape(shape)
+
+
+def eval_records(data, lats, mlts):
+    """
+    Potential and ExB drift of every map record at the same points (magnetic lat., MLT).
+    Returns three arrays shaped (record, point); NaN outside each record's latMin
+    or where a record has no fit
+    """
+    nrec = len(data['fitOrder'])
+    pot = np.full((nrec, len(lats)), np.nan)
+    v_theta = np.full((nrec, len(lats)), np.nan)
+    v_phi = np.full((nrec, len(lats)), np.nan)
+
+    # Records without a fit are skipped, and shifted-pole fits are not supported
+    fitted = (data['fitOrder'] > 0) & np.isfinite(data['fitCoeffs'][:, 0]) & (data['latShift'] == 0)
+
+    keys = np.stack([data['fitOrder'], np.abs(data['latMin']), np.sign(data['hemisphere'])], axis=1)
+    for key in np.unique(keys[fitted], axis=0):
+        order, lat_min, hemi = int(key[0]), float(key[1]), -1 if key[2] < 0 else 1
+        recs = fitted & np.all(keys == key, axis=1)
+        nk = (order + 1) ** 2
+        coeffs = np.nan_to_num(data['fitCoeffs'][recs, :nk])
+
+        basis, basis_dtheta, basis_dphi = get_basis(order, lat_min, tuple(lats), tuple(mlts))
+        pot[recs] = coeffs @ basis
+        e_theta, e_phi = electric_field(coeffs @ basis_dtheta, coeffs @ basis_dphi, lats)
+        v_theta[recs], v_phi[recs] = exb_drift(e_theta, e_phi, lats, hemi)
+
+    return pot, v_theta, v_phi
+
+
+@lru_cache(maxsize=32)
+def get_basis(order, lat_min, lats, mlts):
+    """
+    Basis matrices (coefficient, point) of the potential and its colatitude and
+    MLT-angle derivatives. Points outside the fit boundary are NaN
+    """
+    lats = np.array(lats)
+    phi = np.deg2rad(np.array(mlts) * 15.)
+    theta = np.deg2rad(90. - np.abs(lats))
+    theta_max = np.deg2rad(90. - np.abs(lat_min))
+    alpha = np.pi / theta_max
+
+    basis = legendre_fourier(order, alpha, theta, phi)
+    basis_dtheta = (legendre_fourier(order, alpha, theta + D_THETA, phi) -
+                    legendre_fourier(order, alpha, theta - D_THETA, phi)) / (2 * D_THETA)
+    basis_dphi = legendre_fourier(order, alpha, theta, phi, dphi=True)
+
+    outside = theta > theta_max
+    for b in basis, basis_dtheta, basis_dphi:
+        b[:, outside] = np.nan
+    return basis, basis_dtheta, basis_dphi
+
+
+def legendre_fourier(order, alpha, theta, phi, dphi=False):
+    """ P_l^m(cos(alpha theta)) times cos(m phi)/sin(m phi) (or their phi derivatives), in RST order """
+    plm = legendre_table(order, np.cos(alpha * theta))
+    terms = np.zeros(((order + 1) ** 2, len(theta)))
+    for m in range(order + 1):
+        cos_m = -m * np.sin(m * phi) if dphi else np.cos(m * phi)
+        sin_m = m * np.cos(m * phi) if dphi else np.sin(m * phi)
+        for l in range(m, order + 1):
+            k = index_legendre(l, m)
+            if m == 0:
+                terms[k] = plm[l, 0] * (0. if dphi else 1.)
+            else:
+                terms[k] = plm[l, m] * cos_m
+                terms[k + 1] = plm[l, m] * sin_m
+    return terms
+
+
+def legendre_table(order, x):
+    """ Associated Legendre functions P_l^m(x) (with the Condon-Shortley phase) as [l, m, point] """
+    x = np.clip(x, -1., 1.)
+    somx2 = np.sqrt(1. - x ** 2)
+    plm = np.zeros((order + 1, order + 1, len(x)))
+    pmm = np.ones(len(x))
+    for m in range(order + 1):
+        plm[m, m] = pmm
+        if m < order:
+            plm[m + 1, m] = x * (2 * m + 1) * pmm
+        for l in range(m + 2, order + 1):
+            plm[l, m] = ((2 * l - 1) * x * plm[l - 1, m] - (l + m - 1) * plm[l - 2, m]) / (l - m)
+        pmm = -pmm * (2 * m + 1) * somx2
+    return plm
+
+
+def index_legendre(l, m):
+    """ Index of the (l, m) coefficient in the RST coefficient array (m > 0 has cos then sin) """
+    if m == 0:
+        return l ** 2
+    return l ** 2 + 2 * m - 1
+
+
+def electric_field(dpot_dtheta, dpot_dphi, lats):
+    """ E = -grad(Phi) on a sphere at ALTITUDE, as (theta, phi) components in V/m """
+    radius = (RE + ALTITUDE) * 1E3
+    theta = np.deg2rad(90. - np.abs(lats))
+    e_theta = -dpot_dtheta / radius
+    with np.errstate(divide='ignore', invalid='ignore'):
+        e_phi = -dpot_dphi / (radius * np.sin(theta))
+    return e_theta, e_phi
+
+
+def exb_drift(e_theta, e_phi, lats, hemisphere=1):
+    """
+    ExB drift (m/s) for RST's dipole field magnitude at ALTITUDE. Returns the component
+    along increasing colatitude (equatorward) and along increasing MLT (eastward)
+    """
+    theta = np.deg2rad(90. - np.abs(lats))
+    bmag = B_POLAR * (1. - 3. * ALTITUDE / RE) * np.sqrt(3. * np.cos(theta) ** 2 + 1.) / 2.
+    if hemisphere < 0:
+        bmag = -bmag
+    return e_phi / bmag, -e_theta / bmag
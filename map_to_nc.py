@@ -11,13 +11,18 @@ Terms:
 """
 # !/usr/bin/env python
 import os
-import sys
+import glob
+import argparse
 import numpy as np
-import nvector as nv
 import pydarn
 import datetime as dt
 import aacgmv2
 import netCDF4
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import helper
+import map_potential
+import sd_utils
+from sd_utils import get_random_string
 
 __author__ = "Jordan Wiker"
 __copyright__ = "Copyright 2021, JHUAPL"
@@ -26,6 +31,16 @@ __maintainer__ = "Jordan Wiker"
 __email__ = "jordan.wiker@jhuapl.edu"
 __status__ = "Development"
 
+NUM_WORKERS = os.cpu_count()
+# Variables on the time dimension (one value per map record), and their types
+RECORD_VARS = {'vectorOffset': 'i4', 'vectorCount': 'i4', 'fitOrder': 'i4', 'hemisphere': 'i4',
+               'latMin': 'f4', 'latShift': 'f4', 'lonShift': 'f4', 'potDrop': 'f4'}
+# Variables on the coefficient dimension (one value per fitCoeffs column)
+COEFF_VARS = ['fitL', 'fitM']
+# Spherical harmonic fit fields for each record, from read_map()
+FIT_VARS = {'fitOrder': 'fit.order', 'hemisphere': 'hemisphere', 'latMin': 'latmin',
+            'latShift': 'lat.shft', 'lonShift': 'lon.shft', 'potDrop': 'pot.drop'}
+
 
 def main(
     in_filename='/project/superdarn/data/map/2014/05/20140524.map',
@@ -35,83 +50,152 @@ def main(
     data = get_data(in_filename, AtoGHeight)
     attributes = get_attributes()
     save_data(data, attributes, AtoGHeight, in_filename, out_filename)
+    return 0
+
+
+def convert_maps(startDate, endDate, mapDirFmt=helper.MAP_DIR_FMT, outDirFmt=helper.MAP_NC_DIR_FMT,
+                 AtoGHeight=300, numWorkers=NUM_WORKERS, clobber=False):
+    """ Convert every .map file between two dates in parallel, one file per worker task """
+    jobs = []
+    day = startDate
+    while day <= endDate:
+        outDir = day.strftime(outDirFmt)
+        for in_filename in sorted(glob.glob(os.path.join(day.strftime(mapDirFmt), day.strftime('%Y%m%d*.map')))):
+            out_filename = os.path.join(outDir, os.path.basename(in_filename) + '.nc')
+            if os.path.isfile(out_filename) and not clobber:
+                print('%s exists - skipping' % out_filename)
+                continue
+            os.makedirs(outDir, exist_ok=True)
+            jobs.append((in_filename, out_filename))
+        day += dt.timedelta(days=1)
+
+    print('Converting %i map files with %i workers' % (len(jobs), numWorkers))
+    failed = []
+    with ProcessPoolExecutor(max_workers=numWorkers) as executor:
+        futures = {executor.submit(main, in_filename, out_filename, AtoGHeight): in_filename
+                   for in_filename, out_filename in jobs}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print('Failed to convert %s: %s' % (futures[future], e))
+                failed.append(futures[future])
+
+    print('Converted %i of %i map files' % (len(jobs) - len(failed), len(jobs)))
+    return failed
 
 
 def save_data(data, attributes, AtoGHeight, in_filename, out_filename):
     print('Saving data to %s' % out_filename)
-    with netCDF4.Dataset(out_filename, 'w') as nc:
-        set_header(nc, AtoGHeight, in_filename)
-
-        nc.createDimension('numPoints', len(data['times']))
+    # Write to a temporary file so an interrupted run never leaves a partial netCDF
+    tmp_filename = '%s.%s.tmp' % (out_filename, get_random_string(8))
+    with netCDF4.Dataset(tmp_filename, 'w') as nc:
+        set_header(nc, in_filename, AtoGHeight)
+
+        nc.createDimension('time', len(data['times']))
+        nc.createDimension('numPoints', len(data['mLat']))
+        nc.createDimension('numCoeffs', data['fitCoeffs'].shape[1])
         for k, v in data.items():
             var_attributes = attributes[k]
             if k == 'times':
                 # NOTE(ATC) F4 doesn't have 1-sec precision for 1970 timestamps, need to use i4
-                var = nc.createVariable(k, 'i4', 'numPoints')
+                var = nc.createVariable(k, 'i4', 'time')
+            elif k in RECORD_VARS:
+                var = nc.createVariable(k, RECORD_VARS[k], 'time')
+            elif k == 'fitCoeffs':
+                var = nc.createVariable(k, 'f8', ('time', 'numCoeffs'))
+            elif k in COEFF_VARS:
+                var = nc.createVariable(k, 'i4', 'numCoeffs')
             else:
                 var = nc.createVariable(k, 'f4', 'numPoints')
             var[:] = v
             var.units = var_attributes['units']
             var.long_name = var_attributes['long_name']
 
+    os.replace(tmp_filename, out_filename)
+
 
 def get_data(in_filename, AtoGHeight):
     print('Processing %s' % in_filename)
     map_data = pydarn.SuperDARNRead(in_filename).read_map()
-    latMagVector = []
-    lonMagVector = []
-    azimuthMagVector = []
-
-    latGeoVector = []
-    lonGeoVector = []
-    azimuthGeoVector = []
 
-    velocityVector = []
-    sdVector = []
+    # Each record's vectors are gathered and converted in a few calls for the whole file.
+    # Times are stored once per record, with vectorOffset/vectorCount giving its vectors
+    vectorVars = {'mLat': 'vector.mlat', 'mLon': 'vector.mlon', 'mAz': 'vector.kvect',
+                  'vel': 'vector.vel.median', 'sd': 'vector.vel.sd'}
+    vectors = {k: [] for k in vectorVars}
     timeVector = []
+    countVector = []
+    fileTime = None
+
+    # The potential fit: one set of coefficients (RST 'N+2', Legendre index order) per record
+    fitVars = {k: [] for k in FIT_VARS}
+    coeffVector = []
 
     for entry in map_data:
-        numPoints = len(entry['vector.vel.median'])
         t = dt.datetime(
             int(entry['start.year']), int(
                 entry['start.month']), int(entry['start.day']),
             int(entry['start.hour']), int(
                 entry['start.minute']), int(entry['start.second']),
         )
+        if fileTime is None:
+            fileTime = t
         # Convert time to seconds since 1970-01-01 00:00
-        times = [t.timestamp()] * numPoints
-        timeVector.append(times)
-        azM = entry['vector.kvect']
-
-        velocityVector.append(entry['vector.vel.median'])
-        sdVector.append(entry['vector.vel.sd'])
-        latMagVector.append(entry['vector.mlat'])
-        lonMagVector.append(entry['vector.mlon'])
-        azimuthMagVector.append(azM)
-
-        latG, lonG, heightG = aacgmv2.convert_latlon_arr(
-            entry['vector.mlat'], entry['vector.mlon'], AtoGHeight, t, method_code='A2G',
-        )
-        latGeoVector.append(latG)
-        lonGeoVector.append(lonG)
+        timeVector.append(t.timestamp())
 
-        azG = convert_azm_aacgm2geo(azM, latG, lonG, t, refAlt=AtoGHeight)
-        azimuthGeoVector.append(azG)
+        numPoints = len(entry['vector.vel.median']) if 'vector.vel.median' in entry else 0
+        countVector.append(numPoints)
+        if numPoints > 0:
+            for k, mapVar in vectorVars.items():
+                vectors[k].append(entry[mapVar])
+
+        for k, mapVar in FIT_VARS.items():
+            fitVars[k].append(entry.get(mapVar, 0))
+        coeffVector.append(np.atleast_1d(entry.get('N+2', [])))
 
     data = {}
-    data['times'] = np.array(np.concatenate(timeVector))
-    data['mLat'] = np.array(np.concatenate(latMagVector))
-    data['mLon'] = np.array(np.concatenate(lonMagVector))
-    data['mAz'] = np.array(np.concatenate(azimuthMagVector))
-    data['gAz'] = np.array(np.concatenate(azimuthGeoVector))
-    data['gLat'] = np.array(np.concatenate(latGeoVector))
-    data['gLon'] = np.array(np.concatenate(lonGeoVector))
-    data['vel'] = np.array(np.concatenate(velocityVector))
-    data['sd'] = np.array(np.concatenate(sdVector))
+    data['times'] = np.array(timeVector)
+    data['vectorCount'] = np.array(countVector)
+    data['vectorOffset'] = np.cumsum(countVector) - data['vectorCount']
+    for k, v in vectors.items():
+        data[k] = np.concatenate(v) if v else np.array([])
+
+    for k, v in fitVars.items():
+        data[k] = np.array(v)
+    # Records without a fit (or with a lower order) are padded with NaNs
+    data['fitCoeffs'] = np.full((len(coeffVector), max(1, max(len(c) for c in coeffVector))), np.nan)
+    for ind, coeffs in enumerate(coeffVector):
+        data['fitCoeffs'][ind, :len(coeffs)] = coeffs
+    data['fitL'], data['fitM'] = legendre_indices(data['fitCoeffs'].shape[1])
+
+    # The vectors sit on a fixed grid, so convert each cell once for the whole file
+    data['gLat'], data['gLon'] = sd_utils.convert_latlon_cached(
+        data['mLat'], data['mLon'], AtoGHeight, fileTime, method_code='A2G')
+    # One batch bearing calculation for the whole file, using the pole at the first record
+    data['gAz'] = convert_azm_aacgm2geo(
+        data['mAz'], data['gLat'], data['gLon'], fileTime, refAlt=AtoGHeight)
 
     return data
 
 
+def legendre_indices(numCoeffs):
+    # Degree l and order m of each fitCoeffs column, in RST order. m < 0 marks the sin(m phi) term
+    fitL = np.zeros(numCoeffs, dtype=int)
+    fitM = np.zeros(numCoeffs, dtype=int)
+    l = 0
+    while l ** 2 < numCoeffs:
+        for m in range(l + 1):
+            k = map_potential.index_legendre(l, m)
+            terms = [(k, m)] if m == 0 else [(k, m), (k + 1, -m)]
+            for ind, signedM in terms:
+                if ind < numCoeffs:
+                    fitL[ind], fitM[ind] = l, signedM
+        l += 1
+
+    return fitL, fitM
+
+
 def set_header(ncObject, in_fname, conversionAltitude):
 
     ncObject.description = 'Hemispherical gridded velocity vectors'
@@ -127,6 +211,17 @@ def get_attributes():
 
     attributes = {
         'times': dict({'units': 'seconds since 1970-01-01 00:00 UTC', 'long_name': 'Epoch Time'}),
+        'vectorOffset': dict({'units': 'None', 'long_name': 'Index of the first vector in each record'}),
+        'vectorCount': dict({'units': 'None', 'long_name': 'Number of vectors in each record'}),
+        'fitOrder': dict({'units': 'None', 'long_name': 'Order of the spherical harmonic potential fit'}),
+        'hemisphere': dict({'units': 'None', 'long_name': 'Hemisphere (1 north, -1 south)'}),
+        'latMin': dict({'units': 'degrees', 'long_name': 'Lower magnetic latitude boundary of the fit'}),
+        'latShift': dict({'units': 'degrees', 'long_name': 'Latitude shift of the fit pole'}),
+        'lonShift': dict({'units': 'degrees', 'long_name': 'Longitude shift of the fit pole'}),
+        'potDrop': dict({'units': 'V', 'long_name': 'Cross polar cap potential drop'}),
+        'fitCoeffs': dict({'units': 'V', 'long_name': 'Spherical harmonic potential coefficients (see map_potential.py)'}),
+        'fitL': dict({'units': 'None', 'long_name': 'Legendre degree l of each fit coefficient'}),
+        'fitM': dict({'units': 'None', 'long_name': 'Legendre order m of each fit coefficient (negative for the sin(m phi) term)'}),
         'mLat': dict({'units': 'degrees', 'long_name': 'Magnetic Latitude'}),
         'mLon': dict({'units': 'degrees', 'long_name': 'Magnetic Longitude'}),
         'mAz': dict({'units': 'degrees', 'long_name': 'Magnetic Azimuth'}),
@@ -142,24 +237,11 @@ def get_attributes():
 def convert_azm_aacgm2geo(azM, latG, lonG, dTime, refAlt=300):
     # Convert azimuths from AACGM to geodetic
 
-    refZ = -refAlt * 1E3  # nvector uses z = height in metres down
-    wgs84 = nv.FrameE(name='WGS84')
     nPole = aacgmv2.convert_latlon(90, 0, refAlt, dTime, method_code="A2G")
 
-    geoAzimuths = np.ones(azM.shape) * np.nan
-
-    for ind, mAzm in enumerate(azM):
-
-        pointA = wgs84.GeoPoint(
-            latitude=latG[ind], longitude=lonG[ind], z=refZ, degrees=True,
-        )
-        pointPole = wgs84.GeoPoint(
-            latitude=nPole[0], longitude=nPole[1], z=refZ, degrees=True,
-        )
-
-        p_AB_N = pointA.delta_to(pointPole)
-        azimuth_offset = p_AB_N.azimuth_deg[0]
-        geoAzimuths[ind] = mAzm + azimuth_offset
+    # The offset between the two is the geographic bearing of the AACGM pole
+    azimuthOffset = sd_utils.calc_bearings(latG, lonG, nPole[0], nPole[1], refAlt)
+    geoAzimuths = np.asarray(azM) + azimuthOffset
 
     geoAzimuths[geoAzimuths > 180] -= 360.
     geoAzimuths[geoAzimuths < -180] += 360.
@@ -168,19 +250,25 @@ def convert_azm_aacgm2geo(azM, latG, lonG, dTime, refAlt=300):
 
 
 if __name__ == '__main__':
-    args = sys.argv
-
-    assert len(args) >= 3, 'Should have 2-3 arguments:\n' + \
-        ' -  Input filename\n' + \
-        ' -  Output filename\n' + \
-        ' -  AACGM to Geo conversion height (km)\n' + \
-        '\ne.g.: python3 map_to_nc.py  ' + \
-        '/project/superdarn/data/map/2014/05/20140524.map  ' + \
-        '/homes/superdarn/output.nc  300'
-
-    in_fname = args[1]
-    out_fname = args[2]
-    if len(args) == 4:
-        args[3] = float(args[3])
-
-    main(*args[1:])
+    parser = argparse.ArgumentParser(
+        description='Convert one .map file, or every .map file in a date range (--dates)',
+        epilog='e.g.: python3 map_to_nc.py /project/superdarn/data/map/2014/05/20140524.map '
+               '/homes/superdarn/output.nc 300\n'
+               '      python3 map_to_nc.py --dates 20140501 20140531 -n 8')
+    parser.add_argument('in_filename', nargs='?', help='Input filename')
+    parser.add_argument('out_filename', nargs='?', help='Output filename')
+    parser.add_argument('AtoGHeight', nargs='?', type=float, default=300,
+                        help='AACGM to Geo conversion height (km)')
+    parser.add_argument('--dates', nargs=2, metavar=('START', 'END'),
+                        help='Convert all map files between two dates (YYYYMMDD)')
+    parser.add_argument('-n', '--num-workers', type=int, default=NUM_WORKERS)
+    parser.add_argument('--clobber', action='store_true', help='Overwrite existing files')
+    args = parser.parse_args()
+
+    if args.dates:
+        startDate, endDate = [dt.datetime.strptime(d, '%Y%m%d') for d in args.dates]
+        convert_maps(startDate, endDate, AtoGHeight=args.AtoGHeight,
+                     numWorkers=args.num_workers, clobber=args.clobber)
+    else:
+        assert args.out_filename, 'Specify an input and output filename, or --dates'
+        main(args.in_filename, args.out_filename, args.AtoGHeight)
@@ -0,0 +1,254 @@
+"""
+merge_fit_nc.py
+
+Merge a day's per-radar fit netCDFs (fit_to_nc.py) into one file per hemisphere
+
+Returns from every radar are concatenated along npts, tagged with radar_index
+and sorted by time. The radar.* variables (on the radar dimension) hold each
+radar's location and beam setup from its fit netCDF header.
+
+An index of offsets into npts every INDEX_STEP seconds sits alongside, and the
+npts variables are chunked along time, so a time window (all northern
+hemisphere returns between 10:00 and 10:02, say) is one sliced read:
+
+    data = load_window('20150315.north.v3.0.nc', dt.datetime(2015, 3, 15, 10), dt.datetime(2015, 3, 15, 10, 2))
+
+    python3 merge_fit_nc.py 20150315 20150316
+"""
+import argparse
+import datetime as dt
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import netCDF4
+import numpy as np
+import helper
+import jdutil
+import product_catalog
+import fit_to_nc
+from sd_utils import get_random_string
+
+NUM_WORKERS = os.cpu_count()
+INDEX_STEP = 60  # seconds between entries in the time index
+CHUNK_SIZE = 2 ** 16  # returns per chunk of the npts variables
+
+# Per-radar header table - variable name, fit netCDF attribute, type, units, long name
+RADAR_VARS = [
+    ('radar.lat', 'lat', 'f4', 'deg.', 'Radar geographic latitude'),
+    ('radar.lon', 'lon', 'f4', 'deg.', 'Radar geographic longitude'),
+    ('radar.alt', 'alt', 'f4', 'm', 'Radar altitude'),
+    ('radar.rsep', 'rsep_km', 'f4', 'km', 'Range gate separation'),
+    ('radar.maxrg', 'maxrangegate', 'u2', 'none', 'Number of range gates'),
+    ('radar.bmsep', 'bmsep', 'f4', 'deg.', 'Beam separation'),
+    ('radar.boresight', 'boresight', 'f4', 'deg.', 'Boresight azimuth'),
+]
+
+
+def main(start_date, end_date,
+         in_dir_fmt=helper.FIT_NC_DIR_FMT,
+         out_dir_fmt=helper.FIT_NC_MERGED_DIR_FMT,
+         fit_version='3.0',
+         num_workers=NUM_WORKERS,
+         clobber=False,
+         ):
+    """ Merge every day between start_date and end_date, one worker process per day """
+    days = []
+    time = start_date
+    while time <= end_date:
+        days.append(time)
+        time += dt.timedelta(days=1)
+
+    print('Merging fit netCDFs for %i days with %i workers' % (len(days), num_workers))
+    failed = []
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = {executor.submit(merge_day, day, in_dir_fmt, out_dir_fmt, fit_version, clobber): day
+                   for day in days}
+        for future in as_completed(futures):
+            day = futures[future]
+            try:
+                status = future.result()
+            except Exception as e:
+                print('Error merging %s: %s' % (day.strftime('%Y-%m-%d'), e))
+                status = 1
+            if status != 0:
+                failed.append(day)
+
+    print('Finished merging: %i of %i days failed' % (len(failed), len(days)))
+    return failed
+
+
+def merge_day(time, in_dir_fmt=helper.FIT_NC_DIR_FMT, out_dir_fmt=helper.FIT_NC_MERGED_DIR_FMT,
+              fit_version='3.0', clobber=False):
+    """ Write the north and south merged files for one day. Returns 0 on success """
+    fit_fns = get_fit_files(time, in_dir_fmt, fit_version)
+    if len(fit_fns) == 0:
+        print('No fit netCDFs for %s' % time.strftime('%Y-%m-%d'))
+        return 0
+
+    # Sort the radars into hemispheres by the latitude in their file headers
+    hemi_fns = {'north': {}, 'south': {}}
+    for radar, fit_fn in fit_fns.items():
+        with netCDF4.Dataset(fit_fn) as nc:
+            hemi_fns['north' if nc.lat > 0 else 'south'][radar] = fit_fn
+
+    out_dir = time.strftime(out_dir_fmt)
+    os.makedirs(out_dir, exist_ok=True)
+    for hemi, radar_fns in hemi_fns.items():
+        if len(radar_fns) == 0:
+            continue
+        out_fn = os.path.join(out_dir, time.strftime('%Y%m%d.') + '%s.v%s.nc' % (hemi, fit_version))
+        if os.path.isfile(out_fn) and not clobber:
+            print('File exists: %s - skipping' % out_fn)
+            continue
+        merge_files(time, radar_fns, out_fn)
+        print('Wrote %i radars to %s' % (len(radar_fns), out_fn))
+
+    return 0
+
+
+def get_fit_files(time, in_dir_fmt, fit_version):
+    """ {radar: fit netCDF filename} for one day """
+    fit_fns = {}
+    for fit_fn in sorted(glob.glob(os.path.join(time.strftime(in_dir_fmt), time.strftime('%Y%m%d.*.nc')))):
+        info = product_catalog.parse_filename(os.path.basename(fit_fn))
+        if info is None or info['radar'] is None:
+            continue
+        if fit_version and info['version'] not in (None, str(fit_version)):
+            continue
+        fit_fns[info['radar']] = fit_fn
+    return fit_fns
+
+
+def merge_files(time, radar_fns, out_fname):
+    """ Concatenate one hemisphere's fit netCDFs, sort by time and write with a time index """
+    var_defs = fit_to_nc.def_vars()
+    radars = sorted(radar_fns)
+
+    # Read each radar once, keeping its header for the radar table
+    radar_data = []
+    radar_hdrs = {vn: [] for vn, _, _, _, _ in RADAR_VARS}
+    sources = []
+    for radar in radars:
+        with netCDF4.Dataset(radar_fns[radar]) as nc:
+            radar_data.append({k: np.asarray(v[:]) for k, v in nc.variables.items()})
+            for vn, att, _, _, _ in RADAR_VARS:
+                radar_hdrs[vn].append(getattr(nc, att))
+            sources.append(nc.fitacf_source)
+
+    # Variables missing from a radar (e.g. elv) are filled with NaN. Per-radar scan tables are dropped
+    var_names = [vn for vn, defs in var_defs.items()
+                 if defs['dims'] == 'npts' and any(vn in data for data in radar_data)]
+    out_vars = {}
+    for vn in var_names:
+        vals = []
+        for data in radar_data:
+            if vn in data:
+                vals.append(data[vn])
+            else:
+                vals.append(np.full(len(data['mjd']), np.nan))
+        out_vars[vn] = np.concatenate(vals)
+    radar_index = np.concatenate([np.full(len(data['mjd']), ind) for ind, data in enumerate(radar_data)])
+
+    order = np.argsort(out_vars['mjd'], kind='stable')
+    for vn in var_names:
+        out_vars[vn] = out_vars[vn][order]
+    radar_index = radar_index[order]
+
+    # Offset of the first return at or after each INDEX_STEP, plus one for the end of the day
+    day_mjd = jdutil.jd_to_mjd(jdutil.datetime_to_jd(time))
+    index_mjd = day_mjd + np.arange(86400 // INDEX_STEP + 1) * INDEX_STEP / 86400.
+    index_offset = np.searchsorted(out_vars['mjd'], index_mjd)
+
+    npts = len(radar_index)
+    chunks = (max(min(CHUNK_SIZE, npts), 1),)
+    tmp_fname = '%s.%s.tmp' % (out_fname, get_random_string(8))
+    with netCDF4.Dataset(tmp_fname, 'w') as nc:
+        nc.description = 'Geolocated line-of-sight velocities and related parameters from SuperDARN fitACF, ' + \
+            'all radars in one hemisphere sorted by time'
+        nc.fitacf_source = ', '.join(sources)
+        nc.history = 'Created on %s' % dt.datetime.now()
+        nc.index_step_seconds = INDEX_STEP
+
+        nc.createDimension('npts', size=npts)
+        nc.createDimension('radar', size=len(radars))
+        nc.createDimension('index', size=len(index_mjd))
+
+        for vn in var_names:
+            defs = var_defs[vn]
+            var = nc.createVariable(vn, defs['type'], defs['dims'], chunksizes=chunks)
+            var[:] = out_vars[vn]
+            var.units = defs['units']
+            var.long_name = defs['long_name']
+
+        var = nc.createVariable('radar_index', 'u1', 'npts', chunksizes=chunks)
+        var[:] = radar_index
+        var.units = 'none'
+        var.long_name = 'Index of the radar (radar.code) that made each measurement'
+
+        var = nc.createVariable('radar.code', str, 'radar')
+        for ind, radar in enumerate(radars):
+            var[ind] = radar
+        var.long_name = 'Radar code'
+        for vn, _, vtype, units, long_name in RADAR_VARS:
+            var = nc.createVariable(vn, vtype, 'radar')
+            var[:] = np.array(radar_hdrs[vn])
+            var.units = units
+            var.long_name = long_name
+
+        var = nc.createVariable('index_mjd', 'f8', 'index')
+        var[:] = index_mjd
+        var.units = 'days'
+        var.long_name = 'Modified Julian Date of each time index entry'
+        var = nc.createVariable('index_offset', 'i8', 'index')
+        var[:] = index_offset
+        var.units = 'none'
+        var.long_name = 'Offset of the first return at or after index_mjd'
+
+    os.replace(tmp_fname, out_fname)
+    return 0
+
+
+def load_window(merged_fn, stime, etime, var_names=None):
+    """
+    Read the returns in [stime, etime) from a merged file, plus a 'radar_code' array
+    naming the radar of each return. Only the npts slice covering the window is read
+    """
+    mjd0, mjd1 = [jdutil.jd_to_mjd(jdutil.datetime_to_jd(t)) for t in (stime, etime)]
+    with netCDF4.Dataset(merged_fn) as nc:
+        index_mjd = nc.variables['index_mjd'][:]
+        index_offset = nc.variables['index_offset'][:]
+        npts = nc.dimensions['npts'].size
+
+        i0 = np.searchsorted(index_mjd, mjd0, side='right') - 1
+        i1 = np.searchsorted(index_mjd, mjd1, side='left')
+        p0 = int(index_offset[i0]) if i0 >= 0 else 0
+        p1 = int(index_offset[i1]) if i1 < len(index_mjd) else npts
+
+        if var_names is None:
+            var_names = [vn for vn, var in nc.variables.items() if var.dimensions == ('npts',)]
+        data = {vn: np.asarray(nc.variables[vn][p0:p1]) for vn in set(var_names) | {'mjd', 'radar_index'}}
+        radar_codes = np.array(nc.variables['radar.code'][:], dtype=object)
+
+    # The index is coarse - trim to the exact window
+    in_window = (data['mjd'] >= mjd0) & (data['mjd'] < mjd1)
+    for vn in data:
+        data[vn] = data[vn][in_window]
+    data['radar_code'] = radar_codes[data['radar_index']]
+
+    return data
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('start_date', help='Specify the start date (YYYYMMDD)')
+    parser.add_argument('end_date', help='Specify the end date (YYYYMMDD)')
+    parser.add_argument('-v', '--fit-version', default='3.0')
+    parser.add_argument('-n', '--num-workers', type=int, default=NUM_WORKERS)
+    parser.add_argument('--clobber', action='store_true', help='Overwrite existing merged files')
+    args = parser.parse_args()
+
+    start_date = dt.datetime.strptime(args.start_date, '%Y%m%d')
+    end_date = dt.datetime.strptime(args.end_date, '%Y%m%d')
+
+    main(start_date, end_date, fit_version=args.fit_version,
+         num_workers=args.num_workers, clobber=args.clobber)
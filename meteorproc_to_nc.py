@@ -1,5 +1,16 @@
+"""
+meteorproc_to_nc.py
+
+Turn meteorproc text output into netCDF winds
+
+Writes one file per radar-day (%Y%b%d.<radar>.nc, dimension npts over hours)
+and, optionally, one consolidated file per radar per month or year
+(%Y%b.<radar>.nc or %Y.<radar>.nc) with day x hour variables, so that a month
+of winds is a single file open (see load_consolidated).
+"""
 import numpy as np
 import datetime as dt
+import io
 import os
 import sys
 import glob
@@ -9,21 +20,40 @@ import netCDF4
 from sd_utils import get_radar_params, id_hdw_params_t
 
 
+CONSOLIDATED_VARS = ['Vx', 'Vy', 'sdev_Vx', 'sdev_Vy', 'lat', 'long']
+
+
 def convert_winds(
     startTime, endTime, indir, outdir,
     hdw_dat_dir='/project/superdarn/software/rst/tables/superdarn/hdw/',
+    consolidate=None,
+    daily=True,
 ):
+    """
+    Convert the months from startTime's to endTime's (inclusive)
+    consolidate: None, 'month' or 'year' - also write day x hour files per radar for that period
+    daily: write the per radar-day files
+    Returns 0 on success, 1 if a month had no files or a radar-day could not be processed
+    """
     radar_prm = get_radar_params(hdw_dat_dir)
     step = relativedelta(months=1)
+    periods = {}  # (period start, radar) -> consolidated arrays
+
+    status = 0
 
-    month = startTime - step
-    while month <= endTime:
+    month = dt.datetime(startTime.year, startTime.month, 1) - step
+    while month + step <= endTime:
         month += step
 
+        # Write out consolidated periods that ended with the previous month
+        if consolidate:
+            write_finished_periods(periods, month, outdir, consolidate)
+
         # Parse monthly file-list
         flist = glob.glob(os.path.join(month.strftime(indir), '*'))
         if len(flist) == 0:
             print(month.strftime('skipping %Y %b - no files'))
+            status = 1
             continue
 
         dates = []
@@ -66,9 +96,11 @@ def convert_winds(
                     m_hdr, m_vars = read_winds(merid_wind_fn)
                 except:
                     print('Unable to process %s' % fn_fmt)
+                    status = 1
                     continue
-                if m_vars['year'] == []:
+                if len(m_vars['year']) == 0:
                     print('Unable to process %s' % fn_fmt)
+                    status = 1
                     continue
 
                 # Define output variables
@@ -82,6 +114,11 @@ def convert_winds(
                 header_info['history'] = 'created on %s' % dt.datetime.now()
                 header_info['boresight'] = '%1.2f degrees East of North' % boresight
 
+                if consolidate:
+                    add_to_period(periods, time, radar, outvars, header_info, consolidate)
+                if not daily:
+                    continue
+
                 # Write out the netCDF
                 with netCDF4.Dataset(out_fname, 'w') as nc:
                     set_header(nc, header_info)
@@ -95,6 +132,88 @@ def convert_winds(
                         var.long_name = defs['long_name']
                 print('Wrote to %s' % out_fname)
 
+    if consolidate:
+        write_finished_periods(periods, None, outdir, consolidate)
+
+    return status
+
+
+def get_period(time, consolidate):
+    """ Start and number of days of the month or year containing time """
+    if consolidate == 'month':
+        start = dt.datetime(time.year, time.month, 1)
+        return start, ((start + relativedelta(months=1)) - start).days
+    if consolidate == 'year':
+        start = dt.datetime(time.year, 1, 1)
+        return start, ((start + relativedelta(years=1)) - start).days
+    raise ValueError('consolidate must be month or year, not %s' % consolidate)
+
+
+def add_to_period(periods, time, radar, outvars, header_info, consolidate):
+    """ Put one radar-day of winds into its day x hour slot """
+    start, ndays = get_period(time, consolidate)
+    key = (start, radar)
+    if key not in periods:
+        periods[key] = {
+            'header_info': header_info,
+            'vars': {vn: np.full((ndays, 24), np.nan) for vn in CONSOLIDATED_VARS},
+        }
+    day_ind = (time - start).days
+    hour_ind = np.round(np.asarray(outvars['hour'])).astype(int) % 24
+    for vn in CONSOLIDATED_VARS:
+        periods[key]['vars'][vn][day_ind, hour_ind] = outvars[vn]
+
+
+def write_finished_periods(periods, month, outdir, consolidate):
+    """ Write and forget the periods that end before month (all of them if month is None) """
+    for start, radar in sorted(periods):
+        if month is not None and get_period(month, consolidate)[0] == start:
+            continue
+        period = periods.pop((start, radar))
+        fn_fmt = '%Y%b.{0}.nc' if consolidate == 'month' else '%Y.{0}.nc'
+        out_fname = os.path.join(start.strftime(outdir), start.strftime(fn_fmt.format(radar)))
+
+        # Keep days from an earlier run that are not in this one
+        if os.path.isfile(out_fname):
+            old_vars, _ = load_consolidated(out_fname)
+            for vn, v in period['vars'].items():
+                period['vars'][vn] = np.where(np.isfinite(v), v, old_vars[vn])
+        write_consolidated(out_fname, start, period['vars'], period['header_info'])
+
+
+def write_consolidated(out_fname, start, cvars, header_info):
+    var_defs = def_vars()
+    header_info = dict(header_info, history='created on %s' % dt.datetime.now())
+    os.makedirs(os.path.dirname(out_fname), exist_ok=True)
+    with netCDF4.Dataset(out_fname, 'w') as nc:
+        set_header(nc, header_info)
+        nc.start_date = start.strftime('%Y-%m-%d')
+        nc.createDimension('day', size=cvars['Vx'].shape[0])
+        nc.createDimension('hour', size=24)
+        var = nc.createVariable('day', 'u2', ('day',))
+        var[:] = np.arange(cvars['Vx'].shape[0])
+        var.units = 'days'
+        var.long_name = 'Days since start_date'
+        var = nc.createVariable('hour', 'f8', ('hour',))
+        var[:] = np.arange(24)
+        var.units = 'hours'
+        var.long_name = 'Hour (UT)'
+        for vn, v in cvars.items():
+            defs = var_defs[vn]
+            var = nc.createVariable(vn, defs['type'], ('day', 'hour'))
+            var[:] = v
+            var.units = defs['units']
+            var.long_name = defs['long_name']
+    print('Wrote to %s' % out_fname)
+
+
+def load_consolidated(in_fname):
+    """ Read a consolidated wind file. Returns the day x hour variables and the header attributes """
+    with netCDF4.Dataset(in_fname) as nc:
+        wind = {vn: np.asarray(nc.variables[vn][:]) for vn in nc.variables}
+        atts = {att: nc.getncattr(att) for att in nc.ncattrs()}
+    return wind, atts
+
 
 def set_header(rootgrp, header_info):
     rootgrp.description = header_info['description']
@@ -105,6 +224,7 @@ def set_header(rootgrp, header_info):
     rootgrp.rsep_km = header_info['rsep']
     rootgrp.frang = header_info['frang']
     rootgrp.boresight = header_info['boresight']
+    rootgrp.estimator = header_info.get('estimator', 'meteorproc')
     return rootgrp
 
 
@@ -145,22 +265,15 @@ def def_vars():
 
 
 def read_winds(wind_fn):
-    # Turn the text files into dict data
+    # Turn the text files into dict data - header lines start with #, the last one names the columns
     with open(wind_fn, 'r') as f:
-        txt = f.readlines()
-    hdr = []
-    vals = []
-    for line in txt:
-        if line[0] == '#':
-            hdr.append(line)
-        else:
-            vals.append(np.array(line.split()).astype(float))
+        txt = f.read()
+    hdr = [line for line in txt.splitlines() if line.startswith('#')]
     varnames = hdr[-1].split()[1:]
-    outvars = {v: [] for v in varnames}
-    for val_list in vals:
-        outvar_l = dict(zip(varnames, val_list))
-        for k, v in outvar_l.items():
-            outvars[k].append(v)
+    vals = np.loadtxt(io.StringIO(txt), comments='#', ndmin=2)
+    if vals.size == 0:
+        vals = np.zeros((0, len(varnames)))
+    outvars = {v: vals[:, ind] for ind, v in enumerate(varnames)}
 
     hdr = ', '.join([ln.replace('#', '').strip() for ln in hdr[:-1]])
 
@@ -169,14 +282,15 @@ def read_winds(wind_fn):
 
 if __name__ == '__main__':
     args = sys.argv
-    assert len(args) == 5, 'Should have 5x args, e.g.:\n' + \
+    assert len(args) in (5, 6), 'Should have 4x args (plus optional month/year consolidation), e.g.:\n' + \
         'python3 meteorproc_to_nc.py ' + \
         '2005,1,1 2020,1,1  ' + \
         '/project/superdarn/alex/meteorwind/%Y/%m/ ' + \
-        '/project/superdarn/alex/meteorwindnc/%Y/%m/'
+        '/project/superdarn/alex/meteorwindnc/%Y/%m/ [month]'
 
     startTime = dt.datetime.strptime(args[1], '%Y,%m,%d')
     endTime = dt.datetime.strptime(args[2], '%Y,%m,%d')
     indir = args[3]
     outdir = args[4]
-    convert_winds(startTime, endTime, indir, outdir)
+    consolidate = args[5] if len(args) > 5 else None
+    convert_winds(startTime, endTime, indir, outdir, consolidate=consolidate)
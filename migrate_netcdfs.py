@@ -0,0 +1,193 @@
+"""
+migrate_netcdfs.py
+
+Apply a declared metadata correction to every netCDF in a date range
+
+Migrations are declared in MIGRATIONS as a directory format plus a list of
+edits, each one of:
+    ('set_attr', varname, attname, value)   - varname None for a global attribute
+    ('del_attr', varname, attname)
+    ('rename_var', old_name, new_name)
+
+Files are edited in place by a pool of worker processes. Each file is first
+opened read-only and only reopened in r+ mode if an edit would change it, so
+reruns are cheap. Completed files are appended to a per-migration checkpoint
+file, and a rerun of an interrupted migration skips them. The checkpoint is named
+after a hash of the migration's edits, so changing the edits starts a new one.
+
+    python3 migrate_netcdfs.py gflg_description 20190601 20211130
+"""
+import argparse
+import datetime as dt
+import glob
+import hashlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dateutil.relativedelta import relativedelta
+import netCDF4
+import helper
+
+NUM_WORKERS = os.cpu_count()
+PROGRESS_INTERVAL = 1000  # files
+
+MIGRATIONS = {
+    'gflg_description': {
+        'dir_fmt': helper.FIT_NC_DIR_FMT,
+        'pattern': '*.nc',
+        'edits': [
+            ('set_attr', 'gflg', 'long_name',
+             'Ground scatter flag for ACF, 1 - ground scatter, 0 - other scatter'),
+        ],
+    },
+}
+
+
+def main(migration_name, start_date, end_date, num_workers=NUM_WORKERS,
+         checkpoint_dir=helper.MIGRATION_CHECKPOINT_DIR, email=True):
+    migration = MIGRATIONS[migration_name]
+    start_time = time.time()
+
+    file_list = get_file_list(migration, start_date, end_date)
+    checkpoint_fn = get_checkpoint_filename(migration_name, migration, checkpoint_dir)
+    completed = load_checkpoint(checkpoint_fn)
+    to_migrate = [fn for fn in file_list if fn not in completed]
+
+    print('{0}: {1} files from {2} to {3}, {4} already done'.format(
+        migration_name, len(file_list), start_date.strftime('%Y-%m'),
+        end_date.strftime('%Y-%m'), len(file_list) - len(to_migrate)))
+    if email:
+        helper.send_email('"Starting netCDF migration {0}"'.format(migration_name),
+                          '"Migrating {0} files from {1} to {2}"'.format(
+                              len(to_migrate), start_date.strftime('%Y-%m'), end_date.strftime('%Y-%m')))
+
+    counts, failed = run_migration(migration, to_migrate, checkpoint_fn, num_workers)
+
+    summary = '{0} modified, {1} already up to date, {2} failed. Total time: {3}'.format(
+        counts['modified'], counts['unchanged'], len(failed),
+        helper.getTimeString(time.time() - start_time))
+    print(summary)
+    for fn, err in failed:
+        print('  {0}: {1}'.format(fn, err))
+    if email:
+        helper.send_email('"Finished netCDF migration {0}"'.format(migration_name),
+                          '"{0}"'.format(summary))
+
+    return failed
+
+
+def run_migration(migration, file_list, checkpoint_fn, num_workers=NUM_WORKERS):
+    """ Apply the migration's edits to file_list in parallel, recording progress as it goes """
+    os.makedirs(os.path.dirname(os.path.abspath(checkpoint_fn)), exist_ok=True)
+    counts = {'modified': 0, 'unchanged': 0}
+    failed = []
+    start_time = time.time()
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor, \
+            open(checkpoint_fn, 'a') as checkpoint:
+        futures = {executor.submit(apply_edits, fn, migration['edits']): fn
+                   for fn in file_list}
+        for ct, future in enumerate(as_completed(futures), start=1):
+            fn = futures[future]
+            try:
+                modified = future.result()
+            except Exception as e:
+                failed.append((fn, str(e)))
+            else:
+                counts['modified' if modified else 'unchanged'] += 1
+                checkpoint.write(fn + '\n')
+                checkpoint.flush()
+
+            if ct % PROGRESS_INTERVAL == 0 or ct == len(file_list):
+                print_progress(ct, len(file_list), start_time)
+
+    return counts, failed
+
+
+def apply_edits(fn, edits):
+    """ Apply edits to one file, returning True if it had to be changed """
+    with netCDF4.Dataset(fn, mode='r') as nc:
+        pending = [edit for edit in edits if edit_needed(nc, edit)]
+    if not pending:
+        return False
+
+    with netCDF4.Dataset(fn, mode='r+') as nc:
+        for edit in pending:
+            action = edit[0]
+            if action == 'set_attr':
+                _, varname, attname, value = edit
+                get_target(nc, varname).setncattr(attname, value)
+            elif action == 'del_attr':
+                _, varname, attname = edit
+                get_target(nc, varname).delncattr(attname)
+            elif action == 'rename_var':
+                _, old_name, new_name = edit
+                nc.renameVariable(old_name, new_name)
+            else:
+                raise ValueError('Unknown edit: {0}'.format(action))
+    return True
+
+
+def edit_needed(nc, edit):
+    action = edit[0]
+    if action == 'set_attr':
+        _, varname, attname, value = edit
+        target = get_target(nc, varname)
+        return attname not in target.ncattrs() or target.getncattr(attname) != value
+    if action == 'del_attr':
+        _, varname, attname = edit
+        return attname in get_target(nc, varname).ncattrs()
+    if action == 'rename_var':
+        _, old_name, new_name = edit
+        return old_name in nc.variables and new_name not in nc.variables
+    raise ValueError('Unknown edit: {0}'.format(action))
+
+
+def get_target(nc, varname):
+    return nc if varname is None else nc.variables[varname]
+
+
+def get_file_list(migration, start_date, end_date):
+    file_list = []
+    month = dt.datetime(start_date.year, start_date.month, 1)
+    while month <= end_date:
+        file_list += sorted(glob.glob(os.path.join(
+            month.strftime(migration['dir_fmt']), migration['pattern'])))
+        month += relativedelta(months=1)
+    return file_list
+
+
+def get_checkpoint_filename(migration_name, migration, checkpoint_dir):
+    """ e.g. <checkpoint_dir>/gflg_description_45a3810e.txt, keyed on the declared edits """
+    edits_hash = hashlib.md5(repr(migration['edits']).encode()).hexdigest()[:8]
+    return os.path.join(checkpoint_dir, '{0}_{1}.txt'.format(migration_name, edits_hash))
+
+
+def load_checkpoint(checkpoint_fn):
+    if not os.path.isfile(checkpoint_fn):
+        return set()
+    with open(checkpoint_fn) as f:
+        return set(line.strip() for line in f)
+
+
+def print_progress(ct, total, start_time):
+    elapsed = time.time() - start_time
+    remaining = elapsed / ct * (total - ct)
+    print('{0}: {1} of {2} files ({3:.0f}%), about {4} remaining'.format(
+        time.strftime('%Y-%m-%d %H:%M'), ct, total, 100 * ct / total,
+        helper.getTimeString(remaining)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('migration', choices=list(MIGRATIONS.keys()),
+                        help='Name of the migration to apply')
+    parser.add_argument('start_date', help='Specify the start date (YYYYMMDD)')
+    parser.add_argument('end_date', help='Specify the end date (YYYYMMDD)')
+    parser.add_argument('-n', '--num-workers', type=int, default=NUM_WORKERS)
+    args = parser.parse_args()
+
+    start_date = dt.datetime.strptime(args.start_date, '%Y%m%d')
+    end_date = dt.datetime.strptime(args.end_date, '%Y%m%d')
+
+    main(args.migration, start_date, end_date, num_workers=args.num_workers)
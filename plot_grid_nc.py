@@ -6,22 +6,21 @@ nc_utils from github.com/alexchartier/nc_utils
 import numpy as np
 import matplotlib.pyplot as plt
 import os
+import datetime as dt
 import nc_utils
+import jdutil
+import fit_to_grid_nc
 
 
 def main(
     fn='~/Downloads/20130117.sto.v3.0.grid.nc',
 ):
     df = nc_utils.load_nc(fn)
-    data = nc_utils.ncread_vars(fn)
 
-    t0 = np.floor(data['mjd_start'][0])  # + 16/24
-    t1 = np.floor(data['mjd_start'][0]) + 2 / 60 / 24  # + 16/24
-    tidx = np.logical_and(data['mjd_start'] >= t0, data['mjd_start'] <= t1)
-    breakpoint()
-
-    for k, v in data.items():
-        data[k] = v[tidx]
+    # First 2 minutes of the day
+    t0 = jdutil.jd_to_datetime(jdutil.mjd_to_jd(np.floor(df.variables['mjd_start'][0])))
+    t1 = t0 + dt.timedelta(minutes=2)
+    data = fit_to_grid_nc.load_grid_window(os.path.expanduser(fn), t0, t1)
 
     rlat = df.lat
     rlon = df.lon
@@ -24,12 +24,16 @@ times = np.array([dt.datetime.fromtimestamp(t) for t in data['times']])
 data['phi'] = np.cos(np.deg2rad(data['gAz'])) * data['vel']
 data['theta'] = np.sin(np.deg2rad(data['gAz'])) * data['vel']
 
-# for t in np.unique(times):
-tind = times == times[0]
+# first record - its vectors are numPoints[vectorOffset:vectorOffset + vectorCount]
+tind = 0
+vind = slice(data['vectorOffset'][tind], data['vectorOffset'][tind] + data['vectorCount'][tind])
 
 data_t = {}
 for k, v in data.items():
-    data_t[k] = v[tind]
+    if k in ['times', 'vectorOffset', 'vectorCount']:
+        data_t[k] = v[tind]
+    else:
+        data_t[k] = v[vind]
 
 
 # set up the plot
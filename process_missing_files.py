@@ -1,13 +1,19 @@
 import argparse
 import datetime as dt
-import glob
 import helper
+import product_catalog
 import os
 import subprocess
 import json
+import tempfile
 from dateutil.relativedelta import relativedelta
-import re
-import bz2
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from sd_utils import get_radar_params, id_hdw_params_t
+import raw_to_fit
+import fit_to_nc
+import fit_to_grid_nc
+import fit_to_meteorwind
+import meteorproc_to_nc
 
 VALID_FILE_TYPES = ['rawacf', 'fitacf', 'fit_nc',
                     'meteorwind', 'meteorwind_nc', 'grid', 'grid_nc']
@@ -20,134 +26,110 @@ GLOBUS_SOURCE_FILES = {'rawacf': 'raw',
                        'grid': 'fitacf_30',
                        'grid_nc': 'grid'}
 
+# Each product is made from exactly one upstream product. rawACFs are the
+# root: everything missing for a radar-day is rebuilt from one download
+UPSTREAM_FILE_TYPES = {'rawacf': None,
+                       'fitacf': 'rawacf',
+                       'fit_nc': 'fitacf',
+                       'meteorwind': 'fitacf',
+                       'meteorwind_nc': 'meteorwind',
+                       'grid': 'fitacf',
+                       'grid_nc': 'grid'}
 
-def get_local_file_list(file_types=None):
-    file_list = {}
-
-    day_string = date.strftime('%Y%m%d')
-    day_string_two = date.strftime('%Y%b%d')
-
-    if file_types is None:
-        file_types = VALID_FILE_TYPES
-
-    if 'rawacf' in file_types:
-        rawacf_files = glob.glob(f'{rawacf_dir}/*{day_string}*')
-        if not rawacf_files or not os.path.isdir(rawacf_dir):
-            file_list['rawacf'] = []
-        else:
-            file_list['rawacf'] = rawacf_files
-
-    if 'fitacf' in file_types:
-        fitacf_files = glob.glob(f'{fitacf_dir}/*{day_string}*')
-        if not fitacf_files or not os.path.isdir(fitacf_dir):
-            file_list['fitacf'] = []
-        else:
-            file_list['fitacf'] = fitacf_files
-
-    if 'fit_nc' in file_types:
-        fitnc_files = glob.glob(f'{fit_nc_dir}/*{day_string}*')
-        if not fitnc_files or not os.path.isdir(fit_nc_dir):
-            file_list['fit_nc'] = []
-        else:
-            file_list['fit_nc'] = fitnc_files
-
-    if 'meteorwind' in file_types:
-        meteorwind_files = glob.glob(f'{meteorwind_dir}/*{day_string_two}*')
-        if not meteorwind_files or not os.path.isdir(meteorwind_dir):
-            file_list['meteorwind'] = []
-        else:
-            file_list['meteorwind'] = meteorwind_files
-
-    if 'meteorwind_nc' in file_types:
-        meteorwindnc_files = glob.glob(
-            f'{meteorwind_nc_dir}/*{day_string_two}*')
-        if not meteorwindnc_files or not os.path.isdir(meteorwind_nc_dir):
-            file_list['meteorwind_nc'] = []
-        else:
-            file_list['meteorwind_nc'] = meteorwindnc_files
-
-    if 'grid' in file_types:
-        grid_files = glob.glob(f'{grid_dir}/*{day_string}*')
-        if not grid_files or not os.path.isdir(grid_dir):
-            file_list['grid'] = []
-        else:
-            file_list['grid'] = grid_files
-
-    if 'grid_nc' in file_types:
-        gridnc_files = glob.glob(f'{grid_nc_dir}/*{day_string}*')
-        if not gridnc_files or not os.path.isdir(grid_nc_dir):
-            file_list['grid_nc'] = []
-        else:
-            file_list['grid_nc'] = gridnc_files
+# Maximum number of concurrent tasks for each resource
+RESOURCE_LIMITS = {'network': 2,
+                   'cpu': os.cpu_count()}
 
-    return file_list
+FIT_VERSION = 3.0
+RUN_DIR = '/project/superdarn/run'
+METEORPROC_EXE = '/project/superdarn/software/rst/bin/meteorproc'
+CFIT_EXE = '/project/superdarn/software/rst/bin/make_cfit'
+MAKE_GRID_CMD = fit_to_grid_nc.MAKE_GRID_CMD
 
 
-def get_globus_file_list():
+def get_globus_file_list(date):
     day = date.strftime('%Y%m%d')
     with open(f'{helper.GLOBUS_FILE_LIST_DIR}/globus_data_inventory.json') as f:
         remote_data = json.load(f)
     return remote_data.get(day, [])
 
-# NEXT: Test this with already existing fitACF files to confirm it's combining them properly
-
 
-def combine_files(file_list, fitVersion):
-    file_dict = {}
+def get_filename(file_type, date, radar):
+    """ Local filename of a radar-day product, matching the existing converters """
+    fit_head = date.strftime(f'%Y%m%d.{radar}.v{FIT_VERSION}')
+    filenames = {
+        'fitacf': os.path.join(date.strftime(helper.FITACF_DIR_FMT), fit_head + '.fit'),
+        'fit_nc': os.path.join(date.strftime(helper.FIT_NC_DIR_FMT), fit_head + '.nc'),
+        'grid': os.path.join(date.strftime(helper.GRID_DIR_FMT), fit_head + '.grid'),
+        'grid_nc': os.path.join(date.strftime(helper.GRID_NC_DIR_FMT), fit_head + '.grid.nc'),
+        'meteorwind': os.path.join(date.strftime(helper.METEORWIND_DIR_FMT),
+                                   date.strftime('%Y%b%d') + f'.{radar}.%s.txt'),
+    }
+    return filenames[file_type]
 
-    for file_name in file_list:
-        match = re.search(
-            r'(\d{8})\.\d{4}\.\d{2}\.(.+)\.fitacf\.bz2$', file_name)
-        if match:
-            # Extract the YYYYMMDD portion as the file date
-            file_date = match.group(1)
-            station = match.group(2)  # Extract the radar station name
-            key = (file_date, station)
-            if key not in file_dict:
-                file_dict[key] = []
-            file_dict[key].append(file_name)
 
-    for (file_date, station), files in file_dict.items():
-        output_file = os.path.join(fitacf_dir, f'{file_date}.{
-                                   station}.{fitVersion}.fit')
-        with open(output_file, 'wb') as output:
-            for file_name in files:
-                file_path = os.path.join(fitacf_dir, file_name)
-                with bz2.open(file_path, 'rb') as compressed_file:
-                    uncompressed_data = compressed_file.read()
-                    output.write(uncompressed_data)
+""" Production functions - each returns 0 on success, as the converters do """
 
 
-def produce_rawacf(files):
+def produce_rawacf(month):
+    # The Globus sync works a month at a time, so one download serves every day
+    return download_files(GLOBUS_SOURCE_FILES['rawacf'], month,
+                          month.strftime(helper.RAWACF_DIR_FMT))
 
-    return
 
+def produce_fitacf(date, radar):
+    in_fname_fmt = os.path.join(date.strftime(helper.RAWACF_DIR_FMT),
+                                date.strftime(f'%Y%m%d*{radar}*.rawacf.bz2'))
+    # proc_radar works in (and chdirs to) its run dir - give it a private one and
+    # restore the worker's cwd before the dir is removed
+    cwd = os.getcwd()
+    os.makedirs(RUN_DIR, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=RUN_DIR) as run_dir:
+        try:
+            return raw_to_fit.proc_radar(in_fname_fmt, get_filename('fitacf', date, radar),
+                                         FIT_VERSION, run_dir)
+        finally:
+            os.chdir(cwd)
 
-def produce_fitacf(files):
-    download_files('fitacf_30', files, fitacf_dir)
-    files_to_combine = os.listdir(fitacf_dir)
-    fit_version = 'v3.0'
-    combine_files(files_to_combine, fit_version)
 
+def produce_fit_nc(date, radar):
+    radar_info = get_radar_params(helper.HDW_DAT_DIR)
+    radar_info_t = id_hdw_params_t(date, radar_info[product_catalog.site_code(radar)])
+    out_fname = get_filename('fit_nc', date, radar)
+    os.makedirs(os.path.dirname(out_fname), exist_ok=True)
+    return fit_to_nc.fit_to_nc(date, get_filename('fitacf', date, radar),
+                               out_fname, radar_info_t, FIT_VERSION)
 
-def produce_fit_nc(files):
-    return
 
+def produce_grid(date, radar):
+    return fit_to_grid_nc.fit_to_grid(get_filename('fitacf', date, radar),
+                                      get_filename('grid', date, radar), MAKE_GRID_CMD)
 
-def produce_meteorwind(files):
-    return
 
+def produce_grid_nc(date, radar):
+    out_fname = get_filename('grid_nc', date, radar)
+    os.makedirs(os.path.dirname(out_fname), exist_ok=True)
+    status = fit_to_grid_nc.convert_fit_to_grid_nc(
+        date, get_filename('fitacf', date, radar), get_filename('grid', date, radar),
+        out_fname, helper.HDW_DAT_DIR, fitVersion=str(FIT_VERSION), convert_cmd=MAKE_GRID_CMD)
+    return status or 0
 
-def produce_meteorwind_nc(files):
-    return
 
+def produce_meteorwind(date, radar):
+    # One cfit in a private temp dir, shared by the m and z meteorproc runs
+    wind_fnames = {mz_flag: get_filename('meteorwind', date, radar) % mz_flag
+                   for mz_flag in fit_to_meteorwind.MZ_FLAGS}
+    return fit_to_meteorwind.fit_to_winds(
+        date, get_filename('fitacf', date, radar), 1, wind_fnames,
+        METEORPROC_EXE, CFIT_EXE, run_dir=RUN_DIR)
 
-def produce_grid(files):
-    return
 
-
-def produce_grid_nc(files):
-    return
+def produce_meteorwind_nc(month):
+    # meteorproc_to_nc converts a whole month of wind files at once
+    month_end = month + relativedelta(months=1) - dt.timedelta(days=1)
+    return meteorproc_to_nc.convert_winds(
+        month, month_end, helper.METEORWIND_DIR_FMT, helper.METEORWIND_NC_DIR_FMT,
+        hdw_dat_dir=helper.HDW_DAT_DIR)
 
 
 DATA_PRODUCTION_FUNCTIONS = {
@@ -160,26 +142,140 @@ DATA_PRODUCTION_FUNCTIONS = {
     'grid_nc': produce_grid_nc
 }
 
-# Produce all missing files for the given day
+# Products that are produced (and keyed in the plan) per month rather than per radar-day
+MONTHLY_FILE_TYPES = ['rawacf', 'meteorwind_nc']
+
+TASK_RESOURCES = {'rawacf': 'network'}
 
 
-def produce_missing_files(missing_files):
-    for file_type_to_produce, files in missing_files.items():
-        if files:
-            production_function = DATA_PRODUCTION_FUNCTIONS.get(
-                file_type_to_produce)
-            if production_function:
-                breakpoint()
-                production_function(files)
-            else:
-                print(f'No data production function found for file type: {
-                      file_type_to_produce}')
+def plan_missing_files(start_date, end_date, file_types):
+    """
+    Work out the minimal set of tasks needed to fill every missing product
 
+    Walks each missing radar-day product up its chain of upstream products
+    until it reaches one that exists locally. Tasks are keyed by
+    (file_type, date, radar) - or (file_type, month, None) for monthly
+    products - so an input shared by several products (e.g. one rawACF
+    download feeding fitacf -> fit_nc, grid and meteorwind) is only planned
+    once.
 
-def download_files(globus_file_type, stations, destination_dir):
-    subprocess.run(['nohup', '/software/python-3.11.4/bin/python3',
-                    '/homes/superdarn/superdarn/globus/sync_radar_data_globus.py',
-                    '-y', str(date.year), '-m', str(date.month), '-t', globus_file_type, destination_dir])
+    Returns {task_key: {'file_type', 'args', 'resource', 'deps'}}
+    """
+    all_types = set(VALID_FILE_TYPES)
+    available = {}
+    for file_type in all_types:
+        available[file_type] = {
+            (day, site) for day, site in
+            product_catalog.get_radar_days(catalog, file_type, start_date, end_date) if site
+        }
+
+    plan = {}
+
+    def need(file_type, date, radar):
+        """ Add the task producing file_type (and its upstream tasks) - return its key or None """
+        if (date.strftime('%Y-%m-%d'), radar) in available[file_type]:
+            return None
+
+        if file_type in MONTHLY_FILE_TYPES:
+            month = dt.datetime(date.year, date.month, 1)
+            key = (file_type, month, None)
+            args = (month,)
+        else:
+            key = (file_type, date, radar)
+            args = (date, radar)
+
+        if key not in plan:
+            plan[key] = {
+                'file_type': file_type,
+                'args': args,
+                'resource': TASK_RESOURCES.get(file_type, 'cpu'),
+                'deps': set(),
+            }
+        upstream = UPSTREAM_FILE_TYPES[file_type]
+        if upstream:
+            dep = need(upstream, date, radar)
+            if dep:
+                plan[key]['deps'].add(dep)
+        return key
+
+    date = start_date
+    while date <= end_date:
+        # Products are made per site, from all of its channels' rawACFs (kod.c, kod.d -> kod)
+        for radar in sorted({product_catalog.site_code(radar) for radar in get_globus_file_list(date)}):
+            for file_type in file_types:
+                need(file_type, date, radar)
+        date += dt.timedelta(days=1)
+
+    return plan
+
+
+def execute_plan(plan, resource_limits=RESOURCE_LIMITS):
+    """
+    Run the planned tasks in parallel, respecting dependencies and per-resource limits
+
+    Tasks whose upstream task failed are skipped. Returns the keys of the
+    tasks that failed or were skipped.
+    """
+    executors = {
+        'network': ThreadPoolExecutor(max_workers=resource_limits['network']),
+        'cpu': ProcessPoolExecutor(max_workers=resource_limits['cpu']),
+    }
+    pending = dict(plan)
+    running = {}
+    done = set()
+    failed = set()
+
+    try:
+        while pending or running:
+            # Submit everything whose inputs are ready, skip anything whose inputs failed
+            for key, task in list(pending.items()):
+                if task['deps'] & failed:
+                    print(f'Skipping {describe_task(key)} - upstream product failed')
+                    failed.add(key)
+                    pending.pop(key)
+                elif task['deps'] <= done:
+                    function = DATA_PRODUCTION_FUNCTIONS[task['file_type']]
+                    future = executors[task['resource']].submit(function, *task['args'])
+                    running[future] = key
+                    pending.pop(key)
+
+            if not running:
+                # Only reachable if the plan has a dependency cycle
+                failed.update(pending)
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                key = running.pop(future)
+                try:
+                    status = future.result()
+                except Exception as e:
+                    print(f'Failed to produce {describe_task(key)}: {e}')
+                    status = 1
+                if status:
+                    failed.add(key)
+                else:
+                    print(f'Produced {describe_task(key)}')
+                    done.add(key)
+    finally:
+        for executor in executors.values():
+            executor.shutdown(wait=True)
+
+    return failed
+
+
+def describe_task(key):
+    file_type, date, radar = key
+    if radar is None:
+        return f'{file_type} {date.strftime("%Y-%m")}'
+    return f'{file_type} {date.strftime("%Y-%m-%d")} {radar}'
+
+
+def download_files(globus_file_type, date, destination_dir):
+    result = subprocess.run(['nohup', '/software/python-3.11.4/bin/python3',
+                             '/homes/superdarn/superdarn/globus/sync_radar_data_globus.py',
+                             '-y', str(date.year), '-m', str(date.month), '-t', globus_file_type, destination_dir])
+    return result.returncode
 
     # for station in stations:
     # pattern = date.strftime('%Y%m%d') + '*' + station
@@ -190,7 +286,7 @@ def download_files(globus_file_type, stations, destination_dir):
     #                 '-y', str(date.year), '-m', str(date.month), '-t', globus_file_type, '-p', pattern, destination_dir])
 
 
-def main(start_date, end_date, file_types):
+def main(start_date, end_date, file_types, dry_run=False):
     if file_types is None:
         file_types = VALID_FILE_TYPES
     elif not file_types:
@@ -203,8 +299,7 @@ def main(start_date, end_date, file_types):
         file_types = [file_type.lower() for file_type in file_types]
         invalid_file_types = set(file_types) - set(VALID_FILE_TYPES)
         if invalid_file_types:
-            print(f'\nInvalid file types specified: {
-                  ", ".join(invalid_file_types)}')
+            print(f'\nInvalid file types specified: {", ".join(invalid_file_types)}')
             print('Valid file types are:')
             for file_type in VALID_FILE_TYPES:
                 print(f'  {file_type}')
@@ -212,47 +307,33 @@ def main(start_date, end_date, file_types):
                 '\nExample usage: python3 process_missing_files.py -t fitacf meteorwind_nc\n')
             return
 
-    global rawacf_dir, fitacf_dir, fit_nc_dir, meteorwind_dir, meteorwind_nc_dir, grid_dir, grid_nc_dir, date
+    global catalog
 
-    date = start_date
-    while date >= end_date:
-        print(f'Checking files for {date.strftime("%Y-%m-%d")}...')
-
-        # Populate the directory paths for the current date
-        rawacf_dir = date.strftime(helper.RAWACF_DIR_FMT)
-        fitacf_dir = date.strftime(helper.FITACF_DIR_FMT)
-        fit_nc_dir = date.strftime(helper.FIT_NC_DIR_FMT)
-        meteorwind_dir = date.strftime(helper.METEORWIND_DIR_FMT)
-        meteorwind_nc_dir = date.strftime(helper.METEORWIND_NC_DIR_FMT)
-        grid_dir = date.strftime(helper.GRID_DIR_FMT)
-        grid_nc_dir = date.strftime(helper.GRID_NC_DIR_FMT)
-
-        globus_files = get_globus_file_list()
-        local_files = get_local_file_list(file_types)
-        missing_files = {}
-
-        for file_type, files in local_files.items():
-            missing_files[file_type] = []
-            for globus_file in globus_files:
-                file_exists = False
-                for local_file in files:
-                    if globus_file in local_file:
-                        file_exists = True
-                        break
-                if not file_exists:
-                    missing_files[file_type].append(globus_file)
-
-        # TODO: Remove this block
-        # if missing_files:
-        #     print(f'Missing files for {date.strftime("%Y-%m-%d")} on the local system:')
-        #     for file_type, files in missing_files.items():
-        #         if files:
-        #             print(f'{file_type}: {files}')
-
-        produce_missing_files(missing_files)
-
-        # date -= dt.timedelta(days=1)
-        date -= relativedelta(months=1)
+    # Dates may be given in either order (historically newest first)
+    start_date, end_date = min(start_date, end_date), max(start_date, end_date)
+
+    # Only rescans the directories that have changed since the last run
+    catalog = product_catalog.open_catalog()
+    product_catalog.update_catalog(catalog, start_date, end_date)
+
+    plan = plan_missing_files(start_date, end_date, file_types)
+    print(f'Planned {len(plan)} tasks to fill {start_date.strftime("%Y-%m-%d")} '
+          f'to {end_date.strftime("%Y-%m-%d")}:')
+    for file_type in VALID_FILE_TYPES:
+        num_tasks = sum(1 for key in plan if key[0] == file_type)
+        if num_tasks:
+            print(f'  {file_type}: {num_tasks}')
+    if dry_run:
+        return
+
+    failed = execute_plan(plan)
+    if failed:
+        print(f'{len(failed)} tasks failed or were skipped:')
+        for key in sorted(failed, key=describe_task):
+            print(f'  {describe_task(key)}')
+
+    # Pick up the new files
+    product_catalog.update_catalog(catalog, start_date, end_date)
 
 
 if __name__ == '__main__':
@@ -261,9 +342,11 @@ if __name__ == '__main__':
     parser.add_argument('end_date', help='Specify the end date (YYYYMMDD)')
     parser.add_argument('-t', '--file-types', nargs='*',
                         help='Specify the file types to check (e.g. fitacf, meteorwind_nc, etc)')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='Print the production plan without running it')
     args = parser.parse_args()
 
     start_date = dt.datetime.strptime(args.start_date, '%Y%m%d')
     end_date = dt.datetime.strptime(args.end_date, '%Y%m%d')
 
-    main(start_date, end_date, args.file_types)
+    main(start_date, end_date, args.file_types, dry_run=args.dry_run)
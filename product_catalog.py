@@ -0,0 +1,259 @@
+"""
+product_catalog.py
+
+SQLite catalog of the SuperDARN products held locally
+
+Every product tier (rawacf, fitacf, fit_nc, meteorwind, meteorwind_nc, grid,
+grid_nc) is indexed by path, date, radar, site, version, size, mtime and a
+validity flag. site is the radar code without its channel (kod.c -> kod), so
+products named with and without channels can be matched up. The catalog is
+updated incrementally: each monthly directory is listed once and only files
+whose size or mtime differ from their catalogued row are re-catalogued, so
+validity flags set by integrity checks last until the file itself changes.
+
+Typical use:
+    conn = open_catalog()
+    update_catalog(conn, dt.datetime(2014, 1, 1), dt.datetime(2014, 12, 31))
+    missing = get_missing(conn, dt.datetime(2014, 1, 1), dt.datetime(2014, 12, 31), 'fit_nc')
+
+    python3 product_catalog.py 20140101 20141231 [-t fit_nc grid_nc] [--rescan]
+"""
+import argparse
+import datetime as dt
+import os
+import re
+import sqlite3
+from dateutil.relativedelta import relativedelta
+import helper
+
+PRODUCT_DIR_FMTS = {
+    'rawacf': helper.RAWACF_DIR_FMT,
+    'fitacf': helper.FITACF_DIR_FMT,
+    'fit_nc': helper.FIT_NC_DIR_FMT,
+    'fit_nc_merged': helper.FIT_NC_MERGED_DIR_FMT,
+    'meteorwind': helper.METEORWIND_DIR_FMT,
+    'meteorwind_nc': helper.METEORWIND_NC_DIR_FMT,
+    'grid': helper.GRID_DIR_FMT,
+    'grid_nc': helper.GRID_NC_DIR_FMT,
+}
+
+# Files below these sizes are catalogued but flagged as invalid
+MIN_FILE_SIZES = {
+    'rawacf': 0,
+    'fitacf': helper.MIN_FITACF_FILE_SIZE,
+    'fit_nc': 1E4,
+    'fit_nc_merged': 1E4,
+    'meteorwind': 1,
+    'meteorwind_nc': 1E3,
+    'grid': helper.MIN_FITACF_FILE_SIZE,
+    'grid_nc': 1E4,
+}
+
+# Extensions and suffixes that are not part of the radar name
+NON_RADAR_FIELDS = ['bz2', 'rawacf', 'fitacf', 'fitacf3', 'fit', 'despeckled',
+                    'nc', 'grid', 'txt', 'cfit', 'm', 'z']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    dir TEXT NOT NULL,
+    product TEXT NOT NULL,
+    date TEXT NOT NULL,
+    radar TEXT,
+    site TEXT,
+    version TEXT,
+    size INTEGER,
+    mtime REAL,
+    valid INTEGER
+);
+CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+CREATE INDEX IF NOT EXISTS files_product_date_site ON files (product, date, site);
+"""
+
+UPSERT = """
+INSERT INTO files (path, dir, product, date, radar, version, size, mtime, valid, site)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (path) DO UPDATE SET
+    dir = excluded.dir, product = excluded.product, date = excluded.date,
+    radar = excluded.radar, version = excluded.version, size = excluded.size,
+    mtime = excluded.mtime, valid = excluded.valid, site = excluded.site
+"""
+
+
+def main(start_date, end_date, products, rescan=False):
+    conn = open_catalog()
+    update_catalog(conn, start_date, end_date, products, rescan=rescan)
+    for product in products:
+        missing = get_missing(conn, start_date, end_date, product)
+        print('{0}: {1} radar-days missing relative to rawacf'.format(
+            product, len(missing)))
+
+
+def open_catalog(db_fn=helper.CATALOG_DB):
+    os.makedirs(os.path.dirname(os.path.abspath(db_fn)), exist_ok=True)
+    conn = sqlite3.connect(db_fn)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def update_catalog(conn, start_date, end_date, products=None, rescan=False):
+    """ Bring every monthly product directory in the date range up to date """
+    if products is None:
+        products = PRODUCT_DIR_FMTS.keys()
+
+    for product in products:
+        for month in get_months(start_date, end_date):
+            dirn = month.strftime(PRODUCT_DIR_FMTS[product])
+            update_dir(conn, product, dirn, rescan=rescan)
+    conn.commit()
+
+
+def update_dir(conn, product, dirn, rescan=False):
+    """
+    Catalog new and changed files in one directory and drop rows for deleted ones.
+    Files whose size and mtime match their row are left alone, keeping any validity
+    flag set by set_valid(). rescan re-catalogues every file, resetting those flags
+    """
+    stored = {path: (size, mtime) for path, size, mtime in conn.execute(
+        'SELECT path, size, mtime FROM files WHERE dir = ?', (dirn,))}
+
+    rows = []
+    seen = set()
+    try:
+        with os.scandir(dirn) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                info = parse_filename(entry.name)
+                if info is None:
+                    continue
+                seen.add(entry.path)
+                fn_info = entry.stat()
+                if not rescan and stored.get(entry.path) == (fn_info.st_size, fn_info.st_mtime):
+                    continue
+                valid = fn_info.st_size >= MIN_FILE_SIZES[product]
+                rows.append((entry.path, dirn, product, info['date'], info['radar'], info['version'],
+                             fn_info.st_size, fn_info.st_mtime, int(valid), info['site']))
+    except FileNotFoundError:
+        pass
+
+    removed = [(path,) for path in stored if path not in seen]
+    conn.executemany('DELETE FROM files WHERE path = ?', removed)
+    conn.executemany(UPSERT, rows)
+    if rows or removed:
+        print('Catalogued {0} new or changed and removed {1} {2} files in {3}'.format(
+            len(rows), len(removed), product, dirn))
+
+
+def site_code(radar):
+    """ Radar code without the channel, e.g. kod.c -> kod """
+    return radar.split('.')[0] if radar else radar
+
+
+def parse_filename(fname):
+    """
+    Pull the date, radar, site and fitACF version out of a product filename, e.g.
+        20140524.0001.00.kod.c.rawacf.bz2   -> 2014-05-24, kod.c, kod, None
+        20140524.kod.v3.0.despeckled.fit    -> 2014-05-24, kod, kod, 3.0
+        2014May24.kod.m.txt                 -> 2014-05-24, kod, kod, None
+    Returns None for anything that doesn't start with a date
+    """
+    fields = fname.split('.')
+    date = None
+    for fmt in ('%Y%m%d', '%Y%b%d'):
+        try:
+            date = dt.datetime.strptime(fields[0], fmt)
+            break
+        except ValueError:
+            continue
+    if date is None:
+        return None
+
+    version = None
+    version_match = re.search(r'\.v(\d+\.\d+)', fname)
+    if version_match:
+        version = version_match.group(1)
+        fields = fname.replace(version_match.group(0), '').split('.')
+
+    fields = fields[1:]
+    # rawACF/fitACF style HHMM.SS fields
+    if len(fields) >= 2 and re.fullmatch(r'\d{4}', fields[0]) and re.fullmatch(r'\d{2}', fields[1]):
+        fields = fields[2:]
+    radar_fields = [f for f in fields if f not in NON_RADAR_FIELDS]
+    radar = '.'.join(radar_fields) if radar_fields else None
+
+    return {'date': date.strftime('%Y-%m-%d'), 'radar': radar, 'site': site_code(radar),
+            'version': version}
+
+
+def get_files(conn, product, start_date, end_date=None, radar=None, valid_only=True):
+    """ Return the catalogued paths of one product over a date range """
+    if end_date is None:
+        end_date = start_date
+    query = 'SELECT path FROM files WHERE product = ? AND date BETWEEN ? AND ?'
+    args = [product, start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')]
+    if radar is not None:
+        query += ' AND radar = ?'
+        args.append(radar)
+    if valid_only:
+        query += ' AND valid = 1'
+    return [row[0] for row in conn.execute(query + ' ORDER BY path', args)]
+
+
+def get_radar_days(conn, product, start_date, end_date, valid_only=True):
+    """ Return the set of (date, site) pairs for which a product exists """
+    query = 'SELECT DISTINCT date, site FROM files WHERE product = ? AND date BETWEEN ? AND ?'
+    if valid_only:
+        query += ' AND valid = 1'
+    rows = conn.execute(query, (product, start_date.strftime('%Y-%m-%d'),
+                                end_date.strftime('%Y-%m-%d')))
+    return set(rows)
+
+
+def get_missing(conn, start_date, end_date, product, reference='rawacf'):
+    """
+    Return the sorted (date, site) pairs in the range for which the reference
+    product exists but the requested product does not. Compared by site, as
+    rawACFs are named by channel (kod.c) and most products are not (kod)
+    """
+    rows = conn.execute("""
+        SELECT DISTINCT date, site FROM files
+        WHERE product = ? AND valid = 1 AND date BETWEEN ? AND ?
+        EXCEPT
+        SELECT date, site FROM files
+        WHERE product = ? AND valid = 1 AND date BETWEEN ? AND ?
+        ORDER BY date, site
+        """, (reference, start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'),
+              product, start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')))
+    return rows.fetchall()
+
+
+def set_valid(conn, path, valid):
+    """ Flag a catalogued file as valid/invalid (e.g. after an integrity check) """
+    conn.execute('UPDATE files SET valid = ? WHERE path = ?', (int(valid), path))
+
+
+def get_months(start_date, end_date):
+    month = dt.datetime(min(start_date, end_date).year, min(start_date, end_date).month, 1)
+    last = max(start_date, end_date)
+    months = []
+    while month <= last:
+        months.append(month)
+        month += relativedelta(months=1)
+    return months
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('start_date', help='Specify the start date (YYYYMMDD)')
+    parser.add_argument('end_date', help='Specify the end date (YYYYMMDD)')
+    parser.add_argument('-t', '--file-types', nargs='*', default=list(PRODUCT_DIR_FMTS.keys()),
+                        help='Specify the file types to index (e.g. fitacf, meteorwind_nc, etc)')
+    parser.add_argument('--rescan', action='store_true',
+                        help='Re-catalog every file, even if its size and mtime are unchanged')
+    args = parser.parse_args()
+
+    start_date = dt.datetime.strptime(args.start_date, '%Y%m%d')
+    end_date = dt.datetime.strptime(args.end_date, '%Y%m%d')
+
+    main(start_date, end_date, args.file_types, rescan=args.rescan)
@@ -26,15 +26,71 @@ def build_scan(dmap_data: List[dict]):
     """
     # Set up scans for easy locating
     # Makes a list of size (number of records), with the scan number for each
-    scan_mark = [sub['scan'] for sub in dmap_data]
-    current_scan = 0
-    beam_scan = np.zeros((len(dmap_data)))
-    for beam in range(len(dmap_data)):
-        # Absoloute value used due to some scan flags set as "-1"
-        if abs(scan_mark[beam]) == 1:
-            current_scan += 1
-            beam_scan[beam] = current_scan
-        if scan_mark[beam] == 0:
-            beam_scan[beam] = current_scan
+    scan_mark = np.array([sub['scan'] for sub in dmap_data])
+    beam_scan = scan_index(scan_mark).astype(float)
+    # Records with a scan flag other than 0 or +/-1 are not assigned a scan
+    beam_scan[(np.abs(scan_mark) != 1) & (scan_mark != 0)] = 0
 
     return beam_scan
+
+
+def scan_index(scan_flags):
+    """
+    Returns the scan number of each record from its scan flag. A new scan
+    starts at every record flagged 1 (or -1, as some radars set it)
+
+    Parameters
+    ----------
+    scan_flags: array-like
+        scan flag of each record, in time order
+    Returns
+    ----------
+    rec_scan: np.ndarray
+        scan number of each record, starting from 0 for any records before
+    the first flagged one
+    """
+    return np.cumsum(np.abs(np.asarray(scan_flags)) == 1)
+
+
+def scan_start_indices(rec_scan, rec_npts):
+    """
+    Returns the offset of each scan's first return in the flattened (npts)
+    arrays and the index of its first record
+
+    Parameters
+    ----------
+    rec_scan: np.ndarray
+        scan number of each record (from scan_index)
+    rec_npts: np.ndarray
+        number of returns stored for each record (0 for skipped records)
+    Returns
+    ----------
+    scan_start_index: np.ndarray
+        offset of the first return of each scan from rec_scan[0] to
+    rec_scan[-1]; scan k is npts[scan_start_index[k]:scan_start_index[k + 1]]
+    scan_first_rec: np.ndarray
+        index of the first record of each scan
+    """
+    scans = np.arange(rec_scan[0], rec_scan[-1] + 1)
+    rec_offset = np.concatenate([[0], np.cumsum(rec_npts)])
+    scan_first_rec = np.searchsorted(rec_scan, scans)
+    return rec_offset[scan_first_rec], scan_first_rec
+
+
+def expand_scan_index(scan_start_index, npts):
+    """
+    Returns the scan number of every return from the scan_start_index
+    variable of a fit netCDF
+
+    Parameters
+    ----------
+    scan_start_index: np.ndarray
+        offset of the first return of each scan
+    npts: int
+        total number of returns
+    Returns
+    ----------
+    scan: np.ndarray
+        scan number (counted from 0) of each return
+    """
+    return np.searchsorted(scan_start_index, np.arange(npts), side='right') - 1
@@ -6,6 +6,11 @@ import string
 import random
 import aacgmv2
 import re
+import nvector as nv
+wgs84 = nv.FrameE(name='WGS84')
+
+AACGM_CACHE_DAYS = 4  # days of converted grid cells kept in memory
+aacgm_cache = {}  # (method_code, height, day) -> {(lat, lon): (out_lat, out_lon)}
 
 
 def get_radar_params(hdw_dat_dir):
@@ -84,6 +89,54 @@ def id_beam_north(hdw_params, center_bm=8, maxdev=10):
         return np.nan
 
 
+def convert_latlon_cached(lats, lons, height, time, method_code='A2G'):
+    """
+    aacgmv2.convert_latlon_arr for points on a fixed grid (e.g. grid/map vectors), where the same
+    cells recur thousands of times a day. Each unique (lat, lon) is converted once per day
+    and height, in a single batch, and the results are scattered back to every point
+    """
+    lats = np.asarray(lats, dtype=float).ravel()
+    lons = np.asarray(lons, dtype=float).ravel()
+    if len(lats) == 0:
+        return np.array([]), np.array([])
+
+    cells, inverse = np.unique(np.column_stack([lats, lons]), axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+
+    day = dt.datetime(time.year, time.month, time.day)
+    key = (method_code, float(height), day)
+    if key not in aacgm_cache:
+        if len(aacgm_cache) >= AACGM_CACHE_DAYS:
+            aacgm_cache.pop(next(iter(aacgm_cache)))
+        aacgm_cache[key] = {}
+    known = aacgm_cache[key]
+
+    new_cells = [tuple(cell) for cell in cells if tuple(cell) not in known]
+    if new_cells:
+        new_lats, new_lons = np.array(new_cells).T
+        out_lats, out_lons, _ = aacgmv2.convert_latlon_arr(
+            new_lats, new_lons, height, day, method_code=method_code)
+        known.update(zip(new_cells, zip(out_lats, out_lons)))
+
+    out = np.array([known[tuple(cell)] for cell in cells])
+    return out[inverse, 0], out[inverse, 1]
+
+
+def calc_bearings(lats, lons, target_lat, target_lon, ref_ht=300.):
+    """
+    Azimuths (deg.) at each (lats, lons) of the geodesic towards (target_lat, target_lon),
+    all at ref_ht (km). Either end may be a scalar or an array - one nvector call for the lot
+    """
+    depth = -ref_ht * 1E3  # nvector uses z = height in metres down
+    pointA = wgs84.GeoPoint(latitude=np.atleast_1d(lats), longitude=np.atleast_1d(lons),
+                            z=depth, degrees=True)
+    pointB = wgs84.GeoPoint(latitude=np.atleast_1d(target_lat), longitude=np.atleast_1d(target_lon),
+                            z=depth, degrees=True)
+    p_AB_N = pointA.delta_to(pointB)  # note we want the bearing at point A
+
+    return np.atleast_1d(p_AB_N.azimuth_deg).ravel()
+
+
 def get_random_string(length):
     """Return a random string of lowercase letters"""
 
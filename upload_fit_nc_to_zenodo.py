@@ -15,8 +15,9 @@ import requests
 import datetime as dt
 from dateutil.relativedelta import relativedelta
 import helper
+import zenodo_uploader
+import product_catalog
 import json
-import glob
 import time
 
 __author__ = "Jordan Wiker"
@@ -57,12 +58,18 @@ def upload_to_zenodo(sandbox, date):
     accessToken = helper.ZENODO_SANDBOX_TOKEN if sandbox else helper.ZENODO_TOKEN
     depositURL = helper.SANDBOX_DEPOSIT_URL if sandbox else helper.DEPOSIT_URL
 
-    uploadDir = date.strftime(helper.NETCDF_DIR_FMT)
+    uploadDir = date.strftime(helper.FIT_NC_DIR_FMT)
+
+    # Only upload files the catalog considers valid (e.g. not empty)
+    catalog = product_catalog.open_catalog()
+    product_catalog.update_catalog(catalog, date, date, ['fit_nc'])
+    monthStart = dt.datetime(date.year, date.month, 1)
+    monthEnd = monthStart + relativedelta(months=1) - dt.timedelta(days=1)
+    fileList = product_catalog.get_files(catalog, 'fit_nc', monthStart, monthEnd)
+    catalog.close()
 
     if date.year > helper.LATEST_PUBLIC_DATA:
-        fileList = glob.glob(os.path.join(uploadDir, '*wal**.nc'))
-    else:
-        fileList = glob.glob(os.path.join(uploadDir, '*.nc'))
+        fileList = [f for f in fileList if 'wal' in os.path.basename(f)]
 
     if len(fileList) == 0:
         print('No files to upload in {0}'.format(uploadDir))
@@ -72,26 +79,15 @@ def upload_to_zenodo(sandbox, date):
             len(fileList), date.strftime('%Y-%m')))
 
     headers = {"Content-Type": "application/json"}
-    params = {'access_token': accessToken}
-    r = requests.post(depositURL,
-                      params=params,
-                      json={},
-                      headers=headers)
-
-    bucket_url = r.json()["links"]["bucket"]
-    deposition_id = r.json()['id']
-    helper.check_remaining_zenodo_requests(r)
 
-    # The target URL is a combination of the bucket link with the desired filename
-    for file in fileList:
-        filename = file.split('/')[-1]
-        with open(file, "rb") as fp:
-            r = requests.put(
-                "%s/%s" % (bucket_url, filename),
-                data=fp,
-                params=params,
-            )
-            helper.check_remaining_zenodo_requests(r)
+    # Upload in parallel, resuming any previous partial upload for this month
+    manifestFile = zenodo_uploader.get_manifest_filename('fit_nc', date)
+    deposition_id, failedFiles = zenodo_uploader.upload_files(
+        fileList, depositURL, accessToken, manifestFile)
+    if failedFiles:
+        print('{0} files failed to upload - rerun to resume deposition {1}'.format(
+            len(failedFiles), deposition_id))
+        return 1
 
     if date.year > helper.LATEST_PUBLIC_DATA:
         data = {
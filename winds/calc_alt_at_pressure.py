@@ -1,4 +1,4 @@
-from calc_ctmt_winds import calc_alt_at_pressure
+from calc_ctmt_winds import calc_alt_grid_at_pressure
 import numpy as np
 import datetime as dt
 import matplotlib.pyplot as plt
@@ -20,9 +20,8 @@ for year in years:
 for pi, pressure in enumerate(pressures):
     altmap = np.zeros((len(times), len(lats), len(lons)))
     for ti, time in enumerate(times):
-        for lati, lat in enumerate(lats):
-            for loni, lon in enumerate(lons):
-                altmap[ti, lati, loni] = calc_alt_at_pressure(time, lat, lon, pressure)
+        # One MSIS run per time, cached and reused across pressures
+        altmap[ti] = calc_alt_grid_at_pressure(time, lats, lons, pressure)
     alts[pi] = np.mean(altmap.ravel())
 
 
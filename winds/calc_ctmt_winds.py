@@ -7,6 +7,9 @@ from line_profiler import LineProfiler
 
 import nc_utils   # available from github.com/alexchartier/nc_utils
 import numpy as np
+import os
+import hashlib
+import tempfile
 from scipy.interpolate import CubicSpline
 import matplotlib.pyplot as plt
 import time
@@ -16,6 +19,10 @@ from pymsis import msis
 import xarray as xr
 import scipy as sp
 
+MSIS_CACHE_DIR = os.path.expanduser('~/data/msis/cache')
+msis_pressure_cache = {}  # memoized MSIS pressure grids, see load_msis_pressure_grid()
+
+
 def main(
     # diurnal and semidiurnal tidal filenames
     in_fn_sd='~/data/ctmt/ctmt_semidiurnal_2002_2008.nc',
@@ -82,42 +89,30 @@ def load_wind_coeffs(in_fn_d, in_fn_sd):
     return {'d': nc_utils.ncread_vars(in_fn_d), 's': nc_utils.ncread_vars(in_fn_sd)}
 
 
-def calc_full_wind_at_pressure_level(time, lats, lons, pressure, model_coeffs, plot=False):
-    """ returns a u+v lst/lat/lon distribution of model winds at specified alt and month """
+def calc_full_wind_at_pressure_level(time, lats, lons, pressure, model_coeffs, plot=False,
+                                     f107=None, f107a=None, ap=None, coeff_cache=None):
+    """ returns a u+v lst/lat/lon distribution of model winds at specified pressure (hPa) and month
+    coeff_cache: optional dict for reusing interpolated coefficients (see interp_wind_coeffs)
+    """
     month = time.month
     hours = np.arange(0, 25)
 
     comps = table_of_components()
     dirns = 'u', 'v'
 
+    # Altitude of the pressure level at each lat/lon - the same for all hours and directions
+    alts = calc_alt_grid_at_pressure(time, lats, lons, pressure, f107=f107, f107a=f107a, ap=ap)
+
     # Load the winds in LST 
-    wind_array_lst = np.zeros((len(dirns), len(hours), len(lats), len(lons)))
-    for il, lst in enumerate(hours):
-        for idn, dirn in enumerate(dirns):
-            for lati, lat in enumerate(lats):
-                for loni, lon in enumerate(lons):
-                    alt = calc_alt_at_pressure(time, lat, lon, pressure)
-                    #print(f'{lat} °N, {lon} °E, {alt:.1f} km')
-                    
-                    wind_component = calc_wind_component(
-                        lat, lon, alt, month, model_coeffs, comps, lst=lst, dirn=dirn)
-                    wind_array_lst[idn, il, lati, loni] = wind_component
+    wind_array_lst = eval_wind_lst(month, lats, lons, alts, model_coeffs, hours, comps, dirns, coeff_cache)
    
     # Convert to UT 
-    wind_array_ut = np.zeros_like(wind_array_lst)
-
-    for ilst, lst in enumerate(hours):
-        UTs = lst - lons * 24 / 360 
-        UTs[UTs < 0] += 24
-        for iut, ut in enumerate(hours):
-            lonidx = np.where(np.in1d(UTs, ut))[0]
-            wind_array_ut[:, iut, :, lonidx] = wind_array_lst[:, ilst, :, lonidx]
-    wind_array_ut[:, 24, :, :] = wind_array_ut[:, 0, :, :]
+    wind_array_ut = lst_to_ut(wind_array_lst, hours, lons)
     model = {
         'wind': wind_array_ut,
         'lats': lats,
         'lons': lons,
-        'UTs': UTs,
+        'UTs': hours,
     }
 
     return model
@@ -125,12 +120,88 @@ def calc_full_wind_at_pressure_level(time, lats, lons, pressure, model_coeffs, p
 
 
 def calc_alt_at_pressure(time, lat, lon, pressure, altitudes=np.arange(70, 120)):
-    msis_ds = load_msis(time, lat, lon, altitudes)
-    alt = sp.interpolate.interp1d(msis_ds['pressure'], altitudes)(pressure)
+    """ altitude (km) of a pressure level (hPa) at one location """
+    return calc_alt_grid_at_pressure(time, [lat], [lon], pressure, altitudes)[0, 0]
+
+
+def calc_alt_grid_at_pressure(time, lats, lons, pressure, altitudes=np.arange(70, 120),
+                              f107=None, f107a=None, ap=None, cache_dir=MSIS_CACHE_DIR):
+    """
+    altitude (km) of a pressure level (hPa) on a lat/lon grid, as a (lat, lon) array.
+    NaN where the level is outside the altitude column
+    f107, f107a, ap: solar/geomagnetic indices passed to MSIS (None: looked up by pymsis)
+    """
+    pressures = load_msis_pressure_grid(time, lats, lons, altitudes, f107, f107a, ap, cache_dir)
+    altitudes = np.asarray(altitudes, dtype=float)
+
+    # pressure falls with altitude - find the levels either side of the requested pressure
+    ind = np.clip(np.sum(pressures >= pressure, axis=-1) - 1, 0, len(altitudes) - 2)
+    p0 = np.take_along_axis(pressures, ind[..., None], axis=-1)[..., 0]
+    p1 = np.take_along_axis(pressures, ind[..., None] + 1, axis=-1)[..., 0]
+    alt = altitudes[ind] + (pressure - p0) / (p1 - p0) * (altitudes[ind + 1] - altitudes[ind])
+    alt[(pressure > pressures[..., 0]) | (pressure < pressures[..., -1])] = np.nan
 
     return alt
 
 
+def load_msis_pressure_grid(time, lats, lons, altitudes, f107=None, f107a=None, ap=None,
+                            cache_dir=MSIS_CACHE_DIR):
+    """
+    MSIS pressure (hPa) as a (lat, lon, alt) array from one MSIS run over the grid.
+    Memoized for the life of the process and saved to an .npz in cache_dir, keyed by
+    time, indices and grid
+    """
+    lats, lons, altitudes = [np.atleast_1d(np.asarray(v, dtype=float)) for v in (lats, lons, altitudes)]
+    key = hashlib.md5(repr((time.isoformat(), f107, f107a, ap,
+                            lats.tolist(), lons.tolist(), altitudes.tolist())).encode()).hexdigest()
+    if key in msis_pressure_cache:
+        return msis_pressure_cache[key]
+
+    cache_fn = os.path.join(cache_dir, 'msis_pressure_%s_%s.npz' % (
+        time.strftime('%Y%m%d%H%M'), key[:12])) if cache_dir else None
+    pressures = None
+    if cache_fn and os.path.isfile(cache_fn):
+        try:
+            with np.load(cache_fn) as npz:
+                pressures = npz['pressure']
+        except Exception as e:
+            print('Unable to read %s (%s) - rerunning MSIS' % (cache_fn, e))
+
+    if pressures is None:
+        msis_data = msis.run(
+            time, lons, lats, altitudes,
+            f107s=None if f107 is None else [f107],
+            f107as=None if f107a is None else [f107a],
+            aps=None if ap is None else [np.broadcast_to(ap, 7)],
+            geomagnetic_activity=-1,
+        )
+        # (time, lon, lat, alt, variable) -> (lat, lon, alt)
+        pressures = calc_msis_pressure(msis_data[0]).swapaxes(0, 1)
+        if cache_fn:
+            # write to a temporary file and move it into place, so readers never see a partial file
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, tmp_fn = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, pressure=pressures)
+            os.replace(tmp_fn, cache_fn)
+
+    msis_pressure_cache[key] = pressures
+    return pressures
+
+
+def calc_msis_pressure(msis_data):
+    """ pressure (hPa) from the number densities and temperature of MSIS output [..., variable] """
+    loschmidt_per_m3 = 2.686780111e25
+    zero_degrees_c_in_k = 273.15
+
+    # n2, o2, o, he, h, ar, n, anomalous_o, no
+    total_density = np.sum(np.nan_to_num(msis_data[..., 1:10]), axis=-1)
+    temperature = np.nan_to_num(msis_data[..., 10])
+    pressure_ratio = total_density * temperature / (loschmidt_per_m3 * zero_degrees_c_in_k)
+
+    return pressure_ratio * 1013.25
+
+
 
 def load_msis(time, lat, lon, altitudes):    
     """ load the MSIS model for a location """
@@ -178,31 +249,22 @@ def load_msis(time, lat, lon, altitudes):
 
 
 
-def calc_full_wind(month, lats, lons, alt, model_coeffs, plot=False):
-    """ returns a u+v lst/lat/lon distribution of model winds at specified alt and month """
+def calc_full_wind(month, lats, lons, alt, model_coeffs, plot=False, comps=None, coeff_cache=None):
+    """ returns a u+v lst/lat/lon distribution of model winds at specified alt and month
+    comps: subset of table_of_components() to sum (default: all)
+    coeff_cache: optional dict for reusing interpolated coefficients (see interp_wind_coeffs)
+    """
     hours = np.arange(0, 25)
 
-    comps = table_of_components()
+    if comps is None:
+        comps = table_of_components()
     dirns = 'u', 'v'
 
     # Load the winds in LST 
-    wind_array_lst = np.zeros((len(dirns), len(hours), len(lats), len(lons)))
-    for il, lst in enumerate(hours):
-        for idn, dirn in enumerate(dirns):
-            wind_component = calc_wind_component(
-                lats, lons, alt, month, model_coeffs, comps, lst=lst, dirn=dirn)
-            wind_array_lst[idn, il, :, :] = wind_component
+    wind_array_lst = eval_wind_lst(month, lats, lons, alt, model_coeffs, hours, comps, dirns, coeff_cache)
    
     # Convert to UT 
-    wind_array_ut = np.zeros_like(wind_array_lst)
-
-    for ilst, lst in enumerate(hours):
-        UTs = lst - lons * 24 / 360 
-        UTs[UTs < 0] += 24
-        for iut, ut in enumerate(hours):
-            lonidx = np.where(np.in1d(UTs, ut))[0]
-            wind_array_ut[:, iut, :, lonidx] = wind_array_lst[:, ilst, :, lonidx]
-    wind_array_ut[:, 24, :, :] = wind_array_ut[:, 0, :, :]
+    wind_array_ut = lst_to_ut(wind_array_lst, hours, lons)
 
     if plot: 
         for iut, ut in enumerate(hours):
@@ -225,6 +287,127 @@ def calc_full_wind(month, lats, lons, alt, model_coeffs, plot=False):
     return wind
 
 
+def lst_to_ut(wind_array_lst, hours, lons):
+    """
+    regrid a [..., hour, lat, lon] array from LST to UT on the same hours
+    hours: ascending and spanning one day (e.g. 0-24). UT hours that fall between LST grid
+    hours are linearly interpolated, so any lon spacing works; on whole-hour offsets
+    (lons every 15 deg for hourly grids) it is an exact shift per longitude
+    """
+    hours = np.asarray(hours, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+
+    # LST of each (UT, lon), wrapped into the hour grid
+    lst = np.mod(hours[:, None] + lons[None, :] * 24 / 360 - hours[0], 24) + hours[0]
+    ind = np.clip(np.searchsorted(hours, lst, side='right') - 1, 0, len(hours) - 2)
+    weight = (lst - hours[ind]) / (hours[ind + 1] - hours[ind])
+    lon_ind = np.arange(len(lons))
+
+    # [..., lat, hour, lon] so the (UT, lon) indices are the trailing axes
+    wind = np.swapaxes(wind_array_lst, -3, -2)
+    wind_ut = wind[..., ind, lon_ind] * (1 - weight) + wind[..., ind + 1, lon_ind] * weight
+
+    return np.swapaxes(wind_ut, -3, -2)
+
+
+def eval_wind_lst(month, lats, lons, alt, model_coeffs, lsts, comps=None, dirns=('u', 'v'), coeff_cache=None):
+    """
+    Sum of all tidal components at every (dirn, lst, lat, lon) in one go - same
+    result as calling calc_wind_component for each lst and dirn.
+    alt is in km, either a scalar or a (lat, lon) array
+
+    amp * cos(theta - phi) = amp cos(phi) cos(theta) + amp sin(phi) sin(theta), where
+    theta depends on (component, lst, lon) and phi on (dirn, component, lat), so
+    the sum over components is two tensor contractions
+    """
+    if comps is None:
+        comps = table_of_components()
+    coeffs = interp_wind_coeffs(model_coeffs, month, alt, lats, comps, dirns, coeff_cache)
+    lsts = np.atleast_1d(lsts).astype(float)
+    lons = np.atleast_1d(lons).astype(float)
+
+    # theta: (component, lst, lon)
+    hour = lsts[:, None] - lons[None, :] / 360 * 24
+    theta = coeffs['ds_multiplier'][:, None, None] * np.pi / 12. * hour[None, :, :] - \
+        (coeffs['dirn_multiplier'] * coeffs['wavenumber'])[:, None, None] * lons[None, None, :] * np.pi / 180.
+
+    # phi: (dirn, component, lat) or (dirn, component, lat, lon)
+    ds_multiplier = coeffs['ds_multiplier'].reshape((1, -1) + (1,) * (coeffs['phase'].ndim - 2))
+    phi = coeffs['phase'] * ds_multiplier * np.pi / 12
+    amp_cos = coeffs['amp'] * np.cos(phi)
+    amp_sin = coeffs['amp'] * np.sin(phi)
+
+    subscripts = 'dcl,chn->dhln' if amp_cos.ndim == 3 else 'dcln,chn->dhln'
+    return np.einsum(subscripts, amp_cos, np.cos(theta)) + np.einsum(subscripts, amp_sin, np.sin(theta))
+
+
+def interp_wind_coeffs(model_coeffs, month, alt, lats, comps=None, dirns=('u', 'v'), coeff_cache=None):
+    """
+    Amplitudes and phases of every component at alt for one month, as (dirn, component, lat)
+    arrays, plus each component's diurnal/semidiurnal, direction and wavenumber multipliers.
+    alt may also be a (lat, lon) array, giving (dirn, component, lat, lon) amplitudes and phases.
+
+    coeff_cache: optional dict, keyed on (month, alt, lats, comps, dirns), that belongs to
+    this model_coeffs. Only reuse it with the same, unmodified coefficients - use a new
+    dict (or none) for scaled or edited copies
+    """
+    if comps is None:
+        comps = table_of_components()
+    if coeff_cache is not None:
+        lats_key = tuple(np.atleast_1d(lats).tolist())
+        alt_key = float(alt) if np.ndim(alt) == 0 else (np.shape(alt), np.asarray(alt, dtype=float).tobytes())
+        key = (month, alt_key, lats_key, repr(comps), tuple(dirns))
+        if key in coeff_cache:
+            return coeff_cache[key]
+
+    amp, phase, ds_multiplier, dirn_multiplier, wavenumber = [], [], [], [], []
+    for ds, comp_list in comps.items():
+        coeffs = model_coeffs[ds]
+        mi = coeffs['month'] == month
+        li = np.isin(coeffs['lat'], lats).ravel()
+        # [month, lev, lat] indexed with two boolean masks gives (lat, lev)
+        amp_ds = np.array([[coeffs['amp_%s_%s' % (comp, dirn)][mi, :, li] for dirn in dirns]
+                           for comp in comp_list])
+        phase_ds = np.array([[coeffs['phase_%s_%s' % (comp, dirn)][mi, :, li] for dirn in dirns]
+                             for comp in comp_list])
+
+        # (component, dirn, lat, lev) -> (component, dirn, lat) at alt, or (component, dirn, lat, lon)
+        lev = np.asarray(coeffs['lev']).ravel()
+        if np.ndim(alt) == 0:
+            amp_phase = sp.interpolate.interp1d(lev, np.stack([amp_ds, phase_ds]))(alt)
+        else:
+            amp_phase = interp_lev(lev, np.stack([amp_ds, phase_ds]), alt)
+        amp.append(amp_phase[0])
+        phase.append(amp_phase[1])
+        for comp in comp_list:
+            ds_multiplier.append({'d': 1, 's': 2}[ds])
+            dirn_multiplier.append({'e': 1, 'w': -1, 's': 0}[comp[0]])
+            wavenumber.append(int(comp[1]))
+
+    amp_phase = np.concatenate(amp), np.concatenate(phase)
+    result = {
+        'amp': amp_phase[0].swapaxes(0, 1),
+        'phase': amp_phase[1].swapaxes(0, 1),
+        'ds_multiplier': np.array(ds_multiplier),
+        'dirn_multiplier': np.array(dirn_multiplier),
+        'wavenumber': np.array(wavenumber),
+    }
+    if coeff_cache is not None:
+        coeff_cache[key] = result
+    return result
+
+
+def interp_lev(lev, vals, alts):
+    """ linear interpolation of vals [..., lat, lev] to a (lat, lon) array of altitudes. NaN outside lev """
+    alts = np.asarray(alts, dtype=float)
+    ind = np.clip(np.searchsorted(lev, alts) - 1, 0, len(lev) - 2)
+    weight = (alts - lev[ind]) / (lev[ind + 1] - lev[ind])
+    weight[~((alts >= lev[0]) & (alts <= lev[-1]))] = np.nan
+    lat_ind = np.arange(alts.shape[0])[:, None]
+
+    return vals[..., lat_ind, ind] * (1 - weight) + vals[..., lat_ind, ind + 1] * weight
+
+
 def calc_wind_component(lats, lons, alt, month, model_coeffs, comps, lst=18, dirn='u'):
     """
     compare against https://agupubs.onlinelibrary.wiley.com/doi/epdf/10.1029/2011JA016784
@@ -14,18 +14,26 @@ from itertools import islice
 from line_profiler import LineProfiler
 import nc_utils   # available from github.com/alexchartier/nc_utils
 import numpy as np
+import os
+import hashlib
 import copy
+from concurrent.futures import ProcessPoolExecutor
 from scipy.interpolate import RegularGridInterpolator
-from scipy.optimize import minimize, direct, Bounds
+from scipy.optimize import minimize, direct, Bounds, OptimizeResult
 import matplotlib.pyplot as plt
 import datetime as dt
 from cartopy import config
 import cartopy.crs as ccrs
 import calc_ctmt_winds
 import sd_utils
+import meteorproc_to_nc
 
 hr = np.arange(0, 24)
 
+NUM_WORKERS = os.cpu_count()
+SD_CACHE_DIR = os.path.expanduser('~/data/superdarn/meteorwindnc/cache')
+sd_cube_cache = {}  # memoized monthly SD wind cubes, see load_sd_month_cube()
+
 
 def main(
     # Model params
@@ -35,6 +43,7 @@ def main(
 
     # SuperDARN meteor wind data
     sd_fn_fmt='~/data/superdarn/meteorwindnc/%Y/%m/%Y%b%d.{}.nc',
+    sd_month_fn_fmt='~/data/superdarn/meteorwindnc/%Y/%m/%Y%b.{}.nc',  # consolidated, used if present
 
     # SD hdw.dat dir
     hdw_dat_dir='~/rst/tables/superdarn/hdw/',
@@ -55,35 +64,34 @@ def main(
     """ ICON comparison """
     year = 2020
     #site_model_comparison(year, 9, sd_fn_fmt, 'fhe', lats, lons, alt, icon_fn_fmt)
-    #icon_sd_comparison(year, sd_fn_fmt, radar_list, lats, lons, alt, icon_fn_fmt)
+    #icon_sd_comparison(year, sd_fn_fmt, radar_list, lats, lons, alt, icon_fn_fmt, sd_month_fn_fmt=sd_month_fn_fmt)
 
     """ CTMT comparisons """
     # radar-by-radar comparison to CTMT
     year = 2008 
     #site_model_comparison(year, 10, sd_fn_fmt, 'sys', lats, lons, alt, ctmt_coeffs)
-    #scores_by_radar = radar_by_radar_comparison(year, sd_fn_fmt, radar_list, lats, lons, alt, ctmt_coeffs)
+    #scores_by_radar = radar_by_radar_comparison(year, sd_fn_fmt, radar_list, lats, lons, alt, ctmt_coeffs,
+    #                                            sd_month_fn_fmt=sd_month_fn_fmt)
 
     # Compare all months of the radar data against all months of CTMT
     time = dt.datetime(year, 1, 1)
-    scores_matrix = ctmt_sd_comparison(time, sd_fn_fmt, radar_list, lats, lons, pressure, ctmt_coeffs)
+    scores_matrix = ctmt_sd_comparison(time, sd_fn_fmt, radar_list, lats, lons, pressure, ctmt_coeffs,
+                                       sd_month_fn_fmt=sd_month_fn_fmt)
 
     """ fitting """
     #fit_test(year, sd_fn_fmt, radar_list, lats, lons, alt, ctmt_coeffs)
 
 
-def icon_sd_comparison(year, sd_fn_fmt, radar_list, lats, lons, alt, icon_fn_fmt):
+def icon_sd_comparison(year, sd_fn_fmt, radar_list, lats, lons, alt, icon_fn_fmt,
+                       sd_month_fn_fmt=None, num_workers=NUM_WORKERS):
     """ matrix evaluation of all months of SD vs all months of model """
 
-    scores = np.zeros((12, len(radar_list))) * np.nan
-    for i, month in enumerate(range(1, 13)):
-        print(month)
-        time = dt.datetime(year, month, 15)
-        sd_wind = load_sd_wind(year, month, sd_fn_fmt, radar_list)
-        icon = eval_icon_hme(time.strftime(icon_fn_fmt), lats, lons, alt, hr)
-        for j, radar in enumerate(radar_list):
-            if radar in sd_wind.keys():
-                radar_wind = {radar: sd_wind[radar]}
-                scores[i, j] = calc_weighted_rmse(icon, radar_wind)
+    months = [(year, month) for month in range(1, 13)]
+    sd_winds = load_sd_months(months, sd_fn_fmt, radar_list, sd_month_fn_fmt=sd_month_fn_fmt)
+    icons = eval_models(eval_icon_hme, [
+        (dt.datetime(year, month, 15).strftime(icon_fn_fmt), lats, lons, alt, hr) for year, month in months
+    ], num_workers=num_workers)
+    scores = radar_scores(sd_winds, icons, radar_list, num_workers=num_workers)
 
     available_data_idx = np.isfinite(np.nanmean(scores, axis=0)) 
     scores = scores[:, available_data_idx]
@@ -117,18 +125,16 @@ def site_model_comparison(year, month, sd_fn_fmt, radarcode, lats, lons, alt, mo
     plot_median_wind(sd_wind, radarcode, model=model_wind[radarcode]['model'])
 
 
-def radar_by_radar_comparison(year, sd_fn_fmt, radar_list, lats, lons, alt, model_coeffs):
+def radar_by_radar_comparison(year, sd_fn_fmt, radar_list, lats, lons, alt, model_coeffs,
+                              sd_month_fn_fmt=None, num_workers=NUM_WORKERS):
     """ radar by radar evaluation of SD winds vs CTMT model """
 
-    scores = np.zeros((12, len(radar_list))) * np.nan
-    for i, sdmonth in enumerate(range(1, 13)):
-        sd_wind = load_sd_wind(year, sdmonth, sd_fn_fmt, radar_list)
-        model = calc_ctmt_winds.calc_full_wind(
-            sdmonth, lats, lons, alt, model_coeffs)  # CTMT winds on a grid
-        for j, radar in enumerate(radar_list):
-            if radar in sd_wind.keys():
-                radar_wind = {radar: sd_wind[radar]}
-                scores[i, j] = calc_weighted_rmse(model, radar_wind)
+    months = [(year, month) for month in range(1, 13)]
+    sd_winds = load_sd_months(months, sd_fn_fmt, radar_list, sd_month_fn_fmt=sd_month_fn_fmt)
+    models = eval_models(calc_ctmt_winds.calc_full_wind, [
+        (month, lats, lons, alt, model_coeffs) for year, month in months  # CTMT winds on a grid
+    ], num_workers=num_workers)
+    scores = radar_scores(sd_winds, models, radar_list, num_workers=num_workers)
 
     available_data_idx = np.isfinite(np.nanmean(scores, axis=0)) 
     scores = scores[:, available_data_idx]
@@ -147,22 +153,17 @@ def radar_by_radar_comparison(year, sd_fn_fmt, radar_list, lats, lons, alt, mode
     return scores
 
 
-def ctmt_sd_comparison(time, sd_fn_fmt, radar_list, lats, lons, pressure, model_coeffs):
+def ctmt_sd_comparison(time, sd_fn_fmt, radar_list, lats, lons, pressure, model_coeffs,
+                       sd_month_fn_fmt=None, num_workers=NUM_WORKERS):
     """ matrix evaluation of all months of SD vs all months of model """
 
-    components = calc_ctmt_winds.table_of_components()
-    # coefficients for amplitude of each component in U and V
-    X0 = np.zeros(len(components['d'] + components['s']))
-
-    scores = np.zeros((12, 12))
-    for i, sdmonth in enumerate(range(1, 13)):
-        sd_wind = load_sd_wind(time.year, sdmonth, sd_fn_fmt, radar_list)
-        for j, mmonth in enumerate(range(1, 13)):
-
-            model = calc_ctmt_winds.calc_full_wind_at_pressure_level(
-                time, lats, lons, pressure, model_coeffs)  # model winds on a grid
-
-            scores[i, j] = calc_weighted_rmse(model, sd_wind)
+    # SD data and model grids once per month, then one scoring task per model column
+    months = [(time.year, month) for month in range(1, 13)]
+    sd_winds = load_sd_months(months, sd_fn_fmt, radar_list, sd_month_fn_fmt=sd_month_fn_fmt)
+    models = eval_models(calc_ctmt_winds.calc_full_wind_at_pressure_level, [
+        (time.replace(month=month), lats, lons, pressure, model_coeffs) for year, month in months
+    ], num_workers=num_workers)  # model winds on a grid
+    scores = score_matrix(sd_winds, models, num_workers=num_workers)
 
     fig, ax = plt.subplots()
     heatmap = ax.pcolor(scores, edgecolors='w', vmin=0, vmax=30)
@@ -177,6 +178,44 @@ def ctmt_sd_comparison(time, sd_fn_fmt, radar_list, lats, lons, pressure, model_
     return scores
 
 
+def load_sd_months(months, sd_fn_fmt, radar_list, sd_month_fn_fmt=None):
+    """ load_sd_wind() for each (year, month) in months - may span several years """
+    return [load_sd_wind(year, month, sd_fn_fmt, radar_list, sd_month_fn_fmt=sd_month_fn_fmt)
+            for year, month in months]
+
+
+def eval_models(model_fn, arg_list, num_workers=1):
+    """ model grids from model_fn(*args) for each args in arg_list, on a process pool if num_workers > 1 """
+    if num_workers == 1:
+        return [model_fn(*args) for args in arg_list]
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        return list(executor.map(model_fn, *zip(*arg_list)))
+
+
+def score_model(model, sd_winds):
+    """ calc_weighted_rmse() of one model grid against each SD wind dict. NaN where there is no SD data """
+    return np.array([calc_weighted_rmse(model, sd_wind) if sd_wind else np.nan for sd_wind in sd_winds])
+
+
+def score_models(models, sd_wind_lists, num_workers=NUM_WORKERS):
+    """ score_model() of each model grid against its list of SD winds, one pool task (and one pickled grid) per model """
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        return list(executor.map(score_model, models, sd_wind_lists))
+
+
+def score_matrix(sd_winds, models, num_workers=NUM_WORKERS):
+    """ scores of every SD month (rows) against every model grid (columns) """
+    columns = score_models(models, [sd_winds] * len(models), num_workers)
+    return np.stack(columns, axis=1)
+
+
+def radar_scores(sd_winds, models, radar_list, num_workers=NUM_WORKERS):
+    """ scores of each radar (columns) against the model grid of the same month (rows) """
+    radar_winds = [[{radar: sd_wind[radar]} if radar in sd_wind else {} for radar in radar_list]
+                   for sd_wind in sd_winds]
+    return np.stack(score_models(models, radar_winds, num_workers))
+
+
 def fit_test(year, sd_fn_fmt, radar_list, lats, lons, alt, model_coeffs,
              valsites=['gbr', 'kod', 'hok'],
              badsites=['inv'],
@@ -280,10 +319,15 @@ def plot_errors(errs, fitted=None, ylim=[-30, 30]):
     plt.show()
 
 
-def fit_model(year, lats, lons, alt, month, model_coeffs, sd_wind):
+def fit_model(year, lats, lons, alt, month, model_coeffs, sd_wind, method='wls'):
     """ calculate a tidal fit that best matches the SuperDARN data 
     Use scaling factors to vary the coefficient amplitudes (6x diurnal, 8x semidiurnal
     How to vary phases??
+
+    The model wind is linear in the scaling factors, so the default 'wls' solves
+    the weighted least-squares problem directly from calc_component_basis().
+    Other methods go to scipy.optimize.minimize with linear_cost_function()
+    and its gradient, or 'powell' for the original full-model search
     """
 
     time = dt.datetime(year, month, 1)
@@ -297,8 +341,15 @@ def fit_model(year, lats, lons, alt, month, model_coeffs, sd_wind):
     # coefficients for amplitude of each component in U and V
     X0 = np.zeros(len(components['d'] + components['s']))
 
-    result = powell_search(cost_function, X0, model_coeffs,
-                           month, lats, lons, alt, sd_wind)
+    if method == 'powell':
+        result = powell_search(cost_function, X0, model_coeffs,
+                               month, lats, lons, alt, sd_wind)
+    else:
+        basis = calc_component_basis(month, lats, lons, alt, model_coeffs, sd_wind)
+        if method == 'wls':
+            result = wls_fit(basis)
+        else:
+            result = minimize(linear_cost_function, X0, args=(basis,), jac=True, method=method)
     print('**********')
     print(result.x)
     print('Final cost: %1.1f' % result.fun)
@@ -309,6 +360,59 @@ def fit_model(year, lats, lons, alt, month, model_coeffs, sd_wind):
     return fitted_model_coeffs, result.x
 
 
+def calc_component_basis(month, lats, lons, alt, model_coeffs, sd_wind):
+    """ 
+    Boresight wind of each tidal component at every radar/hour with data, for linear fitting.
+    Columns follow the order of X in scale_model(), so the model boresight wind for
+    scaling factors X is G @ (1 + X), the same as cost_function() gets via the full model
+    """
+    components = calc_ctmt_winds.table_of_components()
+
+    columns = []
+    for ds in 'd', 's':  # diurnal/semidiurnal
+        for component in components[ds]:  # wave component
+            model = calc_ctmt_winds.calc_full_wind(
+                month, lats, lons, alt, model_coeffs, comps={ds: [component]})
+            wind = get_model_wind_at_sd_locs(model, sd_wind)
+            columns.append(np.concatenate([vals['model'] for vals in wind.values()]))
+    G = np.stack(columns, axis=1)
+
+    obs = np.concatenate([vals['obs_med'] for vals in sd_wind.values()])
+    obs_errs = np.concatenate([vals['obs_std'] for vals in sd_wind.values()])
+    finidx = np.isfinite(obs)
+
+    # normalised as in calc_weighted_rmse()
+    norm_obs_errs = obs_errs[finidx] / np.mean(obs_errs[finidx])
+    G, obs = G[finidx], obs[finidx]
+    fitidx = np.all(np.isfinite(G), axis=1)
+
+    return {
+        'G': G[fitidx],
+        'obs': obs[fitidx],
+        'norm_obs_errs': norm_obs_errs[fitidx],
+    }
+
+
+def linear_cost_function(X, basis):
+    """ calc_weighted_rmse() of the scaled model and its gradient with respect to X """
+    weights = 1 / basis['norm_obs_errs']
+    resid = (basis['obs'] - basis['G'] @ (1 + X)) * weights
+    cost = np.sqrt(np.mean(resid ** 2))
+    grad = -(basis['G'] * weights[:, None]).T @ resid / (len(resid) * cost)
+
+    return cost, grad
+
+
+def wls_fit(basis):
+    """ Closed-form weighted least-squares scaling factors. Unconstrained components stay at X=0 """
+    weights = 1 / basis['norm_obs_errs']
+    resid0 = basis['obs'] - basis['G'].sum(axis=1)
+    X = np.linalg.lstsq(basis['G'] * weights[:, None], resid0 * weights, rcond=None)[0]
+    cost, _ = linear_cost_function(X, basis)
+
+    return OptimizeResult(x=X, fun=cost, success=True)
+
+
 def cost_function(X, model_coeffs, month, lats, lons, alt, sd_wind):
     # Update the coefficients according to X
     fitted_model_coeffs = scale_model(model_coeffs, X)
@@ -370,38 +474,25 @@ def powell_search(cost_function, X0, model_coeffs, month, lats, lons, alt, sd_wi
     return result
 
 
-def load_sd_wind(year, month, sd_fn_fmt, radar_list, qc=True):
+def load_sd_wind(year, month, sd_fn_fmt, radar_list, qc=True, sd_month_fn_fmt=None,
+                 cache_dir=SD_CACHE_DIR):
     """ 
     loads a month of SuperDARN wind data 
+    The raw winds come from load_sd_month_cube(), which is cached
     See also: plot_median_wind()
     """
+    cube = load_sd_month_cube(year, month, sd_fn_fmt, radar_list, sd_month_fn_fmt, cache_dir)
     wind = {}
-    for radarcode in radar_list:
+    for ri, radarcode in enumerate(radar_list):
         wind[radarcode] = {}
-        zeroarr = np.zeros((31, 24)) * np.nan
-        wind[radarcode]['obs_daily'] = zeroarr.copy()
+        wind[radarcode]['obs_daily'] = cube['obs_daily'][ri].copy()
         wind[radarcode]['hour'] = hr
-        time = dt.datetime(year, month, 1)
-        dayct = 0
         wind[radarcode]['year'] = year
         wind[radarcode]['month'] = month
-        while time.month == month:
-
-            # Load the SuperDARN wind
-            try:
-                sd = nc_utils.load_nc(time.strftime(
-                    sd_fn_fmt.format(radarcode)))
-            except:
-                time += dt.timedelta(days=1)
-                continue
-
-            hridx = np.isin(hr, sd.variables['hour'][:])
-            wind[radarcode]['obs_daily'][dayct, hridx] = sd.variables['Vx'][:]
-            wind[radarcode]['lat'] = sd.lat
-            wind[radarcode]['lon'] = sd.lon
-            wind[radarcode]['boresight'] = float(sd.boresight.split()[0])
-            time += dt.timedelta(days=1)
-            dayct += 1
+        if np.isfinite(cube['lat'][ri]):
+            wind[radarcode]['lat'] = cube['lat'][ri]
+            wind[radarcode]['lon'] = cube['lon'][ri]
+            wind[radarcode]['boresight'] = cube['boresight'][ri]
 
         # Remove >100 m/s data-points
         wind[radarcode]['obs_daily'][np.abs(wind[radarcode]['obs_daily']) > 100] *= np.nan
@@ -450,6 +541,107 @@ def load_sd_wind(year, month, sd_fn_fmt, radar_list, qc=True):
     return wind
 
 
+def load_sd_month_cube(year, month, sd_fn_fmt, radar_list, sd_month_fn_fmt=None,
+                       cache_dir=SD_CACHE_DIR):
+    """
+    Month of SuperDARN winds as a (radar x day x hour) Vx cube plus each radar's
+    lat/lon/boresight. Cubes are memoized for the life of the process and saved to an
+    .npz in cache_dir, which is reused while the files it was read from are unchanged
+    """
+    time = dt.datetime(year, month, 1)
+    days = []
+    while time.month == month:
+        days.append(time)
+        time += dt.timedelta(days=1)
+
+    key = hashlib.md5(repr((year, month, sd_fn_fmt, sd_month_fn_fmt, list(radar_list))).encode()).hexdigest()
+    if key in sd_cube_cache:
+        return sd_cube_cache[key]
+
+    # The files each radar is read from, and their modification times (-1 if absent).
+    # A consolidated month file (meteorproc_to_nc.py) replaces the radar's daily files,
+    # which are then not touched at all
+    month_fns = {}
+    sources = []
+    mtimes = []
+    for radarcode in radar_list:
+        month_fn = os.path.expanduser(days[0].strftime(sd_month_fn_fmt.format(radarcode))) \
+            if sd_month_fn_fmt else None
+        month_mtime = file_mtime(month_fn) if month_fn else -1.
+        if month_mtime >= 0:
+            month_fns[radarcode] = month_fn
+            sources.append(month_fn)
+            mtimes.append(month_mtime)
+            continue
+        for day in days:
+            day_fn = os.path.expanduser(day.strftime(sd_fn_fmt.format(radarcode)))
+            sources.append(day_fn)
+            mtimes.append(file_mtime(day_fn))
+    sources = np.array(sources)
+    mtimes = np.array(mtimes)
+
+    cache_fn = os.path.join(cache_dir, 'sd_wind_%04i%02i_%s.npz' % (year, month, key[:12])) if cache_dir else None
+    if cache_fn and os.path.isfile(cache_fn):
+        try:
+            with np.load(cache_fn) as npz:
+                cube = {k: npz[k] for k in npz.files}
+        except Exception as e:
+            print('Unable to read %s (%s) - rebuilding' % (cache_fn, e))
+            cube = {}
+        if np.array_equal(cube.get('sources'), sources) and np.array_equal(cube.get('mtimes'), mtimes):
+            sd_cube_cache[key] = cube
+            return cube
+
+    cube = {
+        'radars': np.array(radar_list),
+        'obs_daily': np.full((len(radar_list), 31, 24), np.nan),
+        'lat': np.full(len(radar_list), np.nan),
+        'lon': np.full(len(radar_list), np.nan),
+        'boresight': np.full(len(radar_list), np.nan),
+        'sources': sources,
+        'mtimes': mtimes,
+    }
+    for ri, radarcode in enumerate(radar_list):
+        # One file open per month where there is a consolidated file
+        if radarcode in month_fns:
+            sd, atts = meteorproc_to_nc.load_consolidated(month_fns[radarcode])
+            cube['obs_daily'][ri, :sd['Vx'].shape[0]] = sd['Vx']
+            cube['lat'][ri] = atts['lat']
+            cube['lon'][ri] = atts['lon']
+            cube['boresight'][ri] = float(atts['boresight'].split()[0])
+            continue
+
+        for di, day in enumerate(days):
+            # Load the SuperDARN wind
+            try:
+                sd = nc_utils.load_nc(day.strftime(sd_fn_fmt.format(radarcode)))
+            except:
+                continue
+
+            hridx = np.isin(hr, sd.variables['hour'][:])
+            cube['obs_daily'][ri, di, hridx] = sd.variables['Vx'][:]
+            cube['lat'][ri] = sd.lat
+            cube['lon'][ri] = sd.lon
+            cube['boresight'][ri] = float(sd.boresight.split()[0])
+
+    if cache_fn:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_fn = '%s.%s.tmp' % (cache_fn, sd_utils.get_random_string(8))
+        with open(tmp_fn, 'wb') as f:
+            np.savez(f, **cube)
+        os.replace(tmp_fn, cache_fn)
+    sd_cube_cache[key] = cube
+    return cube
+
+
+def file_mtime(fn):
+    """ Modification time of fn, or -1 if it does not exist """
+    try:
+        return os.stat(fn).st_mtime
+    except OSError:
+        return -1.
+
+
 def get_model_wind_at_sd_locs(model, wind):
     """ Calculate the model wind in the boresight direction at the radar locations 
     """
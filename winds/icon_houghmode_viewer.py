@@ -16,6 +16,7 @@ import matplotlib.pyplot as plt
 import matplotlib as mpl
 import glob
 import numpy as np
+from functools import lru_cache
 from scipy import interpolate
 import pandas as pd
 import xarray as xr
@@ -23,6 +24,20 @@ import xarray as xr
 mpl.rcParams['figure.dpi'] = 120
 #  plt.style.use('seaborn')
 
+HME_CACHE_SIZE = 8  # number of loaded HME files kept, see load_hme()
+
+# variable name parts for each tide's frequency (day^-1) and zonal wavenumber
+NSTR = {1: 'D',
+        2: 'SD'}
+SSTR = {-4: 'E4',
+        -3: 'E3',
+        -2: 'E2',
+        -1: 'E1',
+        0: 'S0',
+        1: 'W1',
+        2: 'W2',
+        3: 'W3', }
+
 
 def main():
     # Specify the HME filename
@@ -100,82 +115,100 @@ def eval_hme(fn_hme, ntide, stide, glats, glons, alts, thr):
     * v      - [m/s] 1D array of meridional winds
     '''
 
-    fn_hme = os.path.abspath(os.path.expanduser(fn_hme))
     assert len(glats) == len(
         glons), "Input arrays glats, glons, alts must be the same length"
     assert len(glats) == len(
         alts), "Input arrays glats, glons, alts must be the same length"
-    assert os.path.exists(fn_hme), 'File not found: %s' % fn_hme
-
     if np.nanmean(alts) < 10e3:
         print('WARNING: Are you sure altitude is specified in meters?')
 
-    ds = xr.open_dataset(fn_hme)
-
-    # Find the variable names of interest
-    nstr = {1: 'D',
-            2: 'SD'}
-    sstr = {-4: 'E4',
-            -3: 'E3',
-            -2: 'E2',
-            -1: 'E1',
-            0: 'S0',
-            1: 'W1',
-            2: 'W2',
-            3: 'W3', }
-
-    var_amp_u = '%sAMP_%s_U' % (nstr[ntide], sstr[stide])
-    var_amp_v = '%sAMP_%s_V' % (nstr[ntide], sstr[stide])
-    var_phase_u = '%sPHASE_%s_U' % (nstr[ntide], sstr[stide])
-    var_phase_v = '%sPHASE_%s_V' % (nstr[ntide], sstr[stide])
-
-    if var_amp_u in ds.variables:
-
-        # Create interpolation objects using alt [m] and geog lat [deg].
-        # Interpolating amplitude and phase is problematic. Interpolate real and imaginary parts instead.
-        phu = -2 * np.pi * ntide / 24. * ds[var_phase_u]
-        phv = -2 * np.pi * ntide / 24. * ds[var_phase_v]
-        u_re_0 = ds[var_amp_u] * np.cos(phu)
-        u_im_0 = ds[var_amp_u] * np.sin(phu)
-        v_re_0 = ds[var_amp_v] * np.cos(phv)
-        v_im_0 = ds[var_amp_v] * np.sin(phv)
-
-        u_re_i = interpolate.RegularGridInterpolator(
-            (1e3 * ds.Altitude.values, ds.Latitude.values), u_re_0.values, method='linear', bounds_error=False, fill_value=np.nan)
-        u_im_i = interpolate.RegularGridInterpolator(
-            (1e3 * ds.Altitude.values, ds.Latitude.values), u_im_0.values, method='linear', bounds_error=False, fill_value=np.nan)
-        v_re_i = interpolate.RegularGridInterpolator(
-            (1e3 * ds.Altitude.values, ds.Latitude.values), v_re_0.values, method='linear', bounds_error=False, fill_value=np.nan)
-        v_im_i = interpolate.RegularGridInterpolator(
-            (1e3 * ds.Altitude.values, ds.Latitude.values), v_im_0.values, method='linear', bounds_error=False, fill_value=np.nan)
-
-        pts = np.vstack((alts, glats)).T
-        u_re = u_re_i(pts)
-        u_im = u_im_i(pts)
-        v_re = v_re_i(pts)
-        v_im = v_im_i(pts)
-
-        u_amp = np.sqrt(u_re**2 + u_im**2)
-        v_amp = np.sqrt(v_re**2 + v_im**2)
-        u_ph_rad = np.arctan2(u_im, u_re)  # phase in radians
-        v_ph_rad = np.arctan2(v_im, v_re)
-        # phase in hours (analogous to what's in the original HME file)
-        u_ph = -24. / (2 * np.pi * ntide) * u_ph_rad
-        # phase in hours (analogous to what's in the original HME file)
-        v_ph = -24. / (2 * np.pi * ntide) * v_ph_rad
-
-        u = u_amp * np.cos(2 * np.pi * ntide / 24. *
-                           (thr - u_ph) + stide * glons * np.pi / 180.)
-        v = v_amp * np.cos(2 * np.pi * ntide / 24. *
-                           (thr - v_ph) + stide * glons * np.pi / 180.)
-
-    else:
-        u = np.zeros(len(glats))
-        v = np.zeros(len(glats))
-
-    del ds
-
-    return u, v
+    hme = load_hme(os.path.abspath(os.path.expanduser(fn_hme)))
+    if (ntide, stide) not in hme['tides']:
+        return np.zeros(len(glats)), np.zeros(len(glats))
+
+    ti = hme['tides'].index((ntide, stide))
+    coeffs = interp_hme(hme, glats, alts)[:, ti, :]  # (point, dirn)
+    phase = 2 * np.pi * ntide / 24. * np.asarray(thr) + stide * np.asarray(glons) * np.pi / 180.
+    wind = np.real(coeffs * np.exp(1j * phase)[:, None])
+
+    return wind[:, 0], wind[:, 1]
+
+
+@lru_cache(maxsize=HME_CACHE_SIZE)
+def load_hme(fn_hme):
+    '''
+    Read every tide available in an ICON L4.1 HME file and build one interpolator
+    for all of them. The file is opened once, and the most recent HME_CACHE_SIZE
+    files are kept in memory.
+
+    Interpolating amplitude and phase is problematic, so the real and imaginary
+    parts of amp * exp(-i 2 pi n phase / 24) are interpolated instead.
+
+    RETURNS a dict with:
+    * tides  - list of available (ntide, stide)
+    * interp - RegularGridInterpolator over (alt [m], lat [deg]), giving [..., tide, dirn (u/v), re/im]
+    '''
+    assert os.path.exists(fn_hme), 'File not found: %s' % fn_hme
+
+    tides = []
+    values = []
+    with xr.open_dataset(fn_hme) as ds:
+        for ntide, nstr in NSTR.items():
+            for stide, sstr in SSTR.items():
+                if '%sAMP_%s_U' % (nstr, sstr) not in ds.variables:
+                    continue
+                tide = []
+                for dirn in 'U', 'V':
+                    amp = ds['%sAMP_%s_%s' % (nstr, sstr, dirn)].values
+                    ph = -2 * np.pi * ntide / 24. * ds['%sPHASE_%s_%s' % (nstr, sstr, dirn)].values
+                    tide.append(np.stack([amp * np.cos(ph), amp * np.sin(ph)], axis=-1))
+                tides.append((ntide, stide))
+                values.append(np.stack(tide, axis=-2))  # (alt, lat, dirn, re/im)
+        alt = 1e3 * ds.Altitude.values
+        lat = ds.Latitude.values
+
+    values = np.stack(values, axis=2) if values else np.zeros((len(alt), len(lat), 0, 2, 2))
+    interp = interpolate.RegularGridInterpolator(
+        (alt, lat), values, method='linear', bounds_error=False, fill_value=np.nan)
+
+    return {'tides': tides, 'interp': interp}
+
+
+def interp_hme(hme, glats, alts):
+    ''' complex tidal coefficients of every tide in hme at the points, as (point, tide, dirn) '''
+    vals = hme['interp'](np.vstack((alts, glats)).T)
+    return vals[..., 0] + 1j * vals[..., 1]
+
+
+def eval_hme_tides(fn_hme, glats, glons, alts, thrs):
+    '''
+    Evaluate all HMEs that are available in a given ICON L4.1 data file, at given locations
+    and for several UT hours, in one batched call.
+
+    INPUTS:
+    * fn_hme - full path to an ICON L4.1 HME data product
+    * glats  - [deg] 1D array of geographic latitudes to evaluate the wind at
+    * glons  - [deg] 1D array of geographic longitudes to evaluate the wind at
+    * alts   - [m] 1D array of geographic altitudes to evaluate the wind at
+    * thrs   - [hr] (scalar or 1D array) UT hours to evaluate the tides at
+
+    RETURNS:
+    * u      - [m/s] (hour, point) array of zonal winds
+    * v      - [m/s] (hour, point) array of meridional winds
+    '''
+    hme = load_hme(os.path.abspath(os.path.expanduser(fn_hme)))
+    thrs = np.atleast_1d(thrs).astype(float)
+    glons = np.asarray(glons, dtype=float)
+    ntide = np.array([n for n, _ in hme['tides']])
+    stide = np.array([s for _, s in hme['tides']])
+
+    # wind = Re(coeffs * exp(i phase)) summed over tides, with phase as (tide, hour, point)
+    coeffs = interp_hme(hme, glats, alts)
+    phase = 2 * np.pi * ntide[:, None, None] / 24. * thrs[None, :, None] + \
+        stide[:, None, None] * glons[None, None, :] * np.pi / 180.
+    wind = np.real(np.einsum('ptd,thp->dhp', coeffs, np.exp(1j * phase)))
+
+    return wind[0], wind[1]
 
 
 def eval_hme_all(fn_hme, glats, glons, alts, thr):
@@ -197,39 +230,26 @@ def eval_hme_all(fn_hme, glats, glons, alts, thr):
     * v      - [m/s] 1D array of meridional winds
     '''
 
-    u = np.zeros(len(glats))
-    v = np.zeros(len(glats))
-
-    for n in range(1, 3):  # diurnal and semi-diurnal
-        for s in range(-4, 4):  # E4 to W3 inclusive
-            uns, vns = eval_hme(fn_hme, n, s, glats, glons, alts, thr)
-            u += uns
-            v += vns
-    return u, v
+    u, v = eval_hme_tides(fn_hme, glats, glons, alts, thr)
+    return u[0], v[0]
 
 
 def eval_icon_hme(fn_hme, glats_1d, glons_1d, alt_km, thrs, 
         dirns=['u', 'v'], plot=False,
 ):
-    """ wrapper for eval_hme_all """
+    """ wrapper for eval_hme_tides - all tides at every lat/lon/hour on a grid """
    
     alt = alt_km * 1000 
-    if (len(glats_1d) != len(glons_1d)) or (len(glats) != len(alt)):
-        glats_3d, glons_3d, alts_3d = np.meshgrid(
-            glats_1d, glons_1d, alt, indexing='ij')
+    glats_3d, glons_3d, alts_3d = np.meshgrid(
+        glats_1d, glons_1d, alt, indexing='ij')
     glats = glats_3d.flatten()
     glons = glons_3d.flatten()
     alts = alts_3d.flatten() 
 
-    u_3d = np.ones((len(thrs), glats_3d.shape[0], glats_3d.shape[1])) * np.nan
-    v_3d = np.ones_like(u_3d) * np.nan
-    wind_array = np.zeros((len(dirns), len(thrs), len(glats_1d), len(glons_1d)))
-    for ind, thr in enumerate(thrs):
-        u, v = eval_hme_all(fn_hme, glats, glons, alts, thr)
-        u_3d[ind, :, :] = np.reshape(u, glats_3d.shape[:2])
-        v_3d[ind, :, :] = np.reshape(v, glats_3d.shape[:2])
-        wind_array[0, ind, :, :] = np.reshape(u, glats_3d.shape[:2])
-        wind_array[1, ind, :, :] = np.reshape(v, glats_3d.shape[:2])
+    u, v = eval_hme_tides(fn_hme, glats, glons, alts, thrs)
+    u_3d = np.reshape(u, (len(thrs),) + glats_3d.shape[:2])
+    v_3d = np.reshape(v, (len(thrs),) + glats_3d.shape[:2])
+    wind_array = np.stack([u_3d, v_3d])
 
     wind = { 
         'wind': wind_array,
@@ -0,0 +1,270 @@
+"""
+zenodo_uploader.py
+
+Parallel, resumable upload of SuperDARN files to a Zenodo deposition
+
+Files are PUT into the deposition bucket by a bounded pool of workers, each
+with its own retry/backoff. A local JSON manifest records the deposition and
+the (filename, size, md5) of every file that made it into the bucket, so a
+rerun reuses the same draft deposition and only sends files that are missing
+or have changed since they were uploaded.
+
+Manifest layout:
+    {
+        "deposition_id": 1234567,
+        "bucket": "https://zenodo.org/api/files/<uuid>",
+        "files": {
+            "20140524.kod.v3.0.nc": {"size": 1234, "mtime": 1.7e9, "md5": "..."},
+            ...
+        }
+    }
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+import helper
+
+NUM_WORKERS = 4
+MAX_NUM_TRIES = 5
+DELAY = 10  # seconds, doubled after each failed attempt
+TIMEOUT = 600  # seconds per request
+MD5_BLOCK_SIZE = 2 ** 20  # bytes
+
+
+def upload_files(file_list, deposit_url, access_token, manifest_fn,
+                 num_workers=NUM_WORKERS, max_tries=MAX_NUM_TRIES):
+    """
+    Upload file_list into a (new or resumed) Zenodo deposition
+
+    Returns the deposition ID and a list of the files that could not be
+    uploaded. The manifest is rewritten after every completed file, so an
+    interrupted run picks up where it left off.
+    """
+    params = {'access_token': access_token}
+    gate = RateLimitGate()
+    manifest = load_manifest(manifest_fn)
+
+    deposition_id, bucket_url = get_deposition(
+        manifest, deposit_url, params, gate)
+    if manifest.get('deposition_id') != deposition_id:
+        # New deposition - nothing from an old manifest is in this bucket
+        manifest = {'deposition_id': deposition_id,
+                    'bucket': bucket_url, 'files': {}}
+        save_manifest(manifest, manifest_fn)
+
+    remote_files = get_remote_files(bucket_url, params, gate)
+    to_upload = get_files_to_upload(file_list, manifest, remote_files)
+    # Keep entries recovered from the bucket even if nothing needs uploading
+    save_manifest(manifest, manifest_fn)
+    print('{0} of {1} files need uploading to deposition {2}'.format(
+        len(to_upload), len(file_list), deposition_id))
+
+    lock = threading.Lock()
+    failed = []
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = {
+            executor.submit(upload_file, fn, md5, bucket_url, params, gate, max_tries): fn
+            for fn, md5 in to_upload.items()
+        }
+        for future in as_completed(futures):
+            fn = futures[future]
+            filename = os.path.basename(fn)
+            try:
+                future.result()
+            except Exception as e:
+                print('Failed to upload {0}: {1}'.format(filename, e))
+                failed.append(fn)
+                continue
+
+            fn_info = os.stat(fn)
+            with lock:
+                manifest['files'][filename] = {
+                    'size': fn_info.st_size,
+                    'mtime': fn_info.st_mtime,
+                    'md5': to_upload[fn],
+                }
+                save_manifest(manifest, manifest_fn)
+
+    return deposition_id, failed
+
+
+def get_deposition(manifest, deposit_url, params, gate):
+    """ Reuse the manifest's deposition if it is still an open draft, else create one """
+    deposition_id = manifest.get('deposition_id')
+    if deposition_id is not None:
+        r = request_with_retry(
+            'get', '{0}/{1}'.format(deposit_url, deposition_id), gate, params=params)
+        if r.status_code == 200 and not r.json().get('submitted', False):
+            print('Resuming deposition {0}'.format(deposition_id))
+            return deposition_id, r.json()['links']['bucket']
+        print('Deposition {0} is no longer an open draft - creating a new one'.format(
+            deposition_id))
+
+    r = request_with_retry('post', deposit_url, gate, params=params, json={},
+                           headers={'Content-Type': 'application/json'})
+    r.raise_for_status()
+    return r.json()['id'], r.json()['links']['bucket']
+
+
+def get_remote_files(bucket_url, params, gate):
+    """ Return {filename: (size, md5)} for everything already in the bucket """
+    r = request_with_retry('get', bucket_url, gate, params=params)
+    if r.status_code != 200:
+        return {}
+
+    remote_files = {}
+    for entry in r.json().get('contents', []):
+        md5 = entry.get('checksum', '').replace('md5:', '')
+        remote_files[entry['key']] = (entry.get('size'), md5)
+    return remote_files
+
+
+def get_files_to_upload(file_list, manifest, remote_files):
+    """ Return {path: md5} for files that are missing or changed in the bucket """
+    to_upload = {}
+    for fn in file_list:
+        filename = os.path.basename(fn)
+        fn_info = os.stat(fn)
+        entry = manifest['files'].get(filename)
+        remote = remote_files.get(filename)
+
+        # Unchanged since the last upload and still in the bucket - no need to hash
+        if entry and remote and entry['size'] == fn_info.st_size \
+                and entry['mtime'] == fn_info.st_mtime \
+                and remote == (entry['size'], entry['md5']):
+            continue
+
+        md5 = file_md5(fn)
+        if remote == (fn_info.st_size, md5):
+            # Already in the bucket (e.g. manifest was lost) - just record it
+            manifest['files'][filename] = {
+                'size': fn_info.st_size, 'mtime': fn_info.st_mtime, 'md5': md5}
+            continue
+        to_upload[fn] = md5
+
+    return to_upload
+
+
+def upload_file(fn, md5, bucket_url, params, gate, max_tries=MAX_NUM_TRIES):
+    """ PUT one file into the bucket and check Zenodo received what we sent """
+    filename = os.path.basename(fn)
+    url = '{0}/{1}'.format(bucket_url, filename)
+
+    for num_tries in range(1, max_tries + 1):
+        with open(fn, 'rb') as fp:
+            r = request_with_retry('put', url, gate, max_tries=1,
+                                   data=fp, params=params)
+
+        if r is not None and r.status_code in (200, 201):
+            remote_md5 = r.json().get('checksum', '').replace('md5:', '')
+            if remote_md5 == md5:
+                print('Uploaded {0}'.format(filename))
+                return
+            print('Checksum mismatch for {0} (attempt #{1})'.format(
+                filename, num_tries))
+        else:
+            print('Upload of {0} failed (attempt #{1})'.format(
+                filename, num_tries))
+
+        time.sleep(DELAY * 2 ** (num_tries - 1))
+
+    raise IOError('Unable to upload {0} after {1} attempts'.format(
+        filename, max_tries))
+
+
+def request_with_retry(method, url, gate, max_tries=MAX_NUM_TRIES, **kwargs):
+    """
+    Make a Zenodo API request, backing off on connection errors, 429s and 5xxs
+
+    Returns the last response (or None if no response was ever received when
+    max_tries == 1), leaving the caller to decide what a 4xx means.
+    """
+    r = None
+    for num_tries in range(1, max_tries + 1):
+        gate.wait()
+        try:
+            r = requests.request(method, url, timeout=TIMEOUT, **kwargs)
+        except requests.exceptions.RequestException as e:
+            print('{0} {1} failed: {2}'.format(method.upper(), url, e))
+            r = None
+        else:
+            gate.update(r)
+            if r.status_code != 429 and r.status_code < 500:
+                return r
+
+        if num_tries < max_tries:
+            time.sleep(DELAY * 2 ** (num_tries - 1))
+
+    if r is None and max_tries > 1:
+        raise IOError('No response from {0} after {1} attempts'.format(
+            url, max_tries))
+    return r
+
+
+class RateLimitGate:
+    """
+    Shared version of helper.check_remaining_zenodo_requests for worker threads
+
+    When any response reports that the rate limit is about to be exhausted,
+    every worker holds off until the reset time instead of only the one that
+    happened to see the header.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.resume_time = 0
+
+    def wait(self):
+        with self.lock:
+            sleep_time = self.resume_time - time.time()
+        if sleep_time > 0:
+            time.sleep(sleep_time)
+
+    def update(self, response):
+        rate_limit_remaining = int(
+            response.headers.get('X-RateLimit-Remaining', 0))
+        rate_limit_reset = int(response.headers.get('X-RateLimit-Reset', 0))
+
+        if response.status_code == 429 or \
+                ('X-RateLimit-Remaining' in response.headers and rate_limit_remaining <= 1):
+            with self.lock:
+                if rate_limit_reset > self.resume_time:
+                    print('Rate limit about to be exhausted. Waiting for {} seconds...'.format(
+                        max(rate_limit_reset - int(time.time()), 0)))
+                    self.resume_time = rate_limit_reset
+
+
+def file_md5(fn):
+    md5 = hashlib.md5()
+    with open(fn, 'rb') as fp:
+        for block in iter(lambda: fp.read(MD5_BLOCK_SIZE), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def get_manifest_filename(product, date):
+    """ e.g. /project/superdarn/data/data_status/Zenodo_manifests/fit_nc_2014-05.json """
+    return os.path.join(helper.ZENODO_MANIFEST_DIR,
+                        '{0}_{1}.json'.format(product, date.strftime('%Y-%m')))
+
+
+def load_manifest(manifest_fn):
+    if not os.path.isfile(manifest_fn):
+        return {'files': {}}
+    with open(manifest_fn) as f:
+        manifest = json.load(f)
+    manifest.setdefault('files', {})
+    return manifest
+
+
+def save_manifest(manifest, manifest_fn):
+    # Write to a temporary file first so an interrupted run can't corrupt it
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_fn)), exist_ok=True)
+    tmp_fn = manifest_fn + '.tmp'
+    with open(tmp_fn, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_fn, manifest_fn)